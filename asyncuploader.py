@@ -0,0 +1,188 @@
+import asyncio
+import time
+from itertools import islice
+from patients import Patients
+from batchbundle import BatchBundle
+from transactionbundle import TransactionBundle
+from bundledispatcher import DEFAULT_CHUNK_SIZE
+from fhirserverclient import FhirClient, DEFAULT_BASE_URL, DEFAULT_USERNAME, DEFAULT_PASSWORD, DEFAULT_HEADERS, \
+    PREFER_MINIMAL
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp is only needed for the asyncio uploader
+    aiohttp = None
+
+# Bundles posted to the server at the same time.
+DEFAULT_CONCURRENCY = 8
+
+class UploadStats:
+    def __init__(self):
+        self.patients = 0
+        self.bundles = 0
+        self.entries = 0
+        self.failed_bundles = 0
+        self.elapsed = 0.0
+
+    def report(self):
+        elapsed = self.elapsed or 1e-9
+        print(f"Uploaded {self.patients} patients in {self.bundles} bundles ({self.entries} entries) in {self.elapsed:.2f}s")
+        print(f"Throughput: {self.bundles / elapsed:.1f} bundles/sec, {self.entries / elapsed:.1f} entries/sec")
+        if self.failed_bundles:
+            print(f"Failed bundles: {self.failed_bundles}")
+
+class AsyncBundleUploader:
+    def __init__(self, patients: Patients, base_url: str = DEFAULT_BASE_URL, username: str = DEFAULT_USERNAME,
+                 password: str = DEFAULT_PASSWORD, concurrency: int = DEFAULT_CONCURRENCY,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, timeout: float = 120, resolve_ids: bool = True):
+        """
+        Posts bundles for many patients concurrently with asyncio and aiohttp.
+
+        Work items are (patient identifier, observations) pairs. At most concurrency
+        bundles are in flight against the server, and the source is only read as fast as
+        the workers drain the queue, so a slow server pushes back on the producer.
+
+        :param patients: The Patients registry, used to look up and store FHIR ids.
+        :param base_url: The FHIR base URL.
+        :param username: User for HTTP basic authentication.
+        :param password: Password for HTTP basic authentication.
+        :param concurrency: The maximum number of requests in flight against the server.
+        :param chunk_size: The maximum number of observations per bundle.
+        :param timeout: Total timeout in seconds for each request.
+        :param resolve_ids: Look up the FHIR ids of uncached patients in bulk before uploading,
+                            so patients that already exist on the server are sent as batches.
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncBundleUploader requires aiohttp (pip install aiohttp)")
+        self.patients = patients
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self.resolve_ids = resolve_ids
+        self.auth = aiohttp.BasicAuth(username, password)
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.stats = UploadStats()
+
+    def run(self, source) -> UploadStats:
+        """Runs upload() on a new event loop and prints the throughput report."""
+        stats = asyncio.run(self.upload(source))
+        stats.report()
+        return stats
+
+    async def upload(self, source) -> UploadStats:
+        """
+        Uploads every (patient identifier, observations) pair from an async iterable.
+
+        :param source: An async iterable of (identifier, list of Observations).
+        :return: The UploadStats of the run.
+        """
+        self.stats = UploadStats()
+        if self.resolve_ids:
+            with FhirClient(self.base_url, self.username, self.password) as client:
+                await asyncio.to_thread(self.patients.resolve_patient_ids, None, client)
+        # The bounded queue provides backpressure: the producer waits while all workers are busy.
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        start = time.perf_counter()
+        async with aiohttp.ClientSession(connector=connector, auth=self.auth, headers=DEFAULT_HEADERS,
+                                         timeout=self.timeout) as session:
+            workers = [asyncio.create_task(self._worker(queue, session, semaphore))
+                       for _ in range(self.concurrency)]
+            try:
+                async for identifier, observations in source:
+                    await queue.put((identifier, observations))
+                await queue.join()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        self.stats.elapsed = time.perf_counter() - start
+        return self.stats
+
+    async def _worker(self, queue, session, semaphore):
+        while True:
+            identifier, observations = await queue.get()
+            try:
+                await self._upload_patient(identifier, observations, session, semaphore)
+            except Exception as e:
+                print(f"Failed to upload observations for patient {identifier}. Error: {e}")
+            finally:
+                queue.task_done()
+
+    async def _upload_patient(self, identifier, observations, session, semaphore):
+        patient = self.patients.get_patient(identifier)
+        if patient is None:
+            print(f"No such patient with this identifier {identifier}")
+            return
+        self.stats.patients += 1
+        # Observations and bundles are built, and bundles serialized, in worker threads, so the
+        # pydantic work does not hold up the event loop while other requests are in flight.
+        observations = iter(observations)
+        first_chunk = await asyncio.to_thread(self._next_chunk, observations)
+
+        patient_id = self.patients.get_patient_id(identifier)
+        if not patient_id:
+            # The Patient must be created before any batch can reference it.
+            transaction = await asyncio.to_thread(TransactionBundle, patient, first_chunk)
+            patient_id = await self._post(transaction, session, semaphore)
+            if patient_id == "":
+                return
+            self.patients.store_patient_id(identifier, patient_id)
+            first_chunk = []
+
+        batches = await asyncio.to_thread(self._build_batches, patient_id, first_chunk, observations)
+        results = await asyncio.gather(*(self._post(batch, session, semaphore) for batch in batches),
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            self.stats.failed_bundles += len(errors)
+            print(f"Failed to post {len(errors)} of {len(batches)} bundles for patient {identifier}. "
+                  f"Error: {errors[0]}")
+
+    def _next_chunk(self, observations) -> list:
+        return list(islice(observations, self.chunk_size))
+
+    def _build_batches(self, patient_id: str, first_chunk: list, observations) -> list:
+        chunks = [first_chunk] if first_chunk else []
+        chunks.extend(iter(lambda: self._next_chunk(observations), []))
+        return [BatchBundle(patient_id, chunk) for chunk in chunks]
+
+    async def _post(self, bundle, session, semaphore) -> str:
+        body = await asyncio.to_thread(_encode, bundle)
+        async with semaphore:
+            async with session.post(self.base_url, data=body, headers={"Prefer": PREFER_MINIMAL}) as response:
+                body = await response.read() if response.status in (200, 201) else await response.text()
+        patient_id = await asyncio.to_thread(bundle.read_response, response.status, body)
+        self.stats.bundles += 1
+        self.stats.entries += len(bundle.bundle.entry)
+        if patient_id == "":
+            self.stats.failed_bundles += 1
+        return patient_id
+
+def _encode(bundle) -> bytes:
+    # One chunk of at most chunk_size entries, small enough to hold encoded.
+    return b"".join(bundle.iter_json())
+
+async def patient_file_source(patients: Patients):
+    """
+    Async source of (identifier, observations) for every patient in patients.txt
+    that has a heart rate file. Files are parsed in a worker thread.
+    """
+    from heartratefilebundlegenerator import HeartRateFileBundleGenerator
+
+    for identifier in patients.identifiers:
+        try:
+            observations = await asyncio.to_thread(HeartRateFileBundleGenerator.read_observations, identifier)
+        except ValueError as e:
+            print(e)
+            continue
+        yield identifier, observations
+
+# Example usage:
+if __name__ == "__main__":
+    patients = Patients()
+    uploader = AsyncBundleUploader(patients)
+    uploader.run(patient_file_source(patients))
@@ -1,34 +1,62 @@
+import json
+import time
+from typing import Optional
 import requests
 from fhir.resources.bundle import Bundle, BundleEntry, BundleEntryRequest
-from requests.auth import HTTPBasicAuth
 from printresource import print_fhir_resource  # Assuming this utility exists
 from observation import HeartRateObservation
+from bundlestream import stream_bundle_json
+from bundleresponse import DEFAULT_READ_SIZE, EntryResponse, parse_bundle_response, response_text
+from retrypolicy import RetryPolicy, retry_after_seconds
+from fhirserverclient import FhirClient, get_default_client
+from metrics import PostStats, metrics
 
 class BatchBundle:
-    def __init__(self, patientId: str, heart_rate_observations):
+    def __init__(self, patientId: str, heart_rate_observations, conditional: bool = False):
         """
         Initialize a BatchBundle.
 
         :param patientId: The FHIR id of the Patient.
-        :param heart_rate_observations: A single Observation or a list of Observations.
+        :param heart_rate_observations: A single Observation or a list of Observations. Observations
+                                        may also be given as JSON dicts, e.g. when replayed from the outbox,
+                                        or as serialized JSON bytes that already refer to the Patient
+                                        (see bundlepipeline), which are posted as they are.
+        :param conditional: Create each Observation with ifNoneExist on its first identifier, so
+                            resending an entry that was already stored does not duplicate it.
         """
+        started = time.perf_counter()
+        self.stats = PostStats()   # timings and byte counts, shown by print_ids
         # Ensure observations is a list.
         if not isinstance(heart_rate_observations, list):
             heart_rate_observations = [heart_rate_observations]
 
         entries = []
         self.observation_ids = []  # list for multiple observations, we can access after posting
+        self.results = []          # EntryResponse per observation, in input order
+        self.attempts = 0          # POSTs made by the last post_bundle
         self.patientId = patientId
         for observation in heart_rate_observations:
             # Update the observation's subject to reference the Patient id.
-            observation.subject.reference = f"Patient/{patientId}"
-            # Create a BundleEntry for each Observation.
-            entry = BundleEntry.construct(
-                resource=observation,
-                request=BundleEntryRequest.construct(
+            if isinstance(observation, dict):
+                observation["subject"] = {"reference": f"Patient/{patientId}"}
+            elif not isinstance(observation, bytes):
+                observation.subject.reference = f"Patient/{patientId}"
+            token = observation_identifier_token(observation) if conditional else None
+            if token:
+                request = BundleEntryRequest.construct(
+                    method="POST",
+                    url="Observation",
+                    ifNoneExist=f"identifier={token}"
+                )
+            else:
+                request = BundleEntryRequest.construct(
                     method="POST",
                     url="Observation"
                 )
+            # Create a BundleEntry for each Observation.
+            entry = BundleEntry.construct(
+                resource=observation,
+                request=request
             )
             entries.append(entry)
 
@@ -37,40 +65,160 @@ class BatchBundle:
             type="batch",
             entry=entries
         )
+        self.stats.built(time.perf_counter() - started)
+
+    def iter_entries(self, indexes=None):
+        """
+        Yields a (resource, request) pair for each Observation in the bundle.
+
+        :param indexes: Positions of the entries to yield, defaults to all of them.
+        """
+        entries = self.bundle.entry
+        for index in (range(len(entries)) if indexes is None else indexes):
+            yield entries[index].resource, entries[index].request
+
+    def iter_json(self, indexes=None):
+        """
+        Streams the Bundle JSON in chunks without building the whole document in memory.
+
+        :param indexes: Positions of the entries to include, defaults to all of them.
+        """
+        return stream_bundle_json("batch", self.iter_entries(indexes))
 
     # the return is the id of the patient we passed in
-    def post_bundle(self) -> str:
+    def post_bundle(self, client: FhirClient = None, retry_policy: RetryPolicy = None) -> str:
         """
         Posts a FHIR Batch bundle to a local FHIR server.
-        :return: The response object from the POST request.
+        The Bundle JSON is sent as a chunked request body while it is being encoded.
+
+        Each entry's outcome is recorded in results. Entries that failed with a retryable
+        status (409, 429, 5xx, ...) are resent on their own in a smaller batch, with the
+        backoff and budget of retry_policy; entries that succeeded are never sent again.
+        observation_ids stays aligned with the input, None for entries that still failed.
+
+        :param client: The FhirClient to post with, defaults to the shared client.
+        :param retry_policy: Backoff and budget for resending failed entries. Defaults to a new RetryPolicy().
+        :return: The Patient id if any entry was stored, "" otherwise.
         """
-        bundle_json = self.bundle.json()
-        endpoint = "http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4/"
-        headers = {
-            "Accept": "*/*",
-            "content-type": "application/fhir+json",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Prefer": "return=representation"
-        }
-        response = requests.post(endpoint, data=bundle_json, headers=headers, auth=HTTPBasicAuth('_System', 'ISCDEMO'))
-        
+        client = client or get_default_client()
+        retry_policy = retry_policy or RetryPolicy()
+        self.results = [None] * len(self.bundle.entry)
+        pending = list(range(len(self.bundle.entry)))
+        self.attempts = 0
+        while True:
+            retry_after = self._post_entries(client, pending)
+            self.attempts += 1
+            retryable = [index for index in pending if retry_policy.is_retryable(self.results[index].status_code)]
+            if not retryable or self.attempts >= retry_policy.max_attempts:
+                break
+            granted = retry_policy.acquire(len(retryable))
+            if granted == 0:
+                print(f"Retry budget exhausted, {len(retryable)} entries not resent")
+                break
+            pending = retryable[:granted]
+            time.sleep(retry_policy.delay(self.attempts - 1, retry_after))
+        return self._finish()
+
+    def _post_entries(self, client: FhirClient, indexes: list) -> Optional[float]:
+        # Posts the given entries as one batch and records their outcomes in results.
+        # Returns the Retry-After of a throttled request, if any.
+        serialized = self.stats.serialize_seconds
+        started = time.perf_counter()
+        try:
+            response = client.post_bundle(lambda: self.stats.body(self.iter_json(indexes)))
+        except requests.RequestException as e:
+            self._record_failure(indexes, EntryResponse(f"0 {e.__class__.__name__}"))
+            return None
+        finally:
+            self.stats.request(time.perf_counter() - started, serialized)
+        metrics.count("entries_posted", len(indexes))
         if response.status_code in (200, 201):
-            resource = response.json()
-            # For each observation entry (assuming they follow patient entry),
-            # collect their ids.
-            self.observation_ids = [entry['resource']['id'] for entry in resource['entry'][1:]]
-            return  self.patientId 
-            #print_fhir_resource(resource)
-        else:
-            print(f"Failed to post Batch Bundle. Status code: {response.status_code}")
-            print("Response:", response.text)
+            started = time.perf_counter()
+            self._record(indexes, parse_bundle_response(self.stats.response(response.iter_content(DEFAULT_READ_SIZE))))
+            self.stats.parsed(time.perf_counter() - started)
+            return None
+        self._record_failure(indexes, EntryResponse(f"{response.status_code} {response.reason}"), response.text)
+        return retry_after_seconds(response.headers.get("Retry-After"))
+
+    def _record(self, indexes: list, entry_responses: list) -> None:
+        if len(entry_responses) != len(indexes):
+            self._record_failure(indexes, EntryResponse("0 Malformed response"),
+                                 f"{len(entry_responses)} entries in the response, {len(indexes)} posted")
+            return
+        for index, entry_response in zip(indexes, entry_responses):
+            self.results[index] = entry_response
+
+    def _record_failure(self, indexes: list, entry_response: EntryResponse, text: str = None) -> None:
+        print(f"Failed to post Batch Bundle. Status: {entry_response.status}")
+        if text:
+            print("Response:", text)
+        for index in indexes:
+            self.results[index] = entry_response
+
+    def _finish(self) -> str:
+        self.observation_ids = [result.id if result is not None and result.ok else None for result in self.results]
+        failed = self.get_failed_indexes()
+        metrics.count("bundles_posted")
+        metrics.count("entries_failed", len(failed))
+        if failed:
+            statuses = sorted({self.results[index].status for index in failed})
+            print(f"{len(failed)} of {len(self.results)} Observations not stored after {self.attempts} attempts: {statuses}")
+        if self.results and len(failed) == len(self.results):
             return ""
+        return self.patientId
+
+    def read_response(self, status_code: int, body) -> str:
+        """
+        Collects the Observation ids from the server's answer to this bundle, for callers that
+        post the bundle themselves, like the asynchronous uploader. There is no retry here.
+        The ids are taken from each entry's response.location, so minimal responses work and
+        echoed resources are never decoded.
+
+        :param status_code: HTTP status of the POST.
+        :param body: Response body as str, bytes or an iterable of bytes chunks.
+        :return: The Patient id if any entry was stored, "" otherwise.
+        """
+        self.results = [None] * len(self.bundle.entry)
+        self.attempts = 1
+        indexes = list(range(len(self.bundle.entry)))
+        if status_code in (200, 201):
+            # A batch has no Patient entry, so every entry is an Observation.
+            self._record(indexes, parse_bundle_response(body))
+        else:
+            self._record_failure(indexes, EntryResponse(str(status_code)), response_text(body))
+        return self._finish()
+
+    @property
+    def failed_count(self) -> int:
+        """The number of Observations not stored by the last post."""
+        return len(self.get_failed_indexes())
+
+    def get_failed_indexes(self) -> list:
+        """Positions of the Observations that were not stored by the last post."""
+        return [index for index, result in enumerate(self.results) if result is None or not result.ok]
 
-        return response
-    
     def print_ids(self):
         print("Patient ID - Known before Posting", self.patientId)
         print("Observation IDs:", self.observation_ids)
+        print(self.stats.summary())
+
+def observation_identifier_token(observation) -> str:
+    """
+    Returns the first identifier of an Observation (model, JSON dict or JSON bytes) as a FHIR
+    search token "system|value", or None if it has no identifier.
+    """
+    if isinstance(observation, bytes):
+        observation = json.loads(observation)
+    if isinstance(observation, dict):
+        identifiers = observation.get("identifier")
+        if not identifiers:
+            return None
+        system, value = identifiers[0].get("system"), identifiers[0].get("value")
+    else:
+        if not observation.identifier:
+            return None
+        system, value = observation.identifier[0].system, observation.identifier[0].value
+    return f"{system}|{value}" if system else value
 
 # Example usage:
 if __name__ == "__main__":
@@ -0,0 +1,576 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from observation import HeartRateObservation
+
+def bench_observation_construction(count: int = 1000):
+    """
+    Compares the validated constructor of HeartRateObservation with the template-based
+    fast path and prints observations/sec for each.
+
+    :param count: The number of observations to build with each method.
+    """
+    base_dt = datetime(2025, 3, 15, tzinfo=ZoneInfo("America/New_York"))
+    values = [random.randint(60, 160) for _ in range(count)]
+    datetimes = [base_dt + timedelta(minutes=i) for i in range(count)]
+
+    # Before: full validation followed by .dict() and a second validation pass.
+    start = time.perf_counter()
+    for value, effective_dt in zip(values, datetimes):
+        HeartRateObservation("2", value, effective_dt=effective_dt)
+    before = time.perf_counter() - start
+
+    # After: one reading at a time through the template.
+    HeartRateObservation.get_template()
+    start = time.perf_counter()
+    for value, effective_dt in zip(values, datetimes):
+        HeartRateObservation.from_template("2", value, effective_dt=effective_dt)
+    after = time.perf_counter() - start
+
+    # After: the whole batch at once.
+    start = time.perf_counter()
+    HeartRateObservation.build_many("2", values, datetimes)
+    batch = time.perf_counter() - start
+
+    print(f"HeartRateObservation construction, {count} readings")
+    print(f"  constructor (before):  {count / before:12.0f} obs/sec")
+    print(f"  from_template (after): {count / after:12.0f} obs/sec  ({before / after:.1f}x)")
+    print(f"  build_many (after):    {count / batch:12.0f} obs/sec  ({before / batch:.1f}x)")
+
+def bench_response_parsing(count: int = 1000, repeat: int = 20):
+    """
+    Compares collecting the Observation ids of a count-entry batch response with json.loads
+    against the incremental BundleResponseParser, for return=representation and return=minimal
+    bodies produced by the stand-in server, and prints the body sizes and parse times.
+
+    :param count: The number of entries in the batch.
+    :param repeat: The number of times each body is parsed.
+    """
+    import json
+    from batchbundle import BatchBundle
+    from bundleresponse import parse_bundle_response
+    from mockfhirserver import MockFhirServer
+
+    observations = [HeartRateObservation.from_template("1", random.randint(60, 160), i) for i in range(count)]
+    bundle = json.loads(b"".join(BatchBundle("1", observations).iter_json()))
+    with MockFhirServer() as server:
+        full = json.dumps(server.handle_bundle(bundle)).encode()
+        minimal = json.dumps(server.handle_bundle(bundle, minimal=True)).encode()
+
+    def timed(parse, body):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            ids = parse(body)
+        assert len(ids) == count
+        return (time.perf_counter() - start) / repeat
+
+    # Before: materialize the whole response and read entry[i].resource.id.
+    before = timed(lambda body: [entry["resource"]["id"] for entry in json.loads(body)["entry"]], full)
+    after_full = timed(lambda body: [entry.id for entry in parse_bundle_response(body)], full)
+    after_minimal = timed(lambda body: [entry.id for entry in parse_bundle_response(body)], minimal)
+
+    print(f"Batch response parsing, {count} entries")
+    print(f"  representation + json.loads (before): {len(full):9d} bytes {before * 1000:8.2f} ms")
+    print(f"  representation + parser:              {len(full):9d} bytes {after_full * 1000:8.2f} ms  ({before / after_full:.1f}x)")
+    print(f"  minimal + parser (after):             {len(minimal):9d} bytes {after_minimal * 1000:8.2f} ms  ({before / after_minimal:.1f}x)")
+
+def bench_outbox(count: int = 20000, single_count: int = 2000):
+    """
+    Measures the outbox: appending one reading at a time with an fsync per record versus
+    grouped fsyncs, appending whole batches, and draining into the stand-in server.
+    Prints records/sec for each.
+
+    :param count: The number of records for the batch append and drain runs.
+    :param single_count: The number of records appended one at a time.
+    """
+    import shutil
+    import tempfile
+    from fhirserverclient import FhirClient
+    from mockfhirserver import MockFhirServer
+    from outbox import Outbox, OutboxDrainer, DEFAULT_FSYNC_EVERY
+    from patientidstore import PatientIdStore
+    from patients import Patients
+
+    patients = Patients(PatientIdStore(":memory:"))
+    identifier = patients.identifiers[0]
+    observations = [HeartRateObservation.from_template("1", random.randint(60, 160), i) for i in range(count)]
+    directory = tempfile.mkdtemp(prefix="outbox-bench-")
+    print("Outbox throughput")
+    try:
+        for fsync_every in (1, DEFAULT_FSYNC_EVERY):
+            path = os.path.join(directory, f"single-{fsync_every}")
+            with Outbox(path, fsync_every=fsync_every) as outbox:
+                start = time.perf_counter()
+                for observation in observations[:single_count]:
+                    outbox.append(identifier, [observation])
+                elapsed = time.perf_counter() - start
+            print(f"  append one at a time, fsync every {fsync_every:4d}: {single_count / elapsed:12.0f} records/sec")
+
+        with Outbox(os.path.join(directory, "batch")) as outbox:
+            start = time.perf_counter()
+            for offset in range(0, count, 1000):
+                outbox.append(identifier, observations[offset:offset + 1000])
+            elapsed = time.perf_counter() - start
+            print(f"  append 1000 at a time:                {count / elapsed:12.0f} records/sec")
+
+            with MockFhirServer() as server, FhirClient(base_url=server.base_url) as client:
+                drainer = OutboxDrainer(outbox, patients, client)
+                start = time.perf_counter()
+                while drainer.drain_once():
+                    pass
+                elapsed = time.perf_counter() - start
+            print(f"  drain into the stand-in server:       {drainer.posted / elapsed:12.0f} records/sec")
+    finally:
+        shutil.rmtree(directory)
+
+def bench_compression(count: int = 1000, bundles: int = 10):
+    """
+    Measures gzip request body compression: the ratio and compression time of a count-entry
+    batch at several levels, then the end-to-end time of posting bundles batches to the
+    stand-in server uncompressed and gzipped.
+
+    :param count: The number of entries per batch.
+    :param bundles: The number of batches posted in the end-to-end runs.
+    """
+    from batchbundle import BatchBundle
+    from fhirserverclient import FhirClient, COMPRESSION_GZIP, compress_body
+    from mockfhirserver import MockFhirServer
+
+    observations = [HeartRateObservation.from_template("1", random.randint(60, 160), i) for i in range(count)]
+    batch = BatchBundle("1", observations)
+    raw = b"".join(batch.iter_json())
+    print(f"Request body compression, {count} entries, {len(raw)} bytes uncompressed")
+    for level in (1, 6, 9):
+        start = time.perf_counter()
+        compressed = b"".join(compress_body(batch.iter_json(), COMPRESSION_GZIP, level))
+        elapsed = time.perf_counter() - start
+        print(f"  gzip level {level}: {len(compressed):9d} bytes ({len(raw) / len(compressed):5.1f}x) "
+              f"encoded and compressed in {elapsed * 1000:7.2f} ms")
+
+    for compression in (None, COMPRESSION_GZIP):
+        with MockFhirServer() as server, FhirClient(base_url=server.base_url, compression=compression) as client:
+            start = time.perf_counter()
+            for _ in range(bundles):
+                batch.post_bundle(client)
+            elapsed = time.perf_counter() - start
+            print(f"  post {bundles} batches, {compression or 'uncompressed':12s}: {elapsed:6.2f}s, "
+                  f"{server.bytes_received} bytes sent")
+
+def bench_timestamps(count: int = 100000):
+    """
+    Compares producing count "minutes ago" timestamps one at a time, as the Observation code
+    did (ZoneInfo, datetime.now() and isoformat() per reading), with TimestampService, which
+    captures one "now" and formats all of them in bulk. Prints timestamps/sec for each.
+
+    :param count: The number of timestamps.
+    """
+    from timestamps import TimestampService
+
+    minutes_ago = [random.randint(0, 1440) for _ in range(count)]
+
+    start = time.perf_counter()
+    for minutes in minutes_ago:
+        (datetime.now(ZoneInfo("America/New_York")) - timedelta(minutes=minutes)).isoformat()
+    before = time.perf_counter() - start
+
+    start = time.perf_counter()
+    TimestampService("America/New_York").format_minutes_ago(minutes_ago)
+    after = time.perf_counter() - start
+
+    print(f"Timestamp formatting, {count} readings")
+    print(f"  per reading (before): {count / before:12.0f} timestamps/sec")
+    print(f"  bulk (after):         {count / after:12.0f} timestamps/sec  ({before / after:.1f}x)")
+
+def bench_sampled(hours: int = 24, per_minute: int = 1):
+    """
+    Compares the request body and server entries of a day of readings posted raw (one
+    Observation per reading) and sampled (one valueSampledData Observation per hour, with and
+    without summary Observations).
+
+    :param hours: Hours of readings.
+    :param per_minute: Readings per minute.
+    """
+    from batchbundle import BatchBundle
+    from fhirserverclient import FhirClient
+    from mockfhirserver import MockFhirServer
+    from sampleddata import SampledHeartRateBuilder
+    from timestamps import TimestampService
+
+    timestamps = TimestampService("America/New_York")
+    count = hours * 60 * per_minute
+    epochs = [timestamps.now_epoch - i * 60 // per_minute for i in range(count)]
+    rates = [random.randint(60, 160) for _ in range(count)]
+
+    start = time.perf_counter()
+    raw = HeartRateObservation.build_many("1", rates, timestamps.format_epochs(epochs))
+    variants = [("raw", raw, time.perf_counter() - start)]
+    for summaries in (False, True):
+        start = time.perf_counter()
+        sampled = SampledHeartRateBuilder(summaries=summaries).build("1", rates, epochs)
+        variants.append(("sampled + summaries" if summaries else "sampled", sampled, time.perf_counter() - start))
+
+    print(f"Sampled observations, {count} readings over {hours} hours")
+    for name, observations, built in variants:
+        batch = BatchBundle("1", observations)
+        with MockFhirServer() as server, FhirClient(base_url=server.base_url) as client:
+            start = time.perf_counter()
+            batch.post_bundle(client)
+            posted = time.perf_counter() - start
+            print(f"  {name:20s}: {len(observations):6d} entries, {server.bytes_received:9d} bytes, "
+                  f"built in {built * 1000:7.2f} ms, posted in {posted * 1000:8.2f} ms")
+
+# Sizes every stage of the suite is measured at.
+SUITE_SCALES = (10, 1000, 100000)
+# A stage slower than the baseline by more than this fraction is reported as a regression.
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+DEFAULT_RESULTS_FILE = "benchmark-results.json"
+
+def _suite_stages(scale: int, workdir: str, server) -> list:
+    """
+    Returns (name, setup) for each stage of the suite at one scale. setup prepares the inputs
+    outside the timing and returns the function that is timed.
+    """
+    from patients import Patients
+    from patientidstore import PatientIdStore
+    from batchbundle import BatchBundle
+    from transactionbundle import TransactionBundle
+    from heartratereader import HeartRateReader
+    from bundledispatcher import BundleDispatcher
+    from fhirserverclient import FhirClient
+
+    base_dt = datetime(2025, 3, 15, tzinfo=ZoneInfo("America/New_York"))
+    values = [random.randint(60, 160) for _ in range(scale)]
+    datetimes = [base_dt + timedelta(seconds=i) for i in range(scale)]
+    patients = Patients(PatientIdStore(":memory:"))
+    identifier = patients.identifiers[0]
+
+    def observations():
+        return HeartRateObservation.build_many("1", values, datetimes)
+
+    def observation_validated():
+        return lambda: [HeartRateObservation("1", value, effective_dt=dt) for value, dt in zip(values, datetimes)]
+
+    def observation_build_many():
+        return observations
+
+    def batch_bundle_build():
+        built = observations()
+        return lambda: BatchBundle("1", built)
+
+    def transaction_bundle_build():
+        built, patient = observations(), patients.get_patient(identifier)
+        return lambda: TransactionBundle(patient, built)
+
+    def bundle_json():
+        bundle = BatchBundle("1", observations()).bundle
+        return bundle.json
+
+    def bundle_stream():
+        batch = BatchBundle("1", observations())
+        return lambda: b"".join(batch.iter_json())
+
+    def file_parse():
+        path = os.path.join(workdir, f"readings-{scale}.txt")
+        with open(path, 'w') as file:
+            file.writelines(f"({value}, '{dt.isoformat()}')\n" for value, dt in zip(values, datetimes))
+        return lambda: HeartRateReader(path)
+
+    def patients_load():
+        path = os.path.join(workdir, f"patients-{scale}.txt")
+        with open("patients.txt", 'r') as file:
+            template = next(line for line in file if line.strip()).rstrip("\n").rsplit(",", 1)[0]
+        with open(path, 'w') as file:
+            file.writelines(f"{template}, {index:03d}-{index // 1000 % 1000:03d}-{index % 10000:04d}\n"
+                            for index in range(scale))
+        store = PatientIdStore(":memory:")
+
+        def load():
+            # Cold start: the cached offset index is removed, so the roster is scanned.
+            if os.path.exists(path + ".idx"):
+                os.remove(path + ".idx")
+            return Patients(store, path)
+        return load
+
+    def post():
+        client = FhirClient(base_url=server.base_url)
+        built = observations()
+        patients.store_patient_id(identifier, "1")
+
+        def run():
+            # Resources stored by earlier runs would otherwise count towards peak_rss_kb.
+            server.reset_resources()
+            BundleDispatcher(identifier, built, patients).post_bundle(client)
+        return run
+
+    return [(stage.__name__, stage) for stage in (
+        observation_validated, observation_build_many, batch_bundle_build, transaction_bundle_build,
+        bundle_json, bundle_stream, file_parse, patients_load, post)]
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    # Nearest-rank percentile.
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))]
+
+def _peak_rss_kb() -> int:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(scales=SUITE_SCALES, latency: float = 0.0, stages=None, min_runs: int = 3,
+              output: str = DEFAULT_RESULTS_FILE) -> dict:
+    """
+    Measures every stage of the upload path at each scale: Observation construction (validated
+    and template), BatchBundle and TransactionBundle building, bundle.json() and streamed
+    serialization, heart rate file parsing, Patients.load_patients and posting to a
+    MockFhirServer with the given latency per request.
+
+    Each stage is run repeatedly, at least min_runs times and for at least a second, except at
+    large scales where a single run already takes that long. For every stage it reports the
+    throughput in items/sec of the median run, the p50 and p99 run times and the process peak
+    RSS after the stage. Peak RSS is a high-water mark, so it only grows from stage to stage.
+
+    :param scales: The numbers of readings (or patients) to measure at.
+    :param latency: Seconds the stand-in server waits before answering each request.
+    :param stages: Names of the stages to run, all of them by default.
+    :param min_runs: The minimum number of runs per stage.
+    :param output: JSON file the results are written to, None to not write them.
+    :return: The results, as written to the file.
+    """
+    from mockfhirserver import MockFhirServer
+
+    results = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency": latency,
+        "results": []
+    }
+    with MockFhirServer(latency=latency) as server, tempfile.TemporaryDirectory() as workdir:
+        for scale in scales:
+            for name, setup in _suite_stages(scale, workdir, server):
+                if stages and name not in stages:
+                    continue
+                run = setup()
+                times = []
+                started = time.perf_counter()
+                while len(times) < min_runs or time.perf_counter() - started < 1.0:
+                    start = time.perf_counter()
+                    run()
+                    times.append(time.perf_counter() - start)
+                    if times[-1] > 1.0:
+                        break
+                times.sort()
+                median = _percentile(times, 0.5)
+                result = {
+                    "stage": name,
+                    "scale": scale,
+                    "runs": len(times),
+                    "throughput": scale / median if median else None,
+                    "p50_ms": median * 1000,
+                    "p99_ms": _percentile(times, 0.99) * 1000,
+                    "peak_rss_kb": _peak_rss_kb()
+                }
+                results["results"].append(result)
+                print(f"{name:26s} {scale:7d}: {result['throughput']:12.0f} items/sec  p50 {result['p50_ms']:9.2f} ms  "
+                      f"p99 {result['p99_ms']:9.2f} ms  peak RSS {result['peak_rss_kb'] / 1024:7.1f} MB  ({len(times)} runs)")
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written to {output}")
+    return results
+
+def compare_results(baseline: dict, current: dict, threshold: float = DEFAULT_REGRESSION_THRESHOLD) -> list:
+    """
+    Prints the throughput of each stage and scale against a baseline run and returns the
+    (stage, scale) pairs that got slower by more than threshold.
+    """
+    previous = {(result["stage"], result["scale"]): result for result in baseline["results"]}
+    regressions = []
+    print(f"Compared with {baseline.get('commit') or 'baseline'} ({baseline.get('timestamp')}):")
+    for result in current["results"]:
+        key = (result["stage"], result["scale"])
+        if key not in previous or not previous[key]["throughput"]:
+            continue
+        ratio = result["throughput"] / previous[key]["throughput"]
+        flag = ""
+        if ratio < 1 - threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"  {key[0]:26s} {key[1]:7d}: {ratio:6.2f}x{flag}")
+    return regressions
+
+def bench_pipeline(count: int = 100000, processes=(1, 4, 16), chunk_size: int = 1000):
+    """
+    Posts the same readings through BundleDispatcher, which builds and serializes every
+    Observation in this process, and through ParallelBundlePipeline with 1, 4 and 16 worker
+    processes. The mock server runs in this process too and takes its share of the parent's
+    core, so the speedup levels off at the parent's posting rate, and at the number of cores.
+
+    :param count: Readings posted per run.
+    :param processes: The worker process counts to measure.
+    :param chunk_size: Observations per bundle.
+    """
+    from array import array
+    from patients import Patients
+    from patientidstore import PatientIdStore
+    from bundledispatcher import BundleDispatcher
+    from bundlepipeline import ParallelBundlePipeline
+    from fhirserverclient import FhirClient
+    from mockfhirserver import MockFhirServer
+    from timestamps import TimestampService, OffsetTable
+
+    timestamps = TimestampService("America/New_York")
+    epochs = array('q', (timestamps.now_epoch - (count - i) * 60 for i in range(count)))
+    utc_offsets = array('h', OffsetTable(timestamps.tz, epochs[0], epochs[-1]).offsets_for(epochs))
+    rates = array('H', (random.randint(60, 160) for _ in range(count)))
+    patients = Patients(PatientIdStore(":memory:"))
+    identifier = patients.identifiers[0]
+    patients.store_patient_id(identifier, "1")
+
+    print(f"Multiprocess bundle building, {count} readings in bundles of {chunk_size} ({os.cpu_count()} cores)")
+    with MockFhirServer() as server, FhirClient(base_url=server.base_url) as client:
+        start = time.perf_counter()
+        observations = (observation for i in range(0, count, chunk_size) for observation in
+                        HeartRateObservation.build_many("1", rates[i:i + chunk_size],
+                                                        timestamps.format_epochs(epochs[i:i + chunk_size])))
+        BundleDispatcher(identifier, observations, patients, chunk_size).post_bundle(client)
+        baseline = time.perf_counter() - start
+        print(f"  {'BundleDispatcher':22s}: {baseline:7.2f} s, {count / baseline:9.0f} obs/sec")
+        for process_count in processes:
+            pipeline = ParallelBundlePipeline(identifier, rates, epochs, utc_offsets, patients, chunk_size, process_count)
+            start = time.perf_counter()
+            pipeline.post_bundle(client)
+            elapsed = time.perf_counter() - start
+            print(f"  {f'{process_count} processes':22s}: {elapsed:7.2f} s, {count / elapsed:9.0f} obs/sec, "
+                  f"{baseline / elapsed:5.2f}x, {pipeline.failed_count} not stored")
+
+def bench_preview(count: int = 100000, entries: int = 2):
+    """
+    Compares previewing the first entries of a generator's bundle the old way (build the whole
+    bundle, then print entry.json(indent=2) of the first entries) with print_preview, which
+    builds only the previewed Observations and writes its output at once.
+
+    :param count: Readings in the file.
+    :param entries: Entries previewed.
+    """
+    import io
+    from contextlib import redirect_stdout
+    from patients import Patients
+    from patientidstore import PatientIdStore
+    from heartratefilebundlegenerator import HeartRateFileBundleGenerator
+
+    patients = Patients(PatientIdStore(":memory:"))
+    identifier = patients.identifiers[0]
+    base_dt = datetime(2025, 3, 15, tzinfo=ZoneInfo("America/New_York"))
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "readings.txt")
+        with open(path, 'w') as file:
+            file.writelines(f"({random.randint(60, 160)}, '{(base_dt + timedelta(minutes=i)).isoformat()}')\n"
+                            for i in range(count))
+        with redirect_stdout(io.StringIO()):
+            generator = HeartRateFileBundleGenerator(identifier, patients, count, file_name=path)
+            start = time.perf_counter()
+            bundle = generator.get_bundle().bundle
+            for entry in bundle.entry[:entries]:
+                print(entry.json(indent=2))
+            built = time.perf_counter() - start
+
+            generator = HeartRateFileBundleGenerator(identifier, patients, count, file_name=path)
+            start = time.perf_counter()
+            generator.print_preview(entries)
+            previewed = time.perf_counter() - start
+    print(f"Bundle preview, first {entries} of {count} entries")
+    print(f"  build bundle + json : {built * 1000:9.2f} ms")
+    print(f"  print_preview       : {previewed * 1000:9.2f} ms ({built / previewed:.0f}x)")
+
+def bench_series_store(count: int = 20000):
+    """
+    Compares the memory of readings held as HeartRateObservation objects with a PatientSeries,
+    and times range queries, hourly statistics and downsampling on the series.
+
+    :param count: Readings (one per minute).
+    """
+    import tracemalloc
+    from seriesstore import PatientSeries
+    from timestamps import TimestampService, OffsetTable
+
+    timestamps = TimestampService("America/New_York")
+    epochs = [timestamps.now_epoch - (count - i) * 60 for i in range(count)]
+    rates = [random.randint(60, 160) for _ in range(count)]
+    utc_offsets = OffsetTable(timestamps.tz, epochs[0], epochs[-1]).offsets_for(epochs)
+
+    tracemalloc.start()
+    observations = HeartRateObservation.build_many("1", rates, timestamps.format_epochs(epochs))
+    object_bytes = tracemalloc.get_traced_memory()[0]
+    del observations
+    tracemalloc.stop()
+    tracemalloc.start()
+    series = PatientSeries("1", rates, epochs, utc_offsets)
+    series_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"Series store, {count} readings")
+    print(f"  as Observations: {object_bytes / count:8.0f} bytes per reading")
+    print(f"  PatientSeries  : {series_bytes / count:8.1f} bytes per reading ({series.nbytes} bytes of arrays)")
+    day = epochs[-1] - 86400
+    for name, query in (("range (last day)", lambda: series.range(day)),
+                        ("hourly stats", lambda: series.window_stats(3600)),
+                        ("downsample 15 min", lambda: series.downsample(900))):
+        start = time.perf_counter()
+        for _ in range(10):
+            query()
+        print(f"  {name:17s}: {(time.perf_counter() - start) * 100:8.3f} ms")
+
+def run_micro_benchmarks():
+    """The before/after comparisons of the individual optimizations."""
+    bench_observation_construction(1000)
+    bench_response_parsing(1000)
+    bench_outbox()
+    bench_compression()
+    bench_timestamps()
+    bench_sampled()
+    bench_preview()
+    bench_series_store()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the heart rate upload path.")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("micro", help="before/after comparisons of individual optimizations (default)")
+    suite_parser = commands.add_parser("suite", help="every stage at 10/1k/100k scale, saved as JSON")
+    suite_parser.add_argument("--scales", type=int, nargs="+", default=list(SUITE_SCALES))
+    suite_parser.add_argument("--stages", nargs="+", help="only run these stages")
+    suite_parser.add_argument("--latency", type=float, default=0.0, help="server latency per request in seconds")
+    suite_parser.add_argument("--output", default=DEFAULT_RESULTS_FILE, help="JSON file for the results")
+    suite_parser.add_argument("--compare", help="results JSON of an earlier run to compare with")
+    suite_parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+    pipeline_parser = commands.add_parser("pipeline", help="bundle building in 1/4/16 worker processes")
+    pipeline_parser.add_argument("--count", type=int, default=100000)
+    pipeline_parser.add_argument("--processes", type=int, nargs="+", default=[1, 4, 16])
+    arguments = parser.parse_args()
+
+    if arguments.command == "suite":
+        current = run_suite(arguments.scales, arguments.latency, arguments.stages, output=arguments.output)
+        if arguments.compare:
+            with open(arguments.compare, 'r') as file:
+                regressions = compare_results(json.load(file), current, arguments.threshold)
+            sys.exit(1 if regressions else 0)
+    elif arguments.command == "pipeline":
+        bench_pipeline(arguments.count, arguments.processes)
+    else:
+        run_micro_benchmarks()
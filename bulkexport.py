@@ -0,0 +1,289 @@
+import json
+import os
+import time
+from datetime import datetime, timezone
+from itertools import groupby
+from urllib.parse import quote
+import requests
+from patients import Patients
+from bundledispatcher import BundleDispatcher, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_WORKERS
+from fhirserverclient import FhirClient, get_default_client
+
+DEFAULT_EXPORT_DIR = "export"
+# A new file is started once the current file of a resource type reaches this size.
+DEFAULT_MAX_FILE_BYTES = 64 * 1024 * 1024
+# Seconds between polls of a running $import.
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_IMPORT_TIMEOUT = 3600.0
+NDJSON_FORMAT = "application/fhir+ndjson"
+MANIFEST_FILE = "manifest.json"
+# Patients must exist before the Observations referring to them are imported or replayed.
+RESOURCE_ORDER = ("Patient", "Observation")
+
+class NdjsonWriter:
+    def __init__(self, directory: str, resource_type: str, max_file_bytes: int = DEFAULT_MAX_FILE_BYTES):
+        """
+        Writes the resources of one type as newline-delimited JSON, in files
+        <resource_type>.0001.ndjson, <resource_type>.0002.ndjson, ... of at most max_file_bytes
+        (a single resource larger than that gets a file of its own).
+
+        :param directory: Where the files are written.
+        :param resource_type: The resource type, used for the file names.
+        :param max_file_bytes: The size in bytes at which a new file is started.
+        """
+        self.directory = directory
+        self.resource_type = resource_type
+        self.max_file_bytes = max_file_bytes
+        self.files = []  # [file name, resource count] of every file written
+        self._file = None
+        self._size = 0
+
+    def write(self, line: bytes) -> None:
+        """Writes one serialized resource, without the trailing newline."""
+        if self._file is None or (self._size and self._size + len(line) + 1 > self.max_file_bytes):
+            self._open_next()
+        self._file.write(line)
+        self._file.write(b"\n")
+        self._size += len(line) + 1
+        self.files[-1][1] += 1
+
+    def _open_next(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        name = f"{self.resource_type}.{len(self.files) + 1:04d}.ndjson"
+        self._file = open(os.path.join(self.directory, name), 'wb')
+        self._size = 0
+        self.files.append([name, 0])
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class BulkExporter:
+    def __init__(self, directory: str = DEFAULT_EXPORT_DIR, max_file_bytes: int = DEFAULT_MAX_FILE_BYTES):
+        """
+        Streams Patients and Observations into NDJSON files, one set of files per resource type,
+        for a bulk $import or for replaying into bundles later (see submit_import and replay_bundles).
+
+        Resources are serialized and written one at a time, so memory use does not grow with the
+        export. Observations refer to their Patient with a conditional reference on the Patient's
+        identifier ("Patient?identifier=system|value"), which stays valid whichever server the
+        files are loaded into and whether or not the Patient already has a FHIR id there.
+        close() writes a manifest.json in the form of a bulk data export manifest.
+
+        :param directory: Where the files are written. Existing files of the same names are replaced.
+        :param max_file_bytes: The size in bytes at which a new file is started for a resource type.
+        """
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        self.writers = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, resource, resource_type: str = None) -> None:
+        """
+        Writes one resource.
+
+        :param resource: A fhir.resources model, a JSON dict, or JSON bytes/str (then resource_type is required).
+        """
+        if isinstance(resource, dict):
+            resource_type = resource["resourceType"]
+            line = json.dumps(resource, separators=(",", ":")).encode()
+        elif isinstance(resource, (bytes, str)):
+            line = resource.encode() if isinstance(resource, str) else resource
+        else:
+            resource_type = resource.resource_type
+            line = resource.json().encode()
+        writer = self.writers.get(resource_type)
+        if writer is None:
+            writer = self.writers[resource_type] = NdjsonWriter(self.directory, resource_type, self.max_file_bytes)
+        writer.write(line)
+
+    def export_patients(self, patients: Patients, identifiers=None) -> int:
+        """
+        Writes the Patient resources of the roster, in roster order.
+
+        :param identifiers: The identifiers of the patients to export, defaults to all of them.
+        :return: The number of Patients written.
+        """
+        count = 0
+        for identifier in (patients.identifiers if identifiers is None else identifiers):
+            patient = patients.get_patient(identifier)
+            if patient is not None:
+                self.write(patient)
+                count += 1
+        return count
+
+    def export_observations(self, patients: Patients, patient_identifier: str, observations) -> int:
+        """
+        Writes the Observations of one patient, e.g. a generator's observations or the lazy
+        iterator of HeartRateFileBundleGenerator.read_observations.
+
+        :param patients: The Patients registry, for the identifier system of the subject reference.
+        :param patient_identifier: The identifier of the patient in the form '356-444-9972'.
+        :param observations: Any iterable of Observation models or JSON dicts, consumed lazily.
+        :return: The number of Observations written.
+        """
+        reference = f"Patient?identifier={patients.get_identifier_token(patient_identifier)}"
+        count = 0
+        for observation in observations:
+            if isinstance(observation, dict):
+                observation["subject"] = {"reference": reference}
+            else:
+                observation.subject.reference = reference
+            self.write(observation)
+            count += 1
+        return count
+
+    def close(self) -> list:
+        """
+        Closes all files and writes the manifest.
+
+        :return: The manifest outputs, one {"type", "url", "count"} dict per file, Patients first.
+        """
+        outputs = []
+        for resource_type in sorted(self.writers, key=_resource_order):
+            writer = self.writers[resource_type]
+            writer.close()
+            outputs.extend({"type": resource_type, "url": name, "count": count} for name, count in writer.files)
+        manifest = {
+            "transactionTime": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "requiresAccessToken": False,
+            "output": outputs,
+            "error": []
+        }
+        with open(os.path.join(self.directory, MANIFEST_FILE), 'w') as file:
+            json.dump(manifest, file, indent=2)
+        return outputs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _resource_order(resource_type: str):
+    return (RESOURCE_ORDER.index(resource_type) if resource_type in RESOURCE_ORDER else len(RESOURCE_ORDER), resource_type)
+
+def read_manifest(directory: str = DEFAULT_EXPORT_DIR) -> list:
+    """Returns the outputs of the manifest of an export directory."""
+    with open(os.path.join(directory, MANIFEST_FILE), 'r') as file:
+        return json.load(file)["output"]
+
+def iter_ndjson(path: str):
+    """Yields the resources of an NDJSON file as dicts, one line at a time."""
+    with open(path, 'rb') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+def import_parameters(outputs: list, files_url: str) -> dict:
+    """
+    The Parameters resource of a $import request for the files of a manifest.
+
+    :param outputs: The manifest outputs, see BulkExporter.close.
+    :param files_url: The URL the export directory is served under, e.g. "https://files.example.org/export/".
+    """
+    files_url = files_url if files_url.endswith("/") else files_url + "/"
+    parameters = [
+        {"name": "inputFormat", "valueCode": NDJSON_FORMAT},
+        {"name": "inputSource", "valueUri": files_url}
+    ]
+    for output in sorted(outputs, key=lambda output: _resource_order(output["type"])):
+        parameters.append({"name": "input", "part": [
+            {"name": "type", "valueCode": output["type"]},
+            {"name": "url", "valueUri": files_url + quote(output["url"])}
+        ]})
+    parameters.append({"name": "storageDetail", "part": [{"name": "type", "valueCode": "https"}]})
+    return {"resourceType": "Parameters", "parameter": parameters}
+
+def submit_import(outputs: list, files_url: str, client: FhirClient = None,
+                  poll_interval: float = DEFAULT_POLL_INTERVAL, timeout: float = DEFAULT_IMPORT_TIMEOUT) -> dict:
+    """
+    Asks the FHIR server to load the exported files with the asynchronous bulk $import operation
+    and waits until it is done. The server fetches the files itself, so the directory must be
+    served at files_url (MockFileServer stands in for this locally).
+
+    :param outputs: The manifest outputs, see BulkExporter.close and read_manifest.
+    :param files_url: The URL the export directory is served under.
+    :param client: The FhirClient to post with, defaults to the shared client.
+    :param poll_interval: Seconds between status polls, unless the server sends Retry-After.
+    :param timeout: Seconds to wait for the import to finish.
+    :return: The completion response of the import.
+    """
+    client = client or get_default_client()
+    response = client.post("$import", data=json.dumps(import_parameters(outputs, files_url)),
+                           headers={"Prefer": "respond-async"})
+    if response.status_code not in (200, 202):
+        raise requests.HTTPError(f"$import failed with status {response.status_code}: {response.text}", response=response)
+    if response.status_code == 200:
+        return response.json()
+    status_url = response.headers["Content-Location"]
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.session.get(status_url, timeout=client.timeout)
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code != 202:
+            raise requests.HTTPError(f"$import failed with status {response.status_code}: {response.text}", response=response)
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"$import not finished after {timeout} seconds, status at {status_url}")
+        try:
+            delay = float(response.headers.get("Retry-After", poll_interval))
+        except ValueError:
+            delay = poll_interval
+        time.sleep(delay)
+
+def replay_bundles(patients: Patients, directory: str = DEFAULT_EXPORT_DIR, client: FhirClient = None,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE, max_workers: int = DEFAULT_MAX_WORKERS) -> int:
+    """
+    Posts the exported Observations as bundles instead, for servers without $import.
+
+    The files are read line by line and every run of Observations of the same patient goes
+    through a BundleDispatcher, so at most max_workers chunks are held in memory and the
+    Patient is created first if it has no FHIR id yet. Patients are taken from the registry,
+    the exported Patient files are only needed for $import.
+
+    :param patients: The Patients registry the exported patients belong to.
+    :param directory: The export directory.
+    :param client: The FhirClient to post with, defaults to the shared client.
+    :param chunk_size: Observations per bundle, the server's maximum gives the fewest requests.
+    :param max_workers: The number of bundles posted concurrently.
+    :return: The number of Observations not stored.
+    """
+    client = client or get_default_client()
+    failed = 0
+    for output in read_manifest(directory):
+        if output["type"] != "Observation":
+            continue
+        resources = iter_ndjson(os.path.join(directory, output["url"]))
+        for reference, observations in groupby(resources, key=lambda resource: resource["subject"]["reference"]):
+            patient_identifier = reference.rpartition("|")[2] if reference.startswith("Patient?") else None
+            if patient_identifier is None or patient_identifier not in patients:
+                count = sum(1 for _ in observations)
+                print(f"Skipped {count} Observations of unknown patient '{reference}'.")
+                failed += count
+                continue
+            dispatcher = BundleDispatcher(patient_identifier, observations, patients, chunk_size, max_workers)
+            dispatcher.post_bundle(client)
+            failed += dispatcher.failed_count
+    return failed
+
+# Example usage:
+if __name__ == "__main__":
+    from mockfhirserver import MockFhirServer, MockFileServer
+    from heartratebundlegenerator import HeartRateBundleGenerator
+
+    patients = Patients()
+    with BulkExporter() as exporter:
+        exporter.export_patients(patients)
+        for identifier in patients.identifiers[:3]:
+            generator = HeartRateBundleGenerator(identifier, 5000, 60, 160, patients, shape="circadian", seed=1)
+            exporter.export_observations(patients, identifier, generator.observations)
+    outputs = read_manifest()
+    print(f"Exported {sum(output['count'] for output in outputs)} resources into {len(outputs)} files")
+
+    with MockFhirServer() as server, MockFileServer(DEFAULT_EXPORT_DIR) as files, \
+            FhirClient(base_url=server.base_url) as client:
+        result = submit_import(outputs, files.base_url, client, poll_interval=0.1)
+        print("$import:", [(output["type"], output["count"]) for output in result["output"]])
@@ -0,0 +1,185 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+from patients import Patients
+from observation import HeartRateObservation
+from batchbundle import BatchBundle
+from transactionbundle import TransactionBundle
+from fhirserverclient import FhirClient, get_default_client
+from retrypolicy import RetryPolicy
+from metrics import PostStats
+
+# Largest number of entries the FHIR server accepts in one Bundle.
+DEFAULT_CHUNK_SIZE = 1000
+# Number of bundles posted at the same time.
+DEFAULT_MAX_WORKERS = 4
+
+class BundleDispatcher:
+    def __init__(self, patient_identifier: str, observations, patients: Patients,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, max_workers: int = DEFAULT_MAX_WORKERS,
+                 retry_policy: RetryPolicy = None, on_chunk_posted=None, observation_count: int = None,
+                 patient_full_url: str = None):
+        """
+        Splits any number of observations into bundles of at most chunk_size entries.
+
+        For a patient without a FHIR id the first chunk is posted as a TransactionBundle that
+        creates the Patient, and the remaining chunks are posted as BatchBundles against the
+        returned id. Otherwise every chunk is a BatchBundle.
+
+        :param patient_identifier: The identifier of the patient in the form '356-444-9972'.
+        :param observations: A list or any iterable of Observations. Chunks are taken from it lazily.
+        :param patients: The Patients registry used to look up and store the FHIR id.
+        :param chunk_size: The maximum number of observations per bundle.
+        :param max_workers: The number of bundles posted concurrently.
+        :param retry_policy: Backoff and budget for resending failed batch entries, shared by all
+                             chunks. Defaults to a new RetryPolicy() per post_bundle.
+        :param on_chunk_posted: Called as on_chunk_posted(index, observation_ids) as soon as a chunk
+                                is posted, with None for observations not stored, e.g. to checkpoint
+                                progress. Chunk index i holds observations i * chunk_size onwards.
+                                Runs on the posting thread, so the calls never overlap.
+        :param observation_count: The number of observations, if known. Only used when the Patient
+                                  cannot be created, to report every observation as not stored;
+                                  otherwise the remaining observations are counted by consuming them.
+        :param patient_full_url: The fullUrl of the Patient in the first chunk's TransactionBundle,
+                                 defaults to a new urn:uuid.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        self.patient_identifier = patient_identifier
+        self.patients = patients
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.retry_policy = retry_policy
+        self.on_chunk_posted = on_chunk_posted
+        self.observation_count = observation_count
+
+        self.patient_resource = patients.get_patient(patient_identifier)
+        if self.patient_resource is None:
+            raise ValueError(f"Patient with identifier '{patient_identifier}' not found. Terminating program.")
+
+        self._observations = iter(observations)
+        # The first chunk is built up front so it can be previewed before posting.
+        first_chunk = self._next_chunk()
+        self.patient_id = patients.get_patient_id(patient_identifier) or ""
+        if self.patient_id:
+            self.first_bundle = BatchBundle(self.patient_id, first_chunk)
+        else:
+            self.first_bundle = TransactionBundle(self.patient_resource, first_chunk, patient_full_url=patient_full_url)
+        self.first_chunk_size = len(first_chunk)
+
+        self.bundle_count = 0
+        self.failed_chunks = []      # indexes of chunks that could not be posted
+        self.failed_count = 0        # observations not stored, including those of failed chunks
+        self.observation_ids = []    # ids in input order, None for observations in failed chunks
+        self.stats = PostStats()     # timings and byte counts of all chunks
+
+    @property
+    def bundle(self):
+        """The FHIR Bundle of the first chunk, for previewing."""
+        return self.first_bundle.bundle
+
+    def _next_chunk(self) -> list:
+        return list(islice(self._observations, self.chunk_size))
+
+    def post_bundle(self, client: FhirClient = None) -> str:
+        """
+        Posts all chunks, max_workers at a time, and reassembles observation_ids in input order.
+        :param client: The FhirClient to post with, defaults to the shared client. Its pool_size
+                       should be at least max_workers so every worker keeps its connection.
+        :return: The FHIR id of the patient, or "" if the patient could not be created.
+        """
+        client = client or get_default_client()
+        retry_policy = self.retry_policy or RetryPolicy()
+        results = {}
+        self.failed_chunks = []
+        self.stats = PostStats()
+        next_index = 0
+
+        if not self.patient_id:
+            # The Patient must exist before any batch can reference it.
+            self.patient_id = self.first_bundle.post_bundle(client)
+            if self.patient_id == "":
+                # Without the Patient no chunk can be posted, none of the observations is stored.
+                if self.observation_count is not None:
+                    total = self.observation_count
+                else:
+                    total = self.first_chunk_size + sum(1 for _ in self._observations)
+                self.failed_chunks.append(0)
+                self.observation_ids = [None] * total
+                self.stats.add(self.first_bundle.stats)
+                self.failed_count = total
+                self.bundle_count = 1
+                return ""
+            self.patients.store_patient_id(self.patient_identifier, self.patient_id)
+            results[0] = self.first_bundle.get_observation_ids()
+            if self.on_chunk_posted is not None:
+                self.on_chunk_posted(0, results[0])
+            self.stats.add(self.first_bundle.stats)
+            first_batch = None
+            next_index = 1
+        else:
+            first_batch = self.first_bundle
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = {}
+            while True:
+                # Keep at most max_workers chunks built and in flight at once.
+                while len(pending) < self.max_workers:
+                    if first_batch is not None:
+                        batch, first_batch = first_batch, None
+                    else:
+                        chunk = self._next_chunk()
+                        if not chunk:
+                            break
+                        batch = BatchBundle(self.patient_id, chunk)
+                    pending[executor.submit(batch.post_bundle, client, retry_policy)] = (next_index, batch)
+                    next_index += 1
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, batch = pending.pop(future)
+                    self.stats.add(batch.stats)
+                    ids = batch.observation_ids
+                    if future.result() == "" or len(ids) != len(batch.bundle.entry):
+                        self.failed_chunks.append(index)
+                        ids = [None] * len(batch.bundle.entry)
+                    results[index] = ids
+                    if self.on_chunk_posted is not None:
+                        self.on_chunk_posted(index, ids)
+
+        self.bundle_count = next_index
+        self.failed_chunks.sort()
+        self.observation_ids = [obs_id for index in sorted(results) for obs_id in results[index]]
+        self.failed_count = self.observation_ids.count(None)
+        if self.failed_chunks:
+            print(f"Failed to post {len(self.failed_chunks)} of {self.bundle_count} bundles: chunks {self.failed_chunks}")
+        return self.patient_id
+
+    def get_patient_id(self):
+        return self.patient_id
+
+    def get_observation_ids(self):
+        return self.observation_ids
+
+    def print_ids(self):
+        print("Patient ID:", self.get_patient_id())
+        print(f"Bundles posted: {self.bundle_count} ({self.chunk_size} observations per bundle)")
+        if self.failed_count:
+            print(f"Observations not stored: {self.failed_count}")
+        print("Observation IDs:", self.get_observation_ids())
+        print(self.stats.summary())
+
+# Example usage:
+if __name__ == "__main__":
+    import random
+
+    patients = Patients()
+    # One month of minute-level readings.
+    readings = (HeartRateObservation.from_template("356-444-9972", random.randint(60, 160), minutes)
+                for minutes in range(31 * 24 * 60))
+    dispatcher = BundleDispatcher("356-444-9972", readings, patients, chunk_size=1000, max_workers=8)
+    print(f"First bundle holds {len(dispatcher.bundle.entry)} entries")
+    # dispatcher.post_bundle()
+    # dispatcher.print_ids()
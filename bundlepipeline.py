@@ -0,0 +1,207 @@
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from patients import Patients
+from observation import HeartRateObservation
+from timestamps import format_iso
+from batchbundle import BatchBundle
+from transactionbundle import TransactionBundle
+from bundledispatcher import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_WORKERS
+from retrypolicy import RetryPolicy
+from fhirserverclient import FhirClient, get_default_client
+from metrics import PostStats
+
+# Worker processes building entries, defaults to one per core.
+DEFAULT_PROCESSES = os.cpu_count() or 1
+# Chunks encoded ahead of posting, per worker process. Bounds the memory held by finished chunks.
+ENCODE_AHEAD = 2
+
+def encode_observations(subject_reference: str, rates, epochs, utc_offsets) -> list:
+    """
+    Builds the HeartRateObservation of each reading and serializes it. Runs in the worker
+    processes: the arguments are compact arrays and the result a list of JSON bytes, so no
+    pydantic object ever crosses a process boundary.
+
+    :param subject_reference: The subject reference of every Observation, e.g. "Patient/2" or a
+                              "urn:uuid:..." fullUrl in a transaction.
+    :param rates: Heart rates.
+    :param epochs: Epoch seconds, one per rate.
+    :param utc_offsets: UTC offsets in minutes, one per rate.
+    :return: The JSON of each Observation, in input order.
+    """
+    encoded = []
+    for observation in HeartRateObservation.build_many("", rates, format_iso(epochs, utc_offsets)):
+        observation.subject.reference = subject_reference
+        encoded.append(observation.json().encode())
+    return encoded
+
+class ParallelBundlePipeline:
+    def __init__(self, patient_identifier: str, rates, epochs, utc_offsets, patients: Patients,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, processes: int = DEFAULT_PROCESSES,
+                 max_workers: int = DEFAULT_MAX_WORKERS, retry_policy: RetryPolicy = None,
+                 on_chunk_posted=None, patient_full_url: str = None):
+        """
+        Posts readings in bundles like BundleDispatcher, but builds and serializes the
+        Observations in a pool of worker processes, so pydantic work is spread over all cores
+        instead of holding one.
+
+        Workers get chunks of raw readings (rates, epochs, UTC offsets) and return the JSON
+        bytes of each Observation. This process wraps the bytes in BatchBundle (or, for a
+        patient without a FHIR id, one TransactionBundle for the first chunk) and posts
+        them from max_workers threads, while the workers already encode the next chunks.
+        At most processes * ENCODE_AHEAD encoded chunks wait for posting at any time.
+
+        observation_ids, failed_count, stats and print_ids behave as in BundleDispatcher.
+
+        :param patient_identifier: The identifier of the patient in the form '356-444-9972'.
+        :param rates: Heart rates, e.g. HeartRateReader.rates.
+        :param epochs: Epoch seconds, one per rate.
+        :param utc_offsets: UTC offsets in minutes, one per rate.
+        :param patients: The Patients registry, used to look up and store the FHIR patient id.
+        :param chunk_size: The maximum number of observations per bundle.
+        :param processes: The number of worker processes building entries.
+        :param max_workers: The number of bundles posted concurrently.
+        :param retry_policy: Backoff and budget for resending failed batch entries, see BundleDispatcher.
+        :param on_chunk_posted: Called as on_chunk_posted(index, observation_ids), see BundleDispatcher.
+        :param patient_full_url: The fullUrl of the Patient in the first chunk's TransactionBundle,
+                                 defaults to a new urn:uuid.
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        if processes < 1 or max_workers < 1:
+            raise ValueError("processes and max_workers must be at least 1")
+        self.patient_identifier = patient_identifier
+        self.rates = rates
+        self.epochs = epochs
+        self.utc_offsets = utc_offsets
+        self.patients = patients
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.max_workers = max_workers
+        self.retry_policy = retry_policy
+        self.on_chunk_posted = on_chunk_posted
+        self.patient_full_url = patient_full_url
+
+        self.patient_resource = patients.get_patient(patient_identifier)
+        if self.patient_resource is None:
+            raise ValueError(f"Patient with identifier '{patient_identifier}' not found. Terminating program.")
+        self.patient_id = patients.get_patient_id(patient_identifier) or ""
+
+        self.bundle_count = 0
+        self.failed_chunks = []      # indexes of chunks that could not be posted
+        self.failed_count = 0        # observations not stored, including those of failed chunks
+        self.observation_ids = []    # ids in input order, None for observations in failed chunks
+        self.stats = PostStats()     # timings and byte counts of all chunks
+
+    def _chunk(self, index: int) -> tuple:
+        start = index * self.chunk_size
+        end = start + self.chunk_size
+        return self.rates[start:end], self.epochs[start:end], self.utc_offsets[start:end]
+
+    def post_bundle(self, client: FhirClient = None) -> str:
+        """
+        Encodes and posts all chunks and reassembles observation_ids in input order.
+
+        :param client: The FhirClient to post with, defaults to the shared client.
+        :return: The FHIR id of the patient, or "" if the patient could not be created.
+        """
+        client = client or get_default_client()
+        retry_policy = self.retry_policy or RetryPolicy()
+        chunk_count = -(-len(self.rates) // self.chunk_size)
+        results = {}
+        self.failed_chunks = []
+        self.stats = PostStats()
+        next_index = 0
+
+        with ProcessPoolExecutor(max_workers=self.processes) as encoders, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as posters:
+            if not self.patient_id and chunk_count:
+                # The Patient must exist before any batch can reference it, so the first chunk
+                # goes alone in a transaction that refers to the Patient by its fullUrl.
+                patient_full_url = self.patient_full_url or f"urn:uuid:{uuid.uuid4()}"
+                encoded = encoders.submit(encode_observations, patient_full_url, *self._chunk(0)).result()
+                transaction = TransactionBundle(self.patient_resource, encoded, patient_full_url=patient_full_url)
+                self.patient_id = transaction.post_bundle(client)
+                self.stats.add(transaction.stats)
+                if self.patient_id == "":
+                    # Without the Patient no chunk can be posted, none of the readings is stored.
+                    self.failed_chunks.append(0)
+                    self.observation_ids = [None] * len(self.rates)
+                    self.failed_count = len(self.rates)
+                    self.bundle_count = 1
+                    return ""
+                self.patients.store_patient_id(self.patient_identifier, self.patient_id)
+                results[0] = transaction.get_observation_ids()
+                if self.on_chunk_posted is not None:
+                    self.on_chunk_posted(0, results[0])
+                next_index = 1
+
+            reference = f"Patient/{self.patient_id}"
+            encoding = deque()
+            posting = {}
+            while next_index < chunk_count or encoding or posting:
+                # Keep every worker process busy, a few chunks ahead of posting.
+                while next_index < chunk_count and len(encoding) < self.processes * ENCODE_AHEAD:
+                    encoding.append((next_index, encoders.submit(encode_observations, reference, *self._chunk(next_index))))
+                    next_index += 1
+                # Chunks are handed to the posters in order, as soon as they are encoded.
+                while encoding and encoding[0][1].done() and len(posting) < self.max_workers:
+                    index, future = encoding.popleft()
+                    batch = BatchBundle(self.patient_id, future.result())
+                    posting[posters.submit(batch.post_bundle, client, retry_policy)] = (index, batch)
+                waiting = list(posting)
+                if encoding and len(posting) < self.max_workers:
+                    waiting.append(encoding[0][1])
+                done, _ = wait(waiting, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future not in posting:
+                        continue
+                    index, batch = posting.pop(future)
+                    self.stats.add(batch.stats)
+                    ids = batch.observation_ids
+                    if future.result() == "" or len(ids) != len(batch.bundle.entry):
+                        self.failed_chunks.append(index)
+                        ids = [None] * len(batch.bundle.entry)
+                    results[index] = ids
+                    if self.on_chunk_posted is not None:
+                        self.on_chunk_posted(index, ids)
+
+        self.bundle_count = chunk_count
+        self.failed_chunks.sort()
+        self.observation_ids = [obs_id for index in sorted(results) for obs_id in results[index]]
+        self.failed_count = self.observation_ids.count(None)
+        if self.failed_chunks:
+            print(f"Failed to post {len(self.failed_chunks)} of {self.bundle_count} bundles: chunks {self.failed_chunks}")
+        return self.patient_id
+
+    def get_patient_id(self):
+        return self.patient_id
+
+    def get_observation_ids(self):
+        return self.observation_ids
+
+    def print_ids(self):
+        print("Patient ID:", self.get_patient_id())
+        print(f"Bundles posted: {self.bundle_count} ({self.chunk_size} observations per bundle, "
+              f"built by {self.processes} processes)")
+        if self.failed_count:
+            print(f"Observations not stored: {self.failed_count}")
+        print("Observation IDs:", self.get_observation_ids())
+        print(self.stats.summary())
+
+# Example usage:
+if __name__ == "__main__":
+    from heartratereader import HeartRateReader
+    from mockfhirserver import MockFhirServer
+
+    patients = Patients()
+    reader = HeartRateReader("3564449972.txt")
+    with MockFhirServer() as server, FhirClient(base_url=server.base_url) as client:
+        pipeline = ParallelBundlePipeline("356-444-9972", reader.rates, reader.epochs, reader.utc_offsets, patients,
+                                          chunk_size=100)
+        started = time.perf_counter()
+        pipeline.post_bundle(client)
+        print(f"Posted {len(pipeline.observation_ids)} observations in {time.perf_counter() - started:.2f}s")
+        print(pipeline.stats.summary())
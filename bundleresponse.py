@@ -0,0 +1,115 @@
+import codecs
+import json
+import re
+
+# Bytes read from the response body at a time.
+DEFAULT_READ_SIZE = 64 * 1024
+
+# The "response" member of a Bundle entry. Resources never have a "response" element,
+# so the key only occurs in batch-response and transaction-response entries.
+_RESPONSE_KEY = re.compile(r'"response"\s*:\s*(?=\{)')
+# Tail kept between chunks when no "response" key is pending, longer than any match of _RESPONSE_KEY.
+_CARRY = 64
+
+class EntryResponse:
+    def __init__(self, status: str = None, location: str = None):
+        """
+        The response part of one Bundle entry.
+
+        :param status: HTTP status of the entry, e.g. "201 Created".
+        :param location: Location of the created or matched resource, e.g. "Observation/12/_history/1".
+        """
+        self.status = status
+        self.location = location
+
+    @property
+    def status_code(self) -> int:
+        try:
+            return int(self.status.split()[0])
+        except (AttributeError, IndexError, ValueError):
+            return 0
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status_code < 300
+
+    @property
+    def id(self) -> str:
+        """The resource id from the location, or None if the entry has no location."""
+        return resource_id(self.location)
+
+    def __repr__(self) -> str:
+        return f"EntryResponse({self.status!r}, {self.location!r})"
+
+class BundleResponseParser:
+    def __init__(self):
+        """
+        Incremental parser for batch-response and transaction-response Bundles.
+
+        Only the response object of each entry is decoded; echoed resources are skipped by
+        a regex search for the next "response" key, so a return=representation body never
+        becomes a tree of Python objects. Feed the body in chunks of any size, then call close().
+        """
+        self.entries = []
+        self._buffer = ""
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._raw_decode = json.JSONDecoder().raw_decode
+
+    def feed(self, chunk: bytes) -> None:
+        buffer = self._buffer + self._decoder.decode(chunk)
+        position = 0
+        while True:
+            match = _RESPONSE_KEY.search(buffer, position)
+            if match is None:
+                # Keep the tail in case a "response" key is split between chunks.
+                self._buffer = buffer[max(position, len(buffer) - _CARRY):]
+                return
+            try:
+                response, position = self._raw_decode(buffer, match.end())
+            except json.JSONDecodeError:
+                # The response object is not complete yet, wait for more data.
+                self._buffer = buffer[match.start():]
+                return
+            self.entries.append(EntryResponse(response.get("status"), response.get("location")))
+
+    def close(self) -> list:
+        """Returns the EntryResponse of every entry, in entry order."""
+        self._buffer = ""
+        return self.entries
+
+def parse_bundle_response(body) -> list:
+    """
+    Returns the EntryResponse of every entry of a batch or transaction response.
+
+    :param body: The response body as str, bytes or an iterable of bytes chunks.
+    """
+    parser = BundleResponseParser()
+    if isinstance(body, str):
+        body = body.encode()
+    if isinstance(body, (bytes, bytearray)):
+        parser.feed(bytes(body))
+    else:
+        for chunk in body:
+            parser.feed(chunk)
+    return parser.close()
+
+def response_text(body) -> str:
+    """
+    A response body as text, e.g. to print the answer to a failed post.
+
+    :param body: The response body as str, bytes or an iterable of bytes chunks.
+    """
+    if isinstance(body, str):
+        return body
+    if not isinstance(body, (bytes, bytearray)):
+        body = b"".join(body)
+    return bytes(body).decode(errors="replace")
+
+def resource_id(location: str) -> str:
+    """
+    "Observation/12/_history/1" -> "12". Absolute locations such as
+    "http://host/fhir/r4/Observation/12/_history/1" work as well.
+    """
+    if not location:
+        return None
+    return location.split("/_history/")[0].rstrip("/").rsplit("/", 1)[-1]
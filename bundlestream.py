@@ -0,0 +1,68 @@
+import json
+from typing import Iterable, Iterator
+
+# Size of the pieces handed to requests as a chunked request body.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+def stream_bundle_json(bundle_type: str, entries: Iterable, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Encodes a FHIR Bundle as JSON one entry at a time, yielding the document in chunks
+    of roughly chunk_size bytes. Only one entry is serialized at any moment, so memory
+    stays constant regardless of the number of entries, and the output is byte-for-byte
+    what Bundle.json() produces for the same entries.
+
+    :param bundle_type: The Bundle type, e.g. "batch" or "transaction".
+    :param entries: An iterable of (resource, request) or (resource, request, fullUrl) tuples.
+                    resource may be a FHIR resource object or already serialized JSON (str/bytes),
+                    request a BundleEntryRequest or a plain dict.
+    :param chunk_size: Approximate size in bytes of each yielded chunk.
+    :return: A generator of bytes suitable for requests.post(data=...).
+    """
+    buffer = bytearray(b'{"entry":[')
+    first = True
+    for entry in entries:
+        if not first:
+            buffer += b","
+        first = False
+        buffer += encode_entry(*entry)
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    # Closed even when empty: Bundle.json() writes an empty entry list as "entry":[].
+    buffer += b"],"
+    buffer += b'"type":' + json.dumps(bundle_type).encode() + b',"resourceType":"Bundle"}'
+    yield bytes(buffer)
+
+def encode_entry(resource, request, full_url: str = None) -> bytes:
+    """
+    Serializes a single Bundle entry.
+
+    :param resource: A FHIR resource object, or its JSON as str/bytes.
+    :param request: A BundleEntryRequest or a dict such as {"method": "POST", "url": "Observation"}.
+    :param full_url: Optional fullUrl of the entry (e.g. "urn:uuid:...").
+    :return: The entry JSON as bytes.
+    """
+    parts = [b"{"]
+    if full_url is not None:
+        parts.append(b'"fullUrl":' + json.dumps(full_url).encode() + b",")
+    parts.append(b'"request":' + _to_json_bytes(request) + b",")
+    parts.append(b'"resource":' + _to_json_bytes(resource) + b"}")
+    return b"".join(parts)
+
+def _to_json_bytes(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, dict):
+        return json.dumps(value, separators=(",", ":")).encode()
+    return value.json().encode()
+
+# Example usage:
+if __name__ == "__main__":
+    from observation import HeartRateObservation
+
+    observations = [HeartRateObservation.from_template("2", 70 + i, i) for i in range(3)]
+    request = {"method": "POST", "url": "Observation"}
+    for chunk in stream_bundle_json("batch", ((obs, request) for obs in observations), chunk_size=256):
+        print(len(chunk), chunk[:60])
@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# Default location of the file checkpoints.
+DEFAULT_CHECKPOINT_PATH = "checkpoints.db"
+
+class FileCheckpoint:
+    def __init__(self, path: str, inode: int, mtime_ns: int, size: int, offset: int, last_epoch: Optional[int]):
+        """
+        How far a readings file has been posted.
+
+        :param path: The absolute path of the file.
+        :param inode: Inode of the file when the checkpoint was written, to notice a replaced file.
+        :param mtime_ns: Modification time of the file when the checkpoint was written.
+        :param size: Size of the file when the checkpoint was written.
+        :param offset: Byte offset up to which all readings are stored (reading index for .hrs files).
+        :param last_epoch: Epoch second of the latest reading stored, None if none was.
+        """
+        self.path = path
+        self.inode = inode
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.offset = offset
+        self.last_epoch = last_epoch
+
+    def __repr__(self) -> str:
+        return f"FileCheckpoint({self.path!r}, offset={self.offset}, last_epoch={self.last_epoch})"
+
+class CheckpointStore:
+    def __init__(self, path: str = DEFAULT_CHECKPOINT_PATH):
+        """
+        Persistent record of which readings of append-only heart rate files are already on the
+        FHIR server, backed by SQLite.
+
+        Each file has a checkpoint: the byte offset up to which every reading is stored, plus
+        the inode, mtime and size seen then. A run reads from the offset only, and skips the
+        file altogether if it has not changed. Checkpoints only move once everything before
+        them is stored. While a post is in flight, the (patient, effective time, value) of
+        every reading a server accepted is recorded per chunk, so a run after a crash skips
+        the readings that already went through instead of sending them twice. Those keys are
+        dropped when the checkpoint moves past them, so the table stays small.
+
+        :param path: The SQLite database file, ":memory:" for a process-local store.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            # Chunk records are committed often, WAL makes each commit a sequential append.
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS file_checkpoints ("
+                "path TEXT PRIMARY KEY, inode INTEGER, mtime_ns INTEGER, size INTEGER, "
+                "offset INTEGER NOT NULL, last_epoch INTEGER, updated_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS posted_readings ("
+                "patient TEXT NOT NULL, epoch INTEGER NOT NULL, value INTEGER NOT NULL, path TEXT NOT NULL, "
+                "PRIMARY KEY (patient, epoch, value)) WITHOUT ROWID"
+            )
+
+    def get(self, file_path: str) -> Optional[FileCheckpoint]:
+        file_path = os.path.abspath(file_path)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT inode, mtime_ns, size, offset, last_epoch FROM file_checkpoints WHERE path = ?",
+                (file_path,)).fetchone()
+        return FileCheckpoint(file_path, *row) if row else None
+
+    def start_offset(self, file_path: str) -> int:
+        """
+        The offset to continue reading a file at. A file that was replaced (other inode) or
+        truncated since its checkpoint is read from the start.
+        """
+        checkpoint = self.get(file_path)
+        if checkpoint is None:
+            return 0
+        stat = os.stat(file_path)
+        if stat.st_ino != checkpoint.inode or stat.st_size < checkpoint.size:
+            print(f"'{file_path}' was replaced or truncated since it was last posted, reading it from the start.")
+            return 0
+        return checkpoint.offset
+
+    def is_unchanged(self, file_path: str) -> bool:
+        """True if the file has the inode, size and mtime of its checkpoint, so there is nothing new to post."""
+        checkpoint = self.get(file_path)
+        if checkpoint is None:
+            return False
+        stat = os.stat(file_path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns) == (checkpoint.inode, checkpoint.size, checkpoint.mtime_ns)
+
+    def posted_keys(self, patient: str) -> set:
+        """(epoch, value) of the readings of a patient recorded as stored beyond their file's checkpoint."""
+        with self._lock:
+            return set(self._connection.execute(
+                "SELECT epoch, value FROM posted_readings WHERE patient = ?", (patient,)))
+
+    def record_posted(self, file_path: str, patient: str, keys) -> None:
+        """Records readings, as (epoch, value) pairs, that the server stored. Committed before returning."""
+        file_path = os.path.abspath(file_path)
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO posted_readings (patient, epoch, value, path) VALUES (?, ?, ?, ?)",
+                [(patient, epoch, value, file_path) for epoch, value in keys])
+
+    def commit(self, file_path: str, offset: int, stat: os.stat_result, last_epoch: Optional[int] = None) -> None:
+        """
+        Moves the checkpoint of a file to offset, after every reading before it was stored,
+        and drops the recorded keys of the file.
+
+        :param stat: os.stat of the file taken before it was read. A later stat could include
+                     lines appended while posting, and the file would then look unchanged.
+        """
+        file_path = os.path.abspath(file_path)
+        with self._lock, self._connection:
+            if last_epoch is None:
+                row = self._connection.execute(
+                    "SELECT last_epoch FROM file_checkpoints WHERE path = ?", (file_path,)).fetchone()
+                last_epoch = row[0] if row else None
+            self._connection.execute(
+                "INSERT OR REPLACE INTO file_checkpoints (path, inode, mtime_ns, size, offset, last_epoch, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (file_path, stat.st_ino, stat.st_mtime_ns, stat.st_size, offset, last_epoch, time.time()))
+            self._connection.execute("DELETE FROM posted_readings WHERE path = ?", (file_path,))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+# Example usage:
+if __name__ == "__main__":
+    store = CheckpointStore()
+    for path, offset, last_epoch in store._connection.execute("SELECT path, offset, last_epoch FROM file_checkpoints"):
+        print(f"{path}: offset {offset}, last reading {time.ctime(last_epoch) if last_epoch else '-'}")
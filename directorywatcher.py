@@ -0,0 +1,124 @@
+import os
+import threading
+import requests
+from patients import Patients
+from heartratefilebundlegenerator import HeartRateFileBundleGenerator
+from bundledispatcher import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_WORKERS
+from fhirserverclient import FhirClient, get_default_client
+from checkpointstore import CheckpointStore
+from seriesstore import SeriesStore
+
+# Seconds between scans of the watched directory.
+DEFAULT_SCAN_INTERVAL = 5.0
+READINGS_SUFFIX = ".txt"
+
+class DirectoryWatcher:
+    def __init__(self, directory: str, patients: Patients, client: FhirClient = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, max_workers: int = DEFAULT_MAX_WORKERS,
+                 interval: float = DEFAULT_SCAN_INTERVAL, checkpoints: CheckpointStore = None,
+                 store: SeriesStore = None):
+        """
+        Daemon that watches a directory for heart rate files named after a patient identifier
+        (<identifier>.txt, with or without the dashes) and posts the readings appended to them.
+
+        The directory is scanned every interval seconds. Files whose inode, size and mtime
+        match their checkpoint are skipped; for the others only the lines after the checkpoint
+        are read, and a line still being written is left for the next scan. The checkpoint only
+        moves once all readings of the new lines are stored, and readings stored by a failed or
+        interrupted post are remembered, so a retry on the next scan, or after a restart, sends
+        only the rest. A replaced or truncated file is posted again from the start. Nothing is
+        posted while the server is unreachable.
+
+        :param directory: The directory to watch.
+        :param patients: The Patients registry the files belong to.
+        :param client: The FhirClient to post with, defaults to the shared client.
+        :param chunk_size: The maximum number of observations per bundle.
+        :param max_workers: The number of bundles posted concurrently for one file.
+        :param interval: Seconds between scans.
+        :param checkpoints: The CheckpointStore to continue from, defaults to the one in checkpoints.db.
+        :param store: Also keep the new readings of every file in this SeriesStore.
+        """
+        self.directory = directory
+        self.patients = patients
+        self.client = client or get_default_client()
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.interval = interval
+        self.checkpoints = checkpoints or CheckpointStore()
+        self.store = store
+        self.posted = 0
+        self._stop = threading.Event()
+        # File names have the dashes of the identifiers removed.
+        self._identifiers = {identifier.replace("-", ""): identifier for identifier in patients.identifiers}
+
+    def identifier_for(self, file_name: str) -> str:
+        """The patient identifier a file name belongs to, or None."""
+        if not file_name.endswith(READINGS_SUFFIX):
+            return None
+        stem = file_name[:-len(READINGS_SUFFIX)]
+        return self._identifiers.get(stem.replace("-", ""))
+
+    def scan_once(self) -> int:
+        """
+        Posts the new readings of every watched file once.
+
+        :return: The number of readings stored.
+        """
+        changed = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                identifier = self.identifier_for(entry.name)
+                if identifier is None or not entry.is_file():
+                    continue
+                try:
+                    if not self.checkpoints.is_unchanged(entry.path):
+                        changed.append((entry.path, identifier))
+                except OSError:
+                    # Removed since the directory was listed.
+                    continue
+        if not changed:
+            return 0
+        if not self.client.is_available():
+            print(f"FHIR server unreachable, {len(changed)} changed files left for the next scan.")
+            return 0
+
+        stored = 0
+        for path, identifier in sorted(changed):
+            # One file that cannot be read or posted must not stop the others.
+            try:
+                generator = HeartRateFileBundleGenerator(identifier, self.patients, self.chunk_size, self.max_workers,
+                                                         file_name=path, follow=True, checkpoints=self.checkpoints,
+                                                         store=self.store)
+                # Moves the checkpoint of the file once everything new is stored.
+                generator.post_bundle(self.client)
+            except requests.RequestException as e:
+                print(f"Failed to post '{path}': {e}, retried on the next scan.")
+                continue
+            except (ValueError, OSError) as e:
+                print(f"Skipped '{path}': {e}, retried on the next scan.")
+                continue
+            if generator.observation_count:
+                stored += generator.observation_count - generator.get_bundle().failed_count
+        self.posted += stored
+        return stored
+
+    def run(self) -> None:
+        """Scans until stop() is called or the process is interrupted."""
+        print(f"Watching '{self.directory}' every {self.interval}s for new readings.")
+        try:
+            while not self._stop.is_set():
+                stored = self.scan_once()
+                if stored:
+                    print(f"Stored {stored} readings ({self.posted} since start).")
+                self._stop.wait(self.interval)
+        except KeyboardInterrupt:
+            print("Stopped.")
+        finally:
+            self.checkpoints.close()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+# Example usage:
+if __name__ == "__main__":
+    DirectoryWatcher(".", Patients()).run()
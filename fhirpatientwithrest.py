@@ -1,29 +1,19 @@
-import requests
 from fhir.resources.patient import Patient
 from printresource import print_fhir_resource
+from fhirserverclient import FhirClient, get_default_client
 
-def get_patient_from_server(patient_id: str) -> Patient:
+def get_patient_from_server(patient_id: str, client: FhirClient = None) -> Patient:
     """
     Fetches a Patient resource from the FHIR server
     using a REST GET request and returns a Patient object.
+
+    :param client: The FhirClient to use, defaults to the shared client. Its base URL,
+                   credentials and FHIR headers are applied to the request.
     """
-    # Replace with your actual FHIR base URL:
-    # This example uses the endpoint in your question plus {patient_id}.
-    url = f"http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4/Patient/{patient_id}"
-
-    # Required headers from your example:
-    # Note: Typically "Authorization: Basic ..." is a base64-encoded
-    # username:password. Here we are using the literal header string
-    # you provided. Adjust if needed.
-    headers = {
-        "Accept": "*/*",
-        "Content-Type": "application/fhir+json",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Prefer": "return=representation"
-    }
+    client = client or get_default_client()
 
     # Make the GET request
-    response = requests.get(url, headers=headers, auth=("_System", "ISCDEMO"))
+    response = client.get(f"Patient/{patient_id}")
     # Raise an exception if the response isn't a 2xx success
     response.raise_for_status()
 
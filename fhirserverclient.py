@@ -0,0 +1,190 @@
+import hashlib
+import os
+import threading
+import zlib
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+DEFAULT_BASE_URL = "http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4/"
+DEFAULT_USERNAME = "_System"
+DEFAULT_PASSWORD = "ISCDEMO"
+# Connections kept open per host; should be at least the number of threads posting at once.
+DEFAULT_POOL_SIZE = 10
+# (connect, read) timeouts in seconds.
+DEFAULT_TIMEOUT = (5, 120)
+
+# Prefer header values for bundle posts. With return=minimal the server answers each entry
+# with its status and location only, instead of echoing every resource back.
+PREFER_MINIMAL = "return=minimal"
+PREFER_REPRESENTATION = "return=representation"
+
+# Request body compression. Observation JSON is very repetitive and compresses about 20x.
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_DEFLATE = "deflate"
+DEFAULT_COMPRESSION_LEVEL = 6
+# zlib wbits for each Content-Encoding: gzip framing, and the zlib framing HTTP calls deflate.
+_WBITS = {COMPRESSION_GZIP: 31, COMPRESSION_DEFLATE: 15}
+
+DEFAULT_HEADERS = {
+    "Accept": "*/*",
+    "Content-Type": "application/fhir+json",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Prefer": "return=representation"
+}
+
+class FhirClient:
+    def __init__(self, base_url: str = DEFAULT_BASE_URL, username: str = DEFAULT_USERNAME,
+                 password: str = DEFAULT_PASSWORD, pool_size: int = DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 bundle_prefer: str = PREFER_MINIMAL, compression: str = None,
+                 compression_level: int = DEFAULT_COMPRESSION_LEVEL):
+        """
+        HTTP client for the FHIR server. All requests go through one keep-alive
+        requests.Session, so repeated posts reuse pooled TCP connections.
+
+        :param base_url: The FHIR base URL, e.g. "http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4/".
+        :param username: User for HTTP basic authentication.
+        :param password: Password for HTTP basic authentication.
+        :param pool_size: The maximum number of connections kept open to the server.
+        :param timeout: Request timeout in seconds, a number or a (connect, read) tuple.
+        :param bundle_prefer: Prefer header sent with post_bundle, PREFER_MINIMAL or PREFER_REPRESENTATION.
+        :param compression: Content-Encoding of POST bodies, COMPRESSION_GZIP, COMPRESSION_DEFLATE or
+                            None. If the server answers 415 the client stops compressing and resends.
+        :param compression_level: zlib level from 1 (fastest) to 9 (smallest).
+        """
+        if compression is not None and compression not in _WBITS:
+            raise ValueError(f"compression must be one of {tuple(_WBITS)} or None")
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.timeout = timeout
+        self.bundle_prefer = bundle_prefer
+        self.compression = compression
+        self.compression_level = compression_level
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.auth = HTTPBasicAuth(username, password)
+        self.session.headers.update(DEFAULT_HEADERS)
+
+    def url(self, path: str = "") -> str:
+        """Returns the absolute URL of a path relative to the FHIR base URL."""
+        return self.base_url + path.lstrip("/")
+
+    def post(self, path: str = "", data=None, headers: dict = None, stream: bool = False) -> requests.Response:
+        """
+        POSTs data to a path relative to the base URL, e.g. "" for bundles or "Patient".
+        With compression set, the body is compressed while it is sent.
+
+        :param data: str, bytes or an iterable of bytes (sent as a chunked body), or a function
+                     returning one of those. A function lets the body be produced again, so a
+                     compressed post the server rejects with 415 is resent uncompressed.
+        :param headers: Headers to add to or override the FHIR defaults.
+        :param stream: Leave the response body unread, to be consumed with iter_content().
+        """
+        body_factory = data if callable(data) else None
+        body = body_factory() if body_factory else data
+        compression = self.compression
+        if compression is None or body is None:
+            return self.session.post(self.url(path), data=body, headers=headers, timeout=self.timeout, stream=stream)
+
+        compressed_headers = dict(headers or {}, **{"Content-Encoding": compression})
+        response = self.session.post(self.url(path), data=compress_body(body, compression, self.compression_level),
+                                     headers=compressed_headers, timeout=self.timeout, stream=stream)
+        if response.status_code != 415:
+            return response
+        print(f"Server rejected {compression} request bodies (415), sending uncompressed from now on")
+        self.compression = None
+        if body_factory is None and not isinstance(body, (str, bytes)):
+            # The iterable body was consumed by the rejected attempt.
+            return response
+        response.close()
+        body = body_factory() if body_factory else body
+        return self.session.post(self.url(path), data=body, headers=headers, timeout=self.timeout, stream=stream)
+
+    def post_bundle(self, data) -> requests.Response:
+        """
+        POSTs a batch or transaction Bundle to the base URL with the bundle_prefer Prefer header.
+        The response body is streamed, so it can be parsed while it arrives.
+
+        :param data: The Bundle JSON, or a function returning it (see post).
+        """
+        return self.post(data=data, headers={"Prefer": self.bundle_prefer}, stream=True)
+
+    def get(self, path: str, params: dict = None, headers: dict = None) -> requests.Response:
+        """GETs a path relative to the base URL, e.g. "Patient/2"."""
+        return self.session.get(self.url(path), params=params, headers=headers, timeout=self.timeout)
+
+    def is_available(self, timeout: float = 2.0) -> bool:
+        """True if the FHIR server answers GET metadata."""
+        try:
+            return self.session.get(self.url("metadata"), timeout=timeout).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def compress_body(data, encoding: str = COMPRESSION_GZIP, level: int = DEFAULT_COMPRESSION_LEVEL):
+    """
+    Compresses a request body for a Content-Encoding.
+
+    :param data: str, bytes or an iterable of bytes chunks.
+    :return: bytes for str/bytes input, otherwise a generator compressing the chunks as they are read.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _WBITS[encoding])
+    if isinstance(data, str):
+        data = data.encode()
+    if isinstance(data, (bytes, bytearray)):
+        return compressor.compress(data) + compressor.flush()
+    return _compress_chunks(compressor, data)
+
+def _compress_chunks(compressor, chunks):
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def get_default_client() -> FhirClient:
+    """Returns the process-wide FhirClient, creating it with the default settings on first use."""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = FhirClient()
+        return _default_client
+
+def set_default_client(client: FhirClient) -> None:
+    """Replaces the process-wide FhirClient, e.g. to point the gateway at another server."""
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
+
+def server_store_path(path: str, base_url: str = DEFAULT_BASE_URL) -> str:
+    """
+    The path of a local store (patient ids, checkpoints, outbox) for a FHIR server. FHIR ids
+    and posted readings only hold for the server they came from, so every server other than
+    the default one gets its own file, e.g. patient_ids-1a2b3c4d5e6f.db.
+
+    :param path: The store's default path, used for DEFAULT_BASE_URL.
+    :param base_url: The FHIR base URL the store is for.
+    """
+    base_url = base_url.rstrip("/")
+    if base_url == DEFAULT_BASE_URL.rstrip("/"):
+        return path
+    stem, extension = os.path.splitext(path)
+    return f"{stem}-{hashlib.sha1(base_url.encode()).hexdigest()[:12]}{extension}"
+
+# Example usage:
+if __name__ == "__main__":
+    client = get_default_client()
+    response = client.get("metadata")
+    print(f"GET {client.url('metadata')} -> {response.status_code}")
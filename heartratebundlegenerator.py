@@ -1,54 +1,138 @@
 import random
+import uuid
+from itertools import chain
 from fhir.resources.patient import Patient
 from patients import Patients
-from observation import HeartRateObservation
 from batchbundle import BatchBundle   # Refactored to accept a list of Observations
-from transactionbundle import TransactionBundle  # Existing TransactionBundle class
+from transactionbundle import TransactionBundle, refer_to  # Existing TransactionBundle class
+from fhirserverclient import FhirClient
+from bundledispatcher import BundleDispatcher, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_WORKERS
+from syntheticheartrate import SyntheticHeartRateGenerator
+from timestamps import TimestampService, OffsetTable
+from seriesstore import PatientSeries, SeriesStore
+from metrics import metrics
+from printresource import print_bundle_preview, DEFAULT_PREVIEW_ENTRIES
+from sampleddata import SampledHeartRateBuilder, MODE_RAW, MODE_SAMPLED, DEFAULT_WINDOW_SECONDS
 
 class HeartRateBundleGenerator:
-    def __init__(self, patient_identifier: str, observation_count: int, low_hr: int, high_hr: int, patients: list[Patient]):
+    def __init__(self, patient_identifier: str, observation_count: int, low_hr: int, high_hr: int, patients: list[Patient],
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, max_workers: int = DEFAULT_MAX_WORKERS,
+                 shape: str = None, seed: int = None, tachycardia_per_day: float = 0.0,
+                 mode: str = MODE_RAW, window_seconds: int = DEFAULT_WINDOW_SECONDS, summaries: bool = False,
+                 store: SeriesStore = None):
         """
         Initialize the generator.
         
         :param patient_identifier: The identifier of the patient.
-        :param observation_count: The number of heart rate observations to generate (max 1000).
+        :param observation_count: The number of heart rate observations to generate.
         :param low_hr: Lower bound for heart rate values.
         :param high_hr: Upper bound for heart rate values.
         :param patients: list of all patients for which bundles can be posted
+        :param chunk_size: The maximum number of observations per bundle. Larger counts are split
+                           into several bundles by a BundleDispatcher.
+        :param max_workers: The number of bundles posted concurrently when the observations are split.
+        :param shape: Generate the readings in one shot with NumPy in this shape ("uniform",
+                      "circadian" or "random_walk", see syntheticheartrate). None keeps the
+                      per-reading random.randint loop.
+        :param seed: Seed for the NumPy generator, for reproducible load tests.
+        :param tachycardia_per_day: Expected tachycardia episodes per day in NumPy mode.
+        :param mode: MODE_RAW posts one Observation per reading, MODE_SAMPLED packs the readings
+                     of each window into one Observation with valueSampledData (see sampleddata).
+        :param window_seconds: The time window of one sampled Observation.
+        :param summaries: In sampled mode, also post a min/max/mean Observation per window.
+        :param store: Also keep the readings in this SeriesStore, for queries after posting.
         """
 
-        if observation_count > 1000:
-            raise ValueError("observation_count must be 1000 or less")
         self.patient_identifier = patient_identifier
         self.patients = patients
         self.observation_count = observation_count
         self.low_hr = low_hr
         self.high_hr = high_hr
+        self.sampler = SampledHeartRateBuilder(window_seconds, summaries=summaries) if mode == MODE_SAMPLED else None
         
          # Retrieve the Patient resource and FHIR id.
         patient_resource = self.patients.get_patient(patient_identifier)
         if patient_resource is None:
             raise ValueError(f"Patient with identifier '{patient_identifier}' not found. Terminating program.")
         
-        # Generate the specified number of HeartRateObservation objects.
-        self.observations = []
-        for _ in range(observation_count):
-            hr_value = random.randint(low_hr, high_hr)
-            minutes_ago = random.randint(0, 1440)
-            obs = HeartRateObservation(patient_identifier, hr_value, minutes_ago)
-            self.observations.append(obs)
+        # One "now" for the whole bundle, every reading is placed relative to the same instant.
+        self.timestamps = TimestampService("America/New_York")
 
-        patient_fhir_id = self.patients.get_patient_id(patient_identifier)
-        
+        # Generate the specified number of readings. They are kept as a compact, time ordered
+        # PatientSeries; raw Observations are only built from it when a bundle is serialized.
+        with metrics.span("generate"):
+            if shape is not None:
+                hr_values, epochs = self.generate_batch(observation_count, shape, seed, tachycardia_per_day)
+            else:
+                hr_values = []
+                epochs = []
+                for _ in range(observation_count):
+                    hr_values.append(random.randint(low_hr, high_hr))
+                    epochs.append(self.timestamps.now_epoch - random.randint(0, 1440) * 60)
+            utc_offsets = OffsetTable(self.timestamps.tz, min(epochs), max(epochs)).offsets_for(epochs) if len(epochs) else []
+            self.series = PatientSeries(patient_identifier, hr_values, epochs, utc_offsets)
+            if store is not None:
+                store.add(patient_identifier, self.series.rates, self.series.epochs, self.series.utc_offsets)
+            self.sampled_observations = None
+            if self.sampler is not None:
+                self.sampled_observations = self.sampler.build(patient_identifier, self.series.rates, self.series.epochs,
+                                                               self.series.utc_offsets)
+                # What is posted: one Observation per window, as in HeartRateFileBundleGenerator.
+                self.observation_count = len(self.sampled_observations)
+
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        # Built on first use, so print_preview does not wrap every Observation in an entry.
+        self._bundle = None
+        # The Patient's fullUrl if it is created in a transaction, shown by print_preview as well.
+        self.patient_full_url = f"urn:uuid:{uuid.uuid4()}"
+
+    @property
+    def observations(self):
+        """
+        The Observations to post. Raw Observations are built from the series, lazily, on every
+        access; sampled ones are a list.
+        """
+        if self.sampled_observations is not None:
+            return self.sampled_observations
+        return self.series.iter_observations(self.patient_identifier)
+
+    @property
+    def bundle(self):
+        """The BatchBundle, TransactionBundle or BundleDispatcher posting the observations."""
+        if self._bundle is None:
+            self._bundle = self._build_bundle()
+        return self._bundle
+
+    def _build_bundle(self):
+        patient_fhir_id = self.patients.get_patient_id(self.patient_identifier)
+        # Sampled mode has one Observation per window, chunk on what is actually posted.
+        if self.observation_count > self.chunk_size:
+            # Too many observations for one bundle, post them in chunks.
+            return BundleDispatcher(self.patient_identifier, self.observations, self.patients, self.chunk_size,
+                                    self.max_workers, observation_count=self.observation_count,
+                                    patient_full_url=self.patient_full_url)
         if patient_fhir_id:
             # If a FHIR id exists, create a BatchBundle with only the observations.
-            self.bundle = BatchBundle(patient_fhir_id, self.observations)
-        else:
-            # If no FHIR id exists, create a TransactionBundle including the Patient resource.
-            self.bundle = TransactionBundle(patient_resource, self.observations)
+            return BatchBundle(patient_fhir_id, list(self.observations))
+        # If no FHIR id exists, create a TransactionBundle including the Patient resource.
+        return TransactionBundle(self.patients.get_patient(self.patient_identifier), list(self.observations),
+                                 patient_full_url=self.patient_full_url)
     
-    def post_bundle(self):
-        patientId = self.bundle.post_bundle()
+    def generate_batch(self, observation_count: int, shape: str, seed: int, tachycardia_per_day: float) -> tuple:
+        """
+        Generates all rates and times as NumPy arrays in one call, against the bundle's "now".
+
+        :return: (rates, epoch seconds) as NumPy arrays.
+        """
+        synthetic = SyntheticHeartRateGenerator(seed, self.low_hr, self.high_hr, shape, tachycardia_per_day)
+        now_epoch = self.timestamps.now_epoch
+        # Readings within the last 24 hours, like minutes_ago in 0..1440.
+        return synthetic.generate(observation_count, now_epoch - 1440 * 60, 1440 * 60 + 1)
+
+    def post_bundle(self, client: FhirClient = None):
+        with metrics.profiled("post_bundle"):
+            patientId = self.bundle.post_bundle(client)
         if patientId != '':
             self.patients.store_patient_id(self.patient_identifier, patientId)
     
@@ -58,21 +142,38 @@ class HeartRateBundleGenerator:
         """
         return self.bundle
     
+    def enqueue(self, outbox) -> int:
+        """
+        Queues the observations in an Outbox instead of posting them, for when the FHIR server
+        is unreachable. An OutboxDrainer posts them later.
+
+        :return: The number of observations queued.
+        """
+        return outbox.append(self.patient_identifier, self.observations)
+
     def print_ids(self):
         self.bundle.print_ids()
     
+    def print_preview(self, count: int = DEFAULT_PREVIEW_ENTRIES, **limits):
+        """
+        Prints the first count entries that would be posted, the Patient first if it has no FHIR
+        id yet, without building the bundle.
+
+        :param limits: max_depth, max_fields and max_value_length, see printresource.format_fhir_resource.
+        """
+        patient_fhir_id = self.patients.get_patient_id(self.patient_identifier)
+        entries = [] if patient_fhir_id else [("Patient", self.patients.get_patient(self.patient_identifier))]
+        if self.sampled_observations is not None:
+            observations = self.sampled_observations[:count]
+        else:
+            observations = self.series.head(count).iter_observations(patient_fhir_id or self.patient_identifier)
+        if not patient_fhir_id:
+            observations = refer_to(observations, self.patient_full_url)
+        print_bundle_preview(chain(entries, (("Observation", observation) for observation in observations)),
+                             count, total=len(entries) + self.observation_count, **limits)
+
     def print_two(self):
-        bundle = self.get_bundle()
-        total_entries = len(bundle.bundle.entry)  # Define total_entries here
-        print(f"Total entries in bundle: {total_entries}")
-        # To inspect the first two entries, for example:
-        # Print the first two entries:
-        print("First entry (Patient):")
-        print(bundle.bundle.entry[0].json(indent=2))
-    
-        if total_entries > 1:
-          print("Second entry (First Observation):")
-          print(bundle.bundle.entry[1].json(indent=2))
+        self.print_preview(2)
 
 # Example usage:
 if __name__ == "__main__":
@@ -1,9 +1,17 @@
 import random
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
+from datetime import datetime
+from heartrateseries import write_series, identifier_from_file_stem
+from syntheticheartrate import SyntheticHeartRateGenerator
+from timestamps import TimestampService, get_zone
 
 class HeartRateDataGenerator:
-    def __init__(self):
+    def __init__(self, seed: int = None):
+        """
+        :param seed: Seed for the choice of day and time zone and for NumPy batch generation,
+                     so repeated runs write the same files.
+        """
+        self.seed = seed
+        self.random = random.Random(seed)
         # The five filenames to generate.
         self.filenames = [
             "3564449972.txt",
@@ -15,35 +23,82 @@ class HeartRateDataGenerator:
         # We'll choose between Eastern and Central time zones.
         self.timezones = ["America/New_York", "America/Chicago"]
 
-    def generate_files(self):
+    def generate_files(self, binary: bool = False, count: int = 100, shape: str = None, tachycardia_per_day: float = 0.0):
+        """
+        Writes random readings for each patient.
+
+        :param binary: Write compact binary series (.hrs, see heartrateseries) instead of
+                       one "(heart_rate, 'iso-timestamp')" tuple per line.
+        :param count: The number of readings per patient.
+        :param shape: Generate the readings with NumPy in this shape ("uniform", "circadian"
+                      or "random_walk", see syntheticheartrate), which is fast enough for
+                      millions of readings. None keeps the per-reading random.randint loop.
+        :param tachycardia_per_day: Expected tachycardia episodes per day in NumPy mode.
+        """
+        synthetic = None
+        if shape is not None:
+            synthetic = SyntheticHeartRateGenerator(self.seed, 60, 160, shape, tachycardia_per_day)
+
         for filename in self.filenames:
             # Choose a random day in March 2025.
-            day = random.randint(1, 31)
+            day = self.random.randint(1, 31)
             base_date = datetime(2025, 3, day)
             
             # Randomly choose a timezone from our list.
-            tz = ZoneInfo(random.choice(self.timezones))
+            tz_name = self.random.choice(self.timezones)
+            timestamps = TimestampService(tz_name)
+            base_epoch = int(base_date.replace(tzinfo=timestamps.tz).timestamp())
+
+            if synthetic is not None:
+                self.write_batch(synthetic, filename, base_date, tz_name, count, binary)
+                continue
+
+            if binary:
+                self.write_binary_file(filename, base_date, tz_name, count)
+                continue
             
-            tuples_list = []
-            for _ in range(100):
+            heart_rates = []
+            epochs = []
+            for _ in range(count):
                 # Generate a random heart rate between 60 and 160.
-                heart_rate = random.randint(60, 160)
-                # Random seconds offset within the day (0 to 86399 seconds).
-                seconds_offset = random.randint(0, 86399)
-                # Create the datetime for this measurement.
-                dt = base_date + timedelta(seconds=seconds_offset)
-                # Make the datetime timezone-aware.
-                dt = dt.replace(tzinfo=tz)
-                # Convert the datetime to an ISO 8601 string.
-                dt_str = dt.isoformat()
-                tuples_list.append((heart_rate, dt_str))
-            
-            # Write the 100 tuples to the file (one per line).
+                heart_rates.append(self.random.randint(60, 160))
+                # Random seconds offset within the day (0 to 86399 seconds) from local midnight.
+                epochs.append(base_epoch + self.random.randint(0, 86399))
+            # Convert all measurement times to ISO 8601 strings at once.
+            dt_strs = timestamps.format_epochs(epochs)
+
+            # Write the tuples to the file (one per line) with a single write.
             with open(filename, "w") as file:
-                for tup in tuples_list:
-                    file.write(f"{tup}\n")
+                file.write("".join(f"{(heart_rate, dt_str)}\n" for heart_rate, dt_str in zip(heart_rates, dt_strs)))
             print(f"Wrote {filename}")
 
+    def write_binary_file(self, filename: str, base_date: datetime, tz_name: str, count: int = 100):
+        # Same readings as the text format, stored as (uint8 rate, int32 epoch offset) records.
+        series_filename = filename.replace(".txt", ".hrs")
+        base_epoch = int(base_date.replace(tzinfo=get_zone(tz_name)).timestamp())
+        rates = [self.random.randint(60, 160) for _ in range(count)]
+        epochs = [base_epoch + self.random.randint(0, 86399) for _ in range(count)]
+        identifier = identifier_from_file_stem(filename.replace(".txt", ""))
+        write_series(series_filename, identifier, tz_name, rates, epochs)
+        print(f"Wrote {series_filename}")
+
+    def write_batch(self, synthetic: SyntheticHeartRateGenerator, filename: str, base_date: datetime, tz_name: str,
+                    count: int, binary: bool):
+        # All readings of the day are generated as arrays in one call and written with a single write.
+        timestamps = TimestampService(tz_name)
+        base_epoch = int(base_date.replace(tzinfo=timestamps.tz).timestamp())
+        rates, epochs = synthetic.generate(count, base_epoch, 86400, tz_name)
+        if binary:
+            series_filename = filename.replace(".txt", ".hrs")
+            identifier = identifier_from_file_stem(filename.replace(".txt", ""))
+            write_series(series_filename, identifier, tz_name, rates, epochs)
+            print(f"Wrote {series_filename}")
+            return
+        lines = [f"({rate}, '{dt_str}')\n" for rate, dt_str in zip(rates.tolist(), timestamps.format_epochs(epochs))]
+        with open(filename, "w") as file:
+            file.write("".join(lines))
+        print(f"Wrote {filename}")
+
 # Example usage:
 if __name__ == "__main__":
     generator = HeartRateDataGenerator()
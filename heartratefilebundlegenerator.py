@@ -1,81 +1,296 @@
-import ast
-from datetime import datetime
+import os
+import uuid
+from array import array
+from itertools import chain
 from fhir.resources.patient import Patient
 from patients import Patients
-from observation import HeartRateObservation
+from heartratereader import HeartRateReader, FORMAT_BINARY
 from batchbundle import BatchBundle
-from transactionbundle import TransactionBundle
+from transactionbundle import TransactionBundle, refer_to
+from fhirserverclient import FhirClient
+from bundledispatcher import BundleDispatcher, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_WORKERS
+from bundlepipeline import ParallelBundlePipeline
+from metrics import metrics
+from printresource import print_bundle_preview, DEFAULT_PREVIEW_ENTRIES
+from checkpointstore import CheckpointStore
+from seriesstore import SeriesStore
+from sampleddata import SampledHeartRateBuilder, MODE_RAW, MODE_SAMPLED, DEFAULT_WINDOW_SECONDS
 
 class HeartRateFileBundleGenerator:
-    def __init__(self, patient_identifier: str, patients: list[Patient]):
+    def __init__(self, patient_identifier: str, patients: list[Patient],
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, max_workers: int = DEFAULT_MAX_WORKERS,
+                 mode: str = MODE_RAW, window_seconds: int = DEFAULT_WINDOW_SECONDS, summaries: bool = False,
+                 file_name: str = None, start_offset: int = 0, follow: bool = False,
+                 checkpoints: CheckpointStore = None, processes: int = 0, store: SeriesStore = None):
         """
         Initialize the generator.
         
         :param patient_identifier: The identifier of the patient in the form '356-444-9972'.
+        :param chunk_size: The maximum number of observations per bundle. Larger files are split
+                           into several bundles by a BundleDispatcher.
+        :param max_workers: The number of bundles posted concurrently when the observations are split.
+        :param mode: MODE_RAW posts one Observation per reading, MODE_SAMPLED packs the readings
+                     of each window into one Observation with valueSampledData (see sampleddata).
+        :param window_seconds: The time window of one sampled Observation.
+        :param summaries: In sampled mode, also post a min/max/mean Observation per window.
+        :param file_name: The readings file, defaults to the one named after the identifier (see read_file).
+        :param start_offset: Byte offset to start reading at, so only readings appended since are posted.
+        :param follow: The file is still being written, see HeartRateReader.
+        :param checkpoints: Continue after the readings already posted from the file, instead of
+                            at start_offset, and checkpoint each chunk as it is stored. Readings
+                            recorded as stored by an interrupted earlier post are left out.
+                            In sampled mode only complete windows are posted: the window of the
+                            latest reading is left for a later run, once a reading of a later
+                            window shows it is complete, so no window is posted twice.
+        :param processes: Build the Observations in this many worker processes (see bundlepipeline),
+                          0 builds them in this process. Raw mode only.
+        :param store: Also keep the readings in this SeriesStore, for queries after posting. The
+                      bundle is still built from the file's own readings, not from the whole series.
         """
         self.patient_identifier = patient_identifier
         self.patients = patients
+        self.checkpoints = checkpoints
+        self.chunk_size = chunk_size
         
         patient_resource = patients.get_patient(patient_identifier)
         if patient_resource is None:
             raise ValueError(f"Patient with identifier '{patient_identifier}' not found. Terminating program.")
         
-        # Read observations from file. File name is the patient_identifier with dashes removed and '.txt' appended.
-        self.observations = []
-        file_name = f"{patient_identifier.replace('-', '')}.txt"
-        observation_count = 0
-        try:
-            with open(file_name, 'r') as file:
-                for line in file:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        # Safely evaluate the tuple. Expected format: (heart_rate, effective_date_str)
-                        tup = ast.literal_eval(line)
-                        heart_rate_value, effective_date_str = tup
-                        # Convert the effective_date_str to a datetime object.
-                        effective_dt = datetime.fromisoformat(effective_date_str)
-                        # Create a HeartRateObservation using the provided effective_dt.
-                        obs = HeartRateObservation(patient_identifier, heart_rate_value, effective_dt=effective_dt)
-                        self.observations.append(obs)
-                        observation_count += 1
-                    except Exception as e:
-                        print(f"Error parsing line: {line}. Error: {e}")
-            print(f"Processed {observation_count} observation entries from file '{file_name}'.")
-        except FileNotFoundError:
-            raise ValueError(f"File '{file_name}' not found.")
+        # Parse the readings into compact arrays; Observations are only built when a bundle needs them.
+        with metrics.span("generate"):
+            self.file_name = file_name or self.file_name_for(patient_identifier)
+            self.positions = None
+            if checkpoints is not None:
+                # Taken before reading, so lines appended meanwhile make the file look changed next time.
+                try:
+                    self.file_stat = os.stat(self.file_name)
+                except FileNotFoundError:
+                    # The same error HeartRateReader raises without checkpoints.
+                    raise ValueError(f"File '{self.file_name}' not found.") from None
+                start_offset = checkpoints.start_offset(self.file_name)
+            self.reader = self.read_file(patient_identifier, self.file_name, start_offset, follow,
+                                         line_offsets=checkpoints is not None and mode == MODE_SAMPLED)
+            # The readings the checkpoint moves past once posted, [first, end) in file order.
+            self._checkpoint_range = (0, len(self.reader))
+            self._checkpoint_offset = None
+            if store is not None:
+                store.add(patient_identifier, self.reader.rates, self.reader.epochs, self.reader.utc_offsets)
+            if checkpoints is not None and mode != MODE_SAMPLED:
+                self.positions = self._new_positions(start_offset)
+                observation_count = len(self.positions)
+                self.sampled_observations = None
+            elif mode == MODE_SAMPLED:
+                # Windows of readings, each window becomes one Observation with the file's UTC offsets.
+                sampler = SampledHeartRateBuilder(window_seconds, summaries=summaries)
+                rates, epochs, utc_offsets = self.reader.rates, self.reader.epochs, self.reader.utc_offsets
+                if checkpoints is not None:
+                    first, end = self._complete_windows(start_offset, window_seconds)
+                    rates, epochs, utc_offsets = rates[first:end], epochs[first:end], utc_offsets[first:end]
+                self.sampled_observations = sampler.build(patient_identifier, rates, epochs, utc_offsets)
+                observation_count = len(self.sampled_observations)
+            else:
+                observation_count = len(self.reader)
+                self.sampled_observations = None
         
+        self.observation_count = observation_count
+        self.max_workers = max_workers
+        self.processes = processes
+        # Built on first use, so previewing the readings (print_preview) does not build every Observation.
+        self._bundle = None
+        # The Patient's fullUrl if it is created in a transaction, shown by print_preview as well.
+        self.patient_full_url = f"urn:uuid:{uuid.uuid4()}"
+
+    @property
+    def bundle(self):
+        """The BatchBundle, TransactionBundle, BundleDispatcher or ParallelBundlePipeline posting the readings."""
+        if self._bundle is None:
+            self._bundle = self._build_bundle()
+        return self._bundle
+
+    def _iter_observations(self, subject_id: str, count: int = None):
+        if self.sampled_observations is not None:
+            return iter(self.sampled_observations[:count])
+        positions = range(len(self.reader)) if self.positions is None else self.positions
+        return self.reader.iter_observations(subject_id, positions[:count])
+
+    def _build_bundle(self):
+        patient_identifier, patients = self.patient_identifier, self.patients
+        chunk_size, max_workers = self.chunk_size, self.max_workers
         # Retrieve the FHIR patient id from the Patients class.
         patient_fhir_id = patients.get_patient_id(patient_identifier)
-        
+        observations = self._iter_observations(patient_identifier)
+
+        if self.processes and self.sampled_observations is None:
+            # Workers get the raw readings and build the Observations themselves.
+            rates, epochs, utc_offsets = self.reader.rates, self.reader.epochs, self.reader.utc_offsets
+            if self.positions is not None:
+                rates = array('H', (rates[i] for i in self.positions))
+                epochs = array('q', (epochs[i] for i in self.positions))
+                utc_offsets = array('h', (utc_offsets[i] for i in self.positions))
+            return ParallelBundlePipeline(patient_identifier, rates, epochs, utc_offsets, patients,
+                                          chunk_size, self.processes, max_workers,
+                                          on_chunk_posted=self._chunk_posted if self.positions is not None else None,
+                                          patient_full_url=self.patient_full_url)
+        if self.positions is not None:
+            # Chunks are checkpointed as they are stored, so the dispatcher is used for any count.
+            return BundleDispatcher(patient_identifier, observations, patients, chunk_size, max_workers,
+                                    on_chunk_posted=self._chunk_posted, observation_count=self.observation_count,
+                                    patient_full_url=self.patient_full_url)
+        if self.observation_count > chunk_size:
+            # Too many observations for one bundle, post them in chunks built on demand.
+            return BundleDispatcher(patient_identifier, observations, patients, chunk_size, max_workers,
+                                    observation_count=self.observation_count, patient_full_url=self.patient_full_url)
         if patient_fhir_id:
             # If a FHIR id exists, create a BatchBundle with only the observations.
-            self.bundle = BatchBundle(patient_fhir_id, self.observations)
-        else:
-            # If no FHIR id exists, create a TransactionBundle including the Patient resource.
-            self.bundle = TransactionBundle(patient_resource, self.observations)
-            
-    def post_bundle(self):
-        patientId = self.bundle.post_bundle()
+            return BatchBundle(patient_fhir_id, list(observations))
+        # If no FHIR id exists, create a TransactionBundle including the Patient resource.
+        return TransactionBundle(patients.get_patient(patient_identifier), list(observations),
+                                 patient_full_url=self.patient_full_url)
+
+    @staticmethod
+    def read_file(patient_identifier: str, file_name: str = None, start_offset: int = 0,
+                  follow: bool = False, line_offsets: bool = False) -> HeartRateReader:
+        """
+        Reads the heart rate readings of a patient into a HeartRateReader.
+        The file name is the patient_identifier with dashes removed and '.hrs' (binary series)
+        or '.txt' appended, see file_name_for.
+
+        :param patient_identifier: The identifier of the patient in the form '356-444-9972'.
+        :param file_name: Read this file instead.
+        :param start_offset: Byte offset to start reading at.
+        :param follow: The file is still being written, see HeartRateReader.
+        :param line_offsets: Keep the byte offset of each reading, see HeartRateReader.
+        :return: The HeartRateReader holding the parsed readings.
+        """
+        if file_name is None:
+            file_name = HeartRateFileBundleGenerator.file_name_for(patient_identifier)
+        reader = HeartRateReader(file_name, start_offset, follow, line_offsets)
+        print(f"Processed {len(reader)} observation entries from file '{file_name}'.")
+        return reader
+
+    @staticmethod
+    def file_name_for(patient_identifier: str) -> str:
+        """
+        The readings file of a patient: the binary series if it is at least as recent as the
+        text file, so readings appended to the text file after converting it are not missed.
+        """
+        stem = patient_identifier.replace('-', '')
+        binary_name, text_name = f"{stem}.hrs", f"{stem}.txt"
+        if not os.path.exists(binary_name):
+            return text_name
+        if os.path.exists(text_name) and os.path.getmtime(binary_name) < os.path.getmtime(text_name):
+            return text_name
+        return binary_name
+
+    def _new_positions(self, start_offset: int) -> list:
+        # Binary series are read whole, their checkpoint offset counts readings instead of bytes.
+        first = start_offset if self.reader.format == FORMAT_BINARY else 0
+        posted = self.checkpoints.posted_keys(self.patient_identifier)
+        positions = list(range(first, len(self.reader)))
+        if posted:
+            epochs, rates = self.reader.epochs, self.reader.rates
+            positions = [i for i in positions if (epochs[i], rates[i]) not in posted]
+            skipped = len(self.reader) - first - len(positions)
+            if skipped:
+                print(f"Skipped {skipped} readings already stored by an earlier, interrupted post.")
+        return positions
+
+    def _complete_windows(self, start_offset: int, window_seconds: int) -> tuple:
+        # The readings of the windows before the latest reading's, which may still grow. The
+        # checkpoint stops at the first reading of that open window, so a later run reads it
+        # again whole. Readings are appended in time order, so the open window is the tail.
+        first = start_offset if self.reader.format == FORMAT_BINARY else 0
+        epochs = self.reader.epochs
+        if first >= len(epochs):
+            self._checkpoint_range = (first, first)
+            return first, first
+        open_window = max(epochs[first:]) // window_seconds * window_seconds
+        end = next(index for index in range(first, len(epochs)) if epochs[index] >= open_window)
+        print(f"{len(epochs) - end} readings of the current window are left until it is complete.")
+        self._checkpoint_range = (first, end)
+        self._checkpoint_offset = end if self.reader.format == FORMAT_BINARY else self.reader.line_offsets[end]
+        return first, end
+
+    def _end_offset(self) -> int:
+        if self._checkpoint_offset is not None:
+            return self._checkpoint_offset
+        return len(self.reader) if self.reader.format == FORMAT_BINARY else self.reader.end_offset
+
+    def _chunk_posted(self, index: int, observation_ids: list) -> None:
+        # Records the readings of a stored chunk, so they are not sent again after a crash.
+        start = index * self.chunk_size
+        epochs, rates = self.reader.epochs, self.reader.rates
+        keys = [(int(epochs[position]), int(rates[position]))
+                for position, observation_id in zip(self.positions[start:start + len(observation_ids)], observation_ids)
+                if observation_id is not None]
+        if keys:
+            self.checkpoints.record_posted(self.file_name, self.patient_identifier, keys)
+
+    def _commit_checkpoint(self) -> None:
+        first, end = self._checkpoint_range
+        epochs = self.reader.epochs[first:end]
+        last_epoch = int(max(epochs)) if len(epochs) else None
+        self.checkpoints.commit(self.file_name, self._end_offset(), self.file_stat, last_epoch)
+
+    @staticmethod
+    def read_observations(patient_identifier: str):
+        """
+        Reads the heart rate readings of a patient and returns a lazy iterator that builds
+        one HeartRateObservation per reading, in file order.
+
+        :param patient_identifier: The identifier of the patient in the form '356-444-9972'.
+        """
+        reader = HeartRateFileBundleGenerator.read_file(patient_identifier)
+        return reader.iter_observations(patient_identifier)
+
+    def post_bundle(self, client: FhirClient = None):
+        if self.checkpoints is not None and self.observation_count == 0:
+            print(f"No new readings in '{self.file_name}'.")
+            self._commit_checkpoint()
+            return
+        with metrics.profiled("post_bundle"):
+            patientId = self.bundle.post_bundle(client)
         if patientId != '':
             self.patients.store_patient_id(self.patient_identifier, patientId)
+        if self.checkpoints is not None:
+            if self.bundle.failed_count == 0:
+                self._commit_checkpoint()
+            else:
+                print(f"Checkpoint of '{self.file_name}' kept, {self.bundle.failed_count} readings are sent again next time.")
         
+    def enqueue(self, outbox) -> int:
+        """
+        Queues the observations in an Outbox instead of posting them, for when the FHIR server
+        is unreachable. An OutboxDrainer posts them later.
+
+        :return: The number of observations queued.
+        """
+        count = outbox.append(self.patient_identifier, self._iter_observations(self.patient_identifier))
+        if self.checkpoints is not None:
+            # The outbox delivers them from here on.
+            self._commit_checkpoint()
+        return count
+
     def print_ids(self):
         self.bundle.print_ids()
             
+    def print_preview(self, count: int = DEFAULT_PREVIEW_ENTRIES, **limits):
+        """
+        Prints the first count entries that would be posted, the Patient first if it has no FHIR
+        id yet. Only those Observations are built, not the bundle, so this is O(count).
+
+        :param limits: max_depth, max_fields and max_value_length, see printresource.format_fhir_resource.
+        """
+        patient_fhir_id = self.patients.get_patient_id(self.patient_identifier)
+        entries = [] if patient_fhir_id else [("Patient", self.patients.get_patient(self.patient_identifier))]
+        observations = self._iter_observations(patient_fhir_id or self.patient_identifier, count)
+        if not patient_fhir_id:
+            observations = refer_to(observations, self.patient_full_url)
+        print_bundle_preview(chain(entries, (("Observation", observation) for observation in observations)),
+                             count, total=len(entries) + self.observation_count, **limits)
+
     def print_two(self):
-        bundle = self.get_bundle()
-        total_entries = len(bundle.bundle.entry)  # Define total_entries here
-        print(f"Total entries in bundle: {total_entries}")
-        # To inspect the first two entries, for example:
-        # Print the first two entries:
-        print("First entry (Patient):")
-        print(bundle.bundle.entry[0].json(indent=2))
-    
-        if total_entries > 1:
-          print("Second entry (First Observation):")
-          print(bundle.bundle.entry[1].json(indent=2))
+        self.print_preview(2)
     
     def get_bundle(self):
         """
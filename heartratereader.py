@@ -0,0 +1,167 @@
+import json
+import mmap
+from array import array
+from datetime import datetime, timedelta, timezone
+from observation import HeartRateObservation
+from heartrateseries import HeartRateSeriesFile, is_series_file, utc_offsets_for
+from timestamps import format_iso
+
+# Supported line formats of heart rate reading files.
+FORMAT_TUPLE = "tuple"    # (155, '2025-03-04T08:57:35-06:00')
+FORMAT_CSV = "csv"        # 155,2025-03-04T08:57:35-06:00
+FORMAT_NDJSON = "ndjson"  # {"hr": 155, "time": "2025-03-04T08:57:35-06:00"}
+FORMAT_BINARY = "binary"  # heartrateseries .hrs file
+
+# Readings whose timestamps are formatted together by iter_observations.
+FORMAT_BLOCK_SIZE = 4096
+
+class HeartRateReader:
+    def __init__(self, file_name: str, start_offset: int = 0, follow: bool = False, line_offsets: bool = False):
+        """
+        Reads a heart rate reading file into compact parallel arrays: rates as unsigned
+        16 bit integers, timestamps as int64 epoch seconds and the UTC offset of each
+        timestamp in minutes. The file is memory mapped and parsed line by line without
+        building any Python objects per reading beyond the parsed numbers.
+
+        The format is detected from the first line: "(hr, 'iso-timestamp')" tuples as written
+        by HeartRateDataGenerator, "hr,iso-timestamp" CSV (an optional header line is skipped)
+        or NDJSON objects with "hr" and "time" members. Binary series files written by
+        heartrateseries are recognized by their magic and decoded without any parsing.
+
+        :param file_name: The file to read.
+        :param start_offset: Byte offset to start reading at, e.g. to skip lines already processed.
+        :param follow: The file is still being appended to. A last line without a newline is
+                       left for the next read, and end_offset stops before it.
+        :param line_offsets: Also keep the byte offset of each reading's line in line_offsets,
+                             e.g. to continue reading at a given reading later. Text files only.
+        """
+        self.file_name = file_name
+        self.rates = array('H')
+        self.epochs = array('q')
+        self.utc_offsets = array('h')
+        self.format = None
+        self.error_count = 0
+        self.end_offset = start_offset
+        self.follow = follow
+        self.line_offsets = array('q') if line_offsets else None
+        if is_series_file(file_name):
+            self._read_series(file_name)
+            return
+        try:
+            with open(file_name, 'rb') as file:
+                self._read(file, start_offset)
+        except FileNotFoundError:
+            raise ValueError(f"File '{file_name}' not found.")
+
+    def _read_series(self, file_name: str) -> None:
+        self.format = FORMAT_BINARY
+        with HeartRateSeriesFile(file_name) as series:
+            self.rates, self.epochs = series.rates_and_epochs()
+            self.utc_offsets = utc_offsets_for(self.epochs, series.tzinfo())
+
+    def _read(self, file, start_offset: int) -> None:
+        file.seek(0, 2)
+        size = file.tell()
+        if size <= start_offset:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            mapped.seek(start_offset)
+            parse = None
+            rates_append = self.rates.append
+            epochs_append = self.epochs.append
+            offsets_append = self.utc_offsets.append
+            line_offsets = self.line_offsets
+            end_offset = None
+            for raw_line in iter(mapped.readline, b""):
+                if self.follow and not raw_line.endswith(b"\n"):
+                    # Still being written, picked up by the next read from end_offset.
+                    end_offset = mapped.tell() - len(raw_line)
+                    break
+                line = raw_line.strip()
+                if not line:
+                    continue
+                if parse is None:
+                    self.format = detect_format(line)
+                    parse = _PARSERS[self.format]
+                    if self.format == FORMAT_CSV and not line[:1].isdigit():
+                        continue  # header line
+                try:
+                    rate, timestamp = parse(line)
+                    effective_dt = datetime.fromisoformat(timestamp)
+                    utc_offset = effective_dt.utcoffset()
+                    if utc_offset is None:
+                        raise ValueError("timestamp has no UTC offset")
+                    rates_append(rate)
+                    epochs_append(int(effective_dt.timestamp()))
+                    offsets_append(int(utc_offset.total_seconds()) // 60)
+                    if line_offsets is not None:
+                        line_offsets.append(mapped.tell() - len(raw_line))
+                except Exception as e:
+                    self.error_count += 1
+                    print(f"Error parsing line: {line.decode(errors='replace')}. Error: {e}")
+            self.end_offset = mapped.tell() if end_offset is None else end_offset
+
+    def __len__(self) -> int:
+        return len(self.rates)
+
+    def __iter__(self):
+        """Yields (heart rate, timezone-aware datetime) pairs in file order."""
+        zones = {}
+        for rate, epoch, utc_offset in zip(self.rates, self.epochs, self.utc_offsets):
+            tz = zones.get(utc_offset)
+            if tz is None:
+                tz = zones[utc_offset] = timezone(timedelta(minutes=utc_offset))
+            yield rate, datetime.fromtimestamp(epoch, tz)
+
+    def iter_observations(self, subject_id: str, positions=None):
+        """
+        Lazily builds one HeartRateObservation per reading, in file order.
+
+        :param subject_id: The FHIR id or identifier used as the Observation subject.
+        :param positions: Indexes of the readings to build, defaults to all of them.
+        """
+        # Timestamps are formatted a block at a time from the epoch and offset arrays,
+        # without building a datetime per reading.
+        if positions is None:
+            for start in range(0, len(self.rates), FORMAT_BLOCK_SIZE):
+                end = start + FORMAT_BLOCK_SIZE
+                effective_dts = format_iso(self.epochs[start:end], self.utc_offsets[start:end])
+                yield from HeartRateObservation.build_many(subject_id, self.rates[start:end], effective_dts)
+            return
+        for start in range(0, len(positions), FORMAT_BLOCK_SIZE):
+            block = positions[start:start + FORMAT_BLOCK_SIZE]
+            effective_dts = format_iso([self.epochs[i] for i in block], [self.utc_offsets[i] for i in block])
+            yield from HeartRateObservation.build_many(subject_id, [self.rates[i] for i in block], effective_dts)
+
+def detect_format(line: bytes) -> str:
+    """Returns the format of a reading file from one of its lines."""
+    if line.startswith(b"("):
+        return FORMAT_TUPLE
+    if line.startswith(b"{"):
+        return FORMAT_NDJSON
+    return FORMAT_CSV
+
+def _parse_tuple(line: bytes):
+    rate, timestamp = line[1:-1].split(b",", 1)
+    return int(rate), timestamp.strip().strip(b"'\"").decode()
+
+def _parse_csv(line: bytes):
+    rate, timestamp = line.split(b",", 1)
+    return int(rate), timestamp.strip().strip(b"'\"").decode()
+
+def _parse_ndjson(line: bytes):
+    reading = json.loads(line)
+    return int(reading["hr"]), reading["time"]
+
+_PARSERS = {
+    FORMAT_TUPLE: _parse_tuple,
+    FORMAT_CSV: _parse_csv,
+    FORMAT_NDJSON: _parse_ndjson,
+}
+
+# Example usage:
+if __name__ == "__main__":
+    reader = HeartRateReader("3564449972.txt")
+    print(f"Read {len(reader)} readings ({reader.format} format), {reader.error_count} errors")
+    for rate, effective_dt in list(reader)[:3]:
+        print(rate, effective_dt.isoformat())
@@ -0,0 +1,190 @@
+import mmap
+import os
+import struct
+from array import array
+from timestamps import OffsetTable, get_zone
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, records are then decoded with struct
+    np = None
+
+# Binary heart rate series (.hrs) layout, all little endian:
+#   header:  magic "HRS1", version (uint8), identifier length (uint8), tz length (uint8), pad,
+#            base epoch seconds (int64), then the identifier and tz name as UTF-8
+#   records: rate (uint8), seconds since the base epoch (int32), 5 bytes each
+MAGIC = b"HRS1"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBxq")
+RECORD = struct.Struct("<Bi")
+if np is not None:
+    RECORD_DTYPE = np.dtype([("rate", "u1"), ("offset", "<i4")])
+
+class HeartRateSeriesFile:
+    def __init__(self, file_name: str):
+        """
+        Opens a binary heart rate series for reading. The file is memory mapped and
+        records is a memoryview over the fixed-width records, so nothing is copied
+        until rates/epochs are requested.
+
+        :param file_name: The .hrs file to open.
+        """
+        self.file_name = file_name
+        with open(file_name, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, id_length, tz_length, self.base_epoch = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"File '{file_name}' is not a version {VERSION} heart rate series")
+        position = HEADER.size
+        self.identifier = self._mmap[position:position + id_length].decode()
+        position += id_length
+        self.tz_name = self._mmap[position:position + tz_length].decode()
+        self.header_size = position + tz_length
+        self.count = (len(self._mmap) - self.header_size) // RECORD.size
+        self.records = memoryview(self._mmap)[self.header_size:self.header_size + self.count * RECORD.size]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def tzinfo(self):
+        """The ZoneInfo of the series, or a fixed offset timezone for "+HH:MM" style names."""
+        return tzinfo_from_name(self.tz_name)
+
+    def as_numpy(self):
+        """
+        Returns the records as a numpy structured array (rate, offset) sharing the file's
+        memory. The array must be released before close().
+        """
+        if np is None:
+            raise ImportError("as_numpy requires numpy")
+        return np.frombuffer(self.records, dtype=RECORD_DTYPE)
+
+    def iter_records(self):
+        """Yields (rate, epoch seconds) pairs without numpy."""
+        base_epoch = self.base_epoch
+        for rate, offset in RECORD.iter_unpack(self.records):
+            yield rate, base_epoch + offset
+
+    def rates_and_epochs(self):
+        """Returns the rates as array('H') and epoch seconds as array('q')."""
+        if np is not None:
+            records = self.as_numpy()
+            rates = array('H', records["rate"].astype(np.uint16).tobytes())
+            epochs = array('q', (records["offset"].astype(np.int64) + self.base_epoch).tobytes())
+            return rates, epochs
+        rates, epochs = array('H'), array('q')
+        for rate, epoch in self.iter_records():
+            rates.append(rate)
+            epochs.append(epoch)
+        return rates, epochs
+
+    def close(self):
+        self.records.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def write_series(file_name: str, identifier: str, tz_name: str, rates, epochs) -> int:
+    """
+    Writes readings as a binary heart rate series.
+
+    :param file_name: The .hrs file to write.
+    :param identifier: The patient identifier, e.g. '356-444-9972'.
+    :param tz_name: An IANA zone such as "America/New_York", or a fixed offset such as "-05:00".
+    :param rates: Heart rates, 0-255.
+    :param epochs: Epoch seconds of each reading, within 68 years of the earliest one.
+    :return: The number of records written.
+    """
+    identifier_bytes = identifier.encode()
+    tz_bytes = tz_name.encode()
+    if np is not None:
+        # Fill the fixed-width records as one structured array.
+        epochs = np.asarray(epochs, dtype=np.int64)
+        base_epoch = int(epochs.min()) if len(epochs) else 0
+        packed = np.empty(len(epochs), dtype=RECORD_DTYPE)
+        packed["rate"] = rates
+        packed["offset"] = epochs - base_epoch
+        records = packed.tobytes()
+    else:
+        epochs = list(epochs)
+        base_epoch = min(epochs) if epochs else 0
+        records = bytearray(RECORD.size * len(epochs))
+        for index, (rate, epoch) in enumerate(zip(rates, epochs)):
+            RECORD.pack_into(records, index * RECORD.size, rate, epoch - base_epoch)
+    with open(file_name, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(identifier_bytes), len(tz_bytes), base_epoch))
+        file.write(identifier_bytes)
+        file.write(tz_bytes)
+        file.write(records)
+    return len(epochs)
+
+def is_series_file(file_name: str) -> bool:
+    """True if the file starts with the binary series magic."""
+    try:
+        with open(file_name, 'rb') as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+def tzinfo_from_name(tz_name: str):
+    return get_zone(tz_name)
+
+def utc_offsets_for(epochs, tz) -> array:
+    """
+    Returns the UTC offset in minutes of each epoch in tz as array('h'), looked up in
+    the zone's transition table rather than per reading.
+    """
+    if len(epochs) == 0:
+        return array('h')
+    offsets = OffsetTable(tz, min(epochs), max(epochs)).offsets_for(epochs)
+    if np is not None:
+        return array('h', offsets.astype(np.int16).tobytes())
+    return array('h', offsets)
+
+def convert_text_file(text_file_name: str, series_file_name: str = None, identifier: str = None, tz_name: str = None) -> str:
+    """
+    Converts a text reading file (any HeartRateReader format) into a binary series.
+
+    :param text_file_name: The file to convert, e.g. '3564449972.txt'.
+    :param series_file_name: The output file, defaults to the text file name with a .hrs extension.
+    :param identifier: The patient identifier, defaults to one derived from the file name.
+    :param tz_name: The IANA zone of the readings. Defaults to the fixed offset of the readings,
+                    which only works if they all share one offset.
+    :return: The name of the written series file.
+    """
+    from heartratereader import HeartRateReader
+
+    stem = os.path.splitext(os.path.basename(text_file_name))[0]
+    series_file_name = series_file_name or os.path.splitext(text_file_name)[0] + ".hrs"
+    identifier = identifier or identifier_from_file_stem(stem)
+    reader = HeartRateReader(text_file_name)
+    if tz_name is None:
+        offsets = set(reader.utc_offsets)
+        if len(offsets) > 1:
+            raise ValueError(f"Readings in '{text_file_name}' use several UTC offsets, pass tz_name")
+        minutes = offsets.pop() if offsets else 0
+        tz_name = f"{'-' if minutes < 0 else '+'}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}"
+    write_series(series_file_name, identifier, tz_name, reader.rates, reader.epochs)
+    return series_file_name
+
+def identifier_from_file_stem(stem: str) -> str:
+    """'3564449972' -> '356-444-9972', the inverse of how reading files are named."""
+    if len(stem) == 10 and stem.isdigit():
+        return f"{stem[:3]}-{stem[3:6]}-{stem[6:]}"
+    return stem
+
+# Example usage:
+if __name__ == "__main__":
+    import sys
+
+    # Convert the given text files (or the sample files) and compare their sizes.
+    file_names = sys.argv[1:] or ["3564449972.txt", "7891011121.txt", "3345567788.txt", "5566678899.txt", "9901122233.txt"]
+    for text_file_name in file_names:
+        series_file_name = convert_text_file(text_file_name)
+        with HeartRateSeriesFile(series_file_name) as series:
+            print(f"{text_file_name} ({os.path.getsize(text_file_name)} bytes) -> {series_file_name} "
+                  f"({os.path.getsize(series_file_name)} bytes, {len(series)} readings, {series.identifier}, {series.tz_name})")
@@ -1,22 +1,79 @@
+import argparse
+import os
+import sys
+import time
 from patients import Patients
-from printresource import print_fhir_resource
+from printresource import print_fhir_resource, DEFAULT_PREVIEW_ENTRIES
 from fhir.resources.patient import Patient
 from heartratefilebundlegenerator import HeartRateFileBundleGenerator
 from heartratebundlegenerator import HeartRateBundleGenerator
+from fhirserverclient import (FhirClient, DEFAULT_BASE_URL, DEFAULT_POOL_SIZE, get_default_client, set_default_client,
+                              server_store_path)
+from bundledispatcher import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_WORKERS
+from outbox import Outbox, OutboxDrainer, DEFAULT_OUTBOX_DIR
+from metrics import metrics
+from sampleddata import MODES, MODE_RAW
+from directorywatcher import DirectoryWatcher, DEFAULT_SCAN_INTERVAL
+from checkpointstore import CheckpointStore, DEFAULT_CHECKPOINT_PATH
+from patientidstore import PatientIdStore, DEFAULT_STORE_PATH
+from seriesstore import SeriesStore, DEFAULT_RETENTION_SECONDS
+
+SOURCE_FILES = "files"
+SOURCE_SYNTHETIC = "synthetic"
+DEFAULT_SYNTHETIC_COUNT = 100
 
 class MainHR:
     def __init__(self):
         # Perform any initialization if needed.
-        self.patients = Patients()
+        # One pooled client for the whole session so repeated posts reuse connections.
+        self.client = get_default_client()
+        # FHIR ids, checkpoints and queued readings are kept per server, see server_store_path.
+        base_url = self.client.base_url
+        self.patients = Patients(PatientIdStore(server_store_path(DEFAULT_STORE_PATH, base_url)))
+        # Readings are queued on disk while the FHIR server is down and posted in the background.
+        self.outbox = Outbox(server_store_path(DEFAULT_OUTBOX_DIR, base_url))
+        # Started by run(), so constructing MainHR leaves no thread polling the outbox.
+        self.drainer = OutboxDrainer(self.outbox, self.patients, self.client)
+        # Generators built by the "Create" options, posted by the matching "Post" option
+        # instead of being built again. Keyed by (source, identifier[, observation count]).
+        self.prepared = {}
+        # Files are posted incrementally, continuing after the readings posted before.
+        self.checkpoints = CheckpointStore(server_store_path(DEFAULT_CHECKPOINT_PATH, base_url))
+        # The readings of the session, a few days per patient, shown with the patient details.
+        self.series = SeriesStore(DEFAULT_RETENTION_SECONDS)
+
+    def post_or_enqueue(self, hrbundle):
+        """Posts the bundle of a generator, or queues its readings in the outbox if the server is down."""
+        if self.drainer.server_available():
+            hrbundle.post_bundle(self.client)
+            hrbundle.print_ids()
+        else:
+            count = hrbundle.enqueue(self.outbox)
+            print(f"FHIR server unreachable, queued {count} observations in the outbox.")
         
+    def print_readings(self, identifier: str, hours: int = 6):
+        """Prints hourly statistics of the last hours of readings of a patient held in memory."""
+        if identifier not in self.series:
+            return
+        series = self.series[identifier]
+        print(f"{len(series)} readings in memory, last {hours} hours with readings:")
+        for window in series.window_stats(3600)[-hours:]:
+            print(f"  {time.strftime('%Y-%m-%d %H:00', time.localtime(window.start_epoch))}: {window.count} readings, "
+                  f"{window.min}-{window.max} bpm, mean {window.mean:.0f}")
+
     def print_preamble(self):
         print("***********************************************************")
         print("Patients in Edge Gateway")
-        for index, (name, identifier) in enumerate(self.patients.get_short_form_patients(), start=1):
+        # Only the first page is listed, large rosters would scroll for minutes.
+        first_page = next(self.patients.get_short_form_patients(), [])
+        for index, (name, identifier) in enumerate(first_page, start=1):
            print(f"{index}. {name} : {identifier}")
+        if len(self.patients) > len(first_page):
+           print(f"... and {len(self.patients) - len(first_page)} more (1-{len(self.patients)})")
         print("***********************************************************")
 
     def run(self):
+        self.drainer.start()
         while True:
             self.print_preamble()
             print("\nMain Menu:")
@@ -38,17 +95,17 @@ class MainHR:
             # Using a switch-like structure (if/elif) to handle the menu choices.
             if option == 1:
                 # Prompt the user to choose a patient from the preamble list.
-                short_patients = self.patients.get_short_form_patients()
                 patient_choice = input("Enter the number of the Gateway patient: ").strip()
                 try:
                     choice_num = int(patient_choice)
-                    if 1 <= choice_num <= len(short_patients):
+                    if 1 <= choice_num <= len(self.patients):
                         # Retrieve the tuple corresponding to the selection.
-                        name, identifier = short_patients[choice_num - 1]
+                        name, identifier = self.patients.get_short_form_patient(choice_num)
                         print(f"Patient Identifier for {name}: {identifier}\n")
                         patient = self.patients.get_patient(identifier)
                         if patient is not None:
                            print_fhir_resource(patient)
+                           self.print_readings(identifier)
                            print("")
                     else:
                         print("Selection out of range.\n")
@@ -56,17 +113,18 @@ class MainHR:
                     print("Invalid input. Please enter a numeric value.\n")
             elif option == 2:
                 print("Option 2: Create Heart Rate Bundle for Patient from File")
-                short_patients = self.patients.get_short_form_patients()
                 patient_choice = input("Enter the number of the Gateway patient: ").strip()
                 try:
                     choice_num = int(patient_choice)
-                    if 1 <= choice_num <= len(short_patients):
+                    if 1 <= choice_num <= len(self.patients):
                         # Retrieve the tuple corresponding to the selection.
-                        name, identifier = short_patients[choice_num - 1]
+                        name, identifier = self.patients.get_short_form_patient(choice_num)
                         print(f"Patient Identifier for {name}: {identifier}\n")
                         patient = self.patients.get_patient(identifier)
                         if patient is not None:
-                           hrbundle = HeartRateFileBundleGenerator(identifier, self.patients)
+                           hrbundle = HeartRateFileBundleGenerator(identifier, self.patients, checkpoints=self.checkpoints,
+                                                                  store=self.series)
+                           self.prepared[(SOURCE_FILES, identifier)] = hrbundle
                            #print out the first two entries
                            hrbundle.print_two()
                            print("")
@@ -76,19 +134,20 @@ class MainHR:
                     print("Invalid input. Please enter a numeric value.\n")
             elif option == 3:
                 print("Option 3: Post Heart Rate Bundle for Patient from File")
-                short_patients = self.patients.get_short_form_patients()
                 patient_choice = input("Enter the number of the Gateway patient: ").strip()
                 try:
                     choice_num = int(patient_choice)
-                    if 1 <= choice_num <= len(short_patients):
+                    if 1 <= choice_num <= len(self.patients):
                         # Retrieve the tuple corresponding to the selection.
-                        name, identifier = short_patients[choice_num - 1]
+                        name, identifier = self.patients.get_short_form_patient(choice_num)
                         print(f"Patient Identifier for {name}: {identifier}\n")
                         patient = self.patients.get_patient(identifier)
                         if patient is not None:
-                           hrbundle = HeartRateFileBundleGenerator(identifier, self.patients)
-                           hrbundle.post_bundle()
-                           hrbundle.print_ids()
+                           # Reuse the bundle created with option 2, if any.
+                           hrbundle = self.prepared.pop((SOURCE_FILES, identifier), None) or \
+                                      HeartRateFileBundleGenerator(identifier, self.patients, checkpoints=self.checkpoints,
+                                                                   store=self.series)
+                           self.post_or_enqueue(hrbundle)
                            print("")
                     else:
                         print("Selection out of range.\n")
@@ -96,23 +155,21 @@ class MainHR:
                     print("Invalid input. Please enter a numeric value.\n")
             elif option == 4:
                 print("Option 4: Create Synthetic Heart Rate Bundle for Patient")
-                short_patients = self.patients.get_short_form_patients()
                 patient_choice = input("Enter the number of the Gateway patient: ").strip()
                 try:
                     choice_num = int(patient_choice)
-                    if 1 <= choice_num <= len(short_patients):
+                    if 1 <= choice_num <= len(self.patients):
                         # Retrieve the tuple corresponding to the selection.
-                        name, identifier = short_patients[choice_num - 1]
+                        name, identifier = self.patients.get_short_form_patient(choice_num)
                         print(f"Patient Identifier for {name}: {identifier}\n")
                         patient = self.patients.get_patient(identifier)
                         if patient is not None:
-                           noOfObservations = input("Enter No of Observations (must be < 1000): ").strip()
+                           noOfObservations = input("Enter No of Observations (more than 1000 are posted in several bundles): ").strip()
                            nobs = int(noOfObservations)
-                           if (nobs > 1000):
-                               nobs = 1000
                            if (nobs < 1):
                                nobs = 1
-                           hrbundle = HeartRateBundleGenerator(identifier, nobs, 60, 160, self.patients)
+                           hrbundle = HeartRateBundleGenerator(identifier, nobs, 60, 160, self.patients, store=self.series)
+                           self.prepared[(SOURCE_SYNTHETIC, identifier, nobs)] = hrbundle
                            #print out the first two entries
                            hrbundle.print_two()
                            print("")
@@ -122,26 +179,24 @@ class MainHR:
                     print("Invalid input. Please enter a numeric value.\n")
             elif option == 5:
                 print("Option 5: Post Synthetic Heart Rate Bundle")
-                short_patients = self.patients.get_short_form_patients()
                 patient_choice = input("Enter the number of the Gateway patient: ").strip()
                 try:
                     choice_num = int(patient_choice)
-                    if 1 <= choice_num <= len(short_patients):
+                    if 1 <= choice_num <= len(self.patients):
                         # Retrieve the tuple corresponding to the selection.
-                        name, identifier = short_patients[choice_num - 1]
+                        name, identifier = self.patients.get_short_form_patient(choice_num)
                         print(f"Patient Identifier for {name}: {identifier}\n")
                         patient = self.patients.get_patient(identifier)
                         if patient is not None:
-                           noOfObservations = input("Enter No of Observations (must be < 1000): ").strip()
+                           noOfObservations = input("Enter No of Observations (more than 1000 are posted in several bundles): ").strip()
                            nobs = int(noOfObservations)
-                           if (nobs > 1000):
-                               nobs = 1000
                            if (nobs < 1):
                                nobs = 1
-                           hrbundle = HeartRateBundleGenerator(identifier, nobs, 60, 160, self.patients)
-                           hrbundle.post_bundle()
-                           #print out ids of the bundle resource that were posted
-                           hrbundle.print_ids()
+                           # Reuse the bundle created with option 4 for the same count, if any.
+                           hrbundle = self.prepared.pop((SOURCE_SYNTHETIC, identifier, nobs), None) or \
+                                      HeartRateBundleGenerator(identifier, nobs, 60, 160, self.patients, store=self.series)
+                           #post and print out ids of the bundle resource that were posted
+                           self.post_or_enqueue(hrbundle)
                            print("")
                     else:
                         print("Selection out of range.\n")
@@ -150,10 +205,165 @@ class MainHR:
                 # pass # Placeholder for actual implementation
             elif option == 6:
                 print("Option 6: Quit - Exiting program.")
+                self.drainer.stop()
+                self.outbox.close()
+                self.checkpoints.close()
+                if metrics.enabled:
+                    # Timings and counters of this session, see metrics (HR_METRICS=1).
+                    metrics.write_prometheus()
+                    metrics.write_json_log()
                 break
             else:
                 print("Invalid selection. Please try again.")
 
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m mainhr",
+                                     description="Edge gateway for heart rate readings. Without a command the interactive menu starts.")
+    parser.add_argument("--base-url", default=DEFAULT_BASE_URL, help="FHIR base URL")
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser("list", help="list the gateway patients")
+    show = commands.add_parser("show", help="print the Patient resource of a patient")
+    show.add_argument("identifier")
+
+    for name, help_text in (("create", "build the bundles and print the first entries"),
+                            ("post", "build and post the bundles")):
+        command = commands.add_parser(name, help=help_text)
+        selection = command.add_mutually_exclusive_group(required=True)
+        selection.add_argument("--patient", action="append", metavar="IDENTIFIER", help="may be repeated")
+        selection.add_argument("--all", action="store_true", help="every patient (with a readings file for --source files)")
+        command.add_argument("--source", choices=(SOURCE_FILES, SOURCE_SYNTHETIC), default=SOURCE_FILES)
+        command.add_argument("--count", type=int, default=DEFAULT_SYNTHETIC_COUNT, help="synthetic readings per patient")
+        command.add_argument("--shape", help="NumPy shape of synthetic readings: uniform, circadian or random_walk")
+        command.add_argument("--seed", type=int)
+        command.add_argument("--mode", choices=MODES, default=MODE_RAW)
+        command.add_argument("--chunk", type=int, default=DEFAULT_CHUNK_SIZE, help="observations per bundle")
+        command.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS, help="bundles posted concurrently")
+        command.add_argument("--no-checkpoint", action="store_true",
+                             help="read whole files instead of continuing after the readings posted before")
+        if name == "create":
+            command.add_argument("--preview", type=int, default=DEFAULT_PREVIEW_ENTRIES, help="entries shown per patient")
+            command.add_argument("--max-depth", type=int, help="nesting depth shown of each entry")
+            command.add_argument("--max-fields", type=int, help="fields shown of each entry")
+        if name == "post":
+            command.add_argument("--processes", type=int, default=0,
+                                 help="build the Observations of --source files in this many worker processes")
+            command.add_argument("--print-ids", action="store_true", help="print every Observation id")
+
+    daemon = commands.add_parser("daemon", help="watch a directory and post readings appended to <identifier>.txt files")
+    daemon.add_argument("--watch", default=".", help="the directory to watch")
+    daemon.add_argument("--interval", type=float, default=DEFAULT_SCAN_INTERVAL, help="seconds between scans")
+    daemon.add_argument("--chunk", type=int, default=DEFAULT_CHUNK_SIZE)
+    daemon.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS)
+    return parser
+
+def select_identifiers(patients: Patients, args) -> list:
+    if not args.all:
+        unknown = [identifier for identifier in args.patient if identifier not in patients]
+        if unknown:
+            raise SystemExit(f"Unknown patient identifiers: {', '.join(unknown)}")
+        return args.patient
+    if args.source == SOURCE_SYNTHETIC:
+        return list(patients.identifiers)
+    return [identifier for identifier in patients.identifiers
+            if any(os.path.exists(identifier.replace("-", "") + suffix) for suffix in (".hrs", ".txt"))]
+
+def create_generator(identifier: str, patients: Patients, args, checkpoints: CheckpointStore = None):
+    if args.source == SOURCE_SYNTHETIC:
+        return HeartRateBundleGenerator(identifier, max(1, args.count), 60, 160, patients, args.chunk, args.workers,
+                                        shape=args.shape, seed=args.seed, mode=args.mode)
+    return HeartRateFileBundleGenerator(identifier, patients, args.chunk, args.workers, mode=args.mode,
+                                        checkpoints=checkpoints, processes=getattr(args, "processes", 0))
+
+def run_command(args) -> int:
+    """Runs one non-interactive command, returns the process exit status."""
+    client = FhirClient(base_url=args.base_url, pool_size=max(DEFAULT_POOL_SIZE, getattr(args, "workers", 0)))
+    set_default_client(client)
+    # FHIR ids and checkpoints only hold for the server they were recorded against.
+    patients = Patients(PatientIdStore(server_store_path(DEFAULT_STORE_PATH, args.base_url)))
+    checkpoint_path = server_store_path(DEFAULT_CHECKPOINT_PATH, args.base_url)
+
+    if args.command == "list":
+        for page in patients.get_short_form_patients():
+            for name, identifier in page:
+                print(f"{identifier} : {name}")
+        return 0
+    if args.command == "show":
+        patient = patients.get_patient(args.identifier)
+        if patient is None:
+            print(f"Patient with identifier '{args.identifier}' not found.")
+            return 1
+        print_fhir_resource(patient)
+        return 0
+    # Readings the interactive menu queued while the server was down are delivered by the
+    # commands that post; the others never touch the outbox.
+    outbox_path = server_store_path(DEFAULT_OUTBOX_DIR, args.base_url)
+    outbox = Outbox(outbox_path) if args.command in ("daemon", "post") and os.path.isdir(outbox_path) else None
+    if args.command == "daemon":
+        drainer = OutboxDrainer(outbox, patients, client).start() if outbox is not None else None
+        try:
+            DirectoryWatcher(args.watch, patients, client, args.chunk, args.workers, args.interval,
+                             checkpoints=CheckpointStore(checkpoint_path),
+                             store=SeriesStore(DEFAULT_RETENTION_SECONDS)).run()
+        finally:
+            if drainer is not None:
+                drainer.stop()
+                outbox.close()
+        return 0
+
+    identifiers = select_identifiers(patients, args)
+    checkpoints = None if args.no_checkpoint or args.source != SOURCE_FILES else CheckpointStore(checkpoint_path)
+    started = time.perf_counter()
+    observations = failed = 0
+    for identifier in identifiers:
+        generator = create_generator(identifier, patients, args, checkpoints)
+        if args.command == "create":
+            generator.print_preview(args.preview, max_depth=args.max_depth, max_fields=args.max_fields)
+            continue
+        generator.post_bundle(client)
+        bundle = generator.get_bundle()
+        # observation_ids is empty after a failed transaction, the generator knows what was to be posted.
+        count = generator.observation_count
+        observations += count
+        failed += bundle.failed_count
+        if args.print_ids:
+            generator.print_ids()
+        else:
+            print(f"{identifier}: {count - bundle.failed_count} of {count} observations stored. {bundle.stats.summary()}")
+    if args.command == "post":
+        elapsed = time.perf_counter() - started
+        print(f"Posted {observations} observations for {len(identifiers)} patients in {elapsed:.2f}s "
+              f"({observations / elapsed if elapsed else 0:.0f} obs/sec), {failed} not stored.")
+    if checkpoints is not None:
+        checkpoints.close()
+    if outbox is not None:
+        drain_outbox(outbox, patients, client)
+    if metrics.enabled:
+        metrics.write_prometheus()
+        metrics.write_json_log()
+    return 1 if failed else 0
+
+def drain_outbox(outbox: Outbox, patients: Patients, client: FhirClient) -> None:
+    """Posts the records queued in the outbox, leaving them queued if the server fails."""
+    drainer = OutboxDrainer(outbox, patients, client)
+    try:
+        while drainer.drain_once():
+            pass
+    except Exception as e:
+        print(f"Queued readings left in the outbox for later. Error: {e!r}")
+    finally:
+        outbox.close()
+    if drainer.posted or drainer.dead_lettered:
+        print(f"Posted {drainer.posted} queued observations, {drainer.dead_lettered} dead-lettered.")
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.command is None:
+        if args.base_url != DEFAULT_BASE_URL:
+            set_default_client(FhirClient(base_url=args.base_url))
+        MainHR().run()
+        return 0
+    return run_command(args)
+
 if __name__ == "__main__":
-    app = MainHR()
-    app.run()
+    sys.exit(main())
@@ -0,0 +1,284 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+DEFAULT_PROMETHEUS_FILE = "metrics.prom"
+DEFAULT_JSON_LOG = "metrics.jsonl"
+DEFAULT_PROFILE_DIR = "profiles"
+PROFILE_CPROFILE = "cprofile"
+PROFILE_TRACEMALLOC = "tracemalloc"
+METRIC_PREFIX = "hr_gateway_"
+# Lines of profile output printed after each profiled call.
+PROFILE_TOP = 15
+
+class _NullSpan:
+    # Shared by every span while metrics are disabled, so a disabled span costs one attribute
+    # check and no allocation.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+class _Profiled:
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        if self.metrics.profile == PROFILE_CPROFILE:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.metrics.profile == PROFILE_TRACEMALLOC:
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.before = tracemalloc.take_snapshot()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        os.makedirs(self.metrics.profile_dir, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        if self.metrics.profile == PROFILE_CPROFILE:
+            self.profiler.disable()
+            path = os.path.join(self.metrics.profile_dir, f"{self.name}-{stamp}.prof")
+            self.profiler.dump_stats(path)
+            output = io.StringIO()
+            pstats.Stats(self.profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP)
+            print(output.getvalue())
+            print(f"cProfile of {self.name} written to {path}")
+        else:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().compare_to(self.before, "lineno")[:PROFILE_TOP]
+            if self.started_tracing:
+                tracemalloc.stop()
+            path = os.path.join(self.metrics.profile_dir, f"{self.name}-{stamp}.txt")
+            with open(path, 'w') as file:
+                file.write(f"peak {peak} bytes, {current} bytes still allocated\n")
+                file.writelines(f"{stat}\n" for stat in top)
+            print(f"tracemalloc of {self.name}: peak {peak / 1024 / 1024:.1f} MB")
+            for stat in top:
+                print(f"  {stat}")
+            print(f"Written to {path}")
+        return False
+
+class Metrics:
+    def __init__(self, enabled: bool = False, profile: str = None, profile_dir: str = DEFAULT_PROFILE_DIR):
+        """
+        Timers and counters for the upload pipeline: generate -> build bundle -> serialize ->
+        HTTP -> parse response.
+
+        While disabled, span() returns a shared no-op context manager and count() returns
+        immediately, so instrumented code pays almost nothing. Timers keep a count, total and
+        maximum per name and counters a running sum. Both can be exported in the Prometheus
+        text format (for the node_exporter textfile collector) or appended to a JSON log.
+
+        profile wraps every profiled() block, e.g. each post_bundle, in cProfile or tracemalloc
+        and writes the result to profile_dir. cProfile only sees the calling thread, so
+        BundleDispatcher workers show up as time spent waiting on their futures.
+
+        :param enabled: Collect timers and counters.
+        :param profile: None, PROFILE_CPROFILE or PROFILE_TRACEMALLOC.
+        :param profile_dir: Where profiles are written.
+        """
+        if profile not in (None, PROFILE_CPROFILE, PROFILE_TRACEMALLOC):
+            raise ValueError(f"Unknown profiler '{profile}'")
+        self.enabled = enabled
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.counters = {}
+        self.timers = {}  # name -> [count, total seconds, max seconds]
+        self._lock = threading.Lock()
+
+    def enable(self, profile: str = None) -> None:
+        if profile not in (None, PROFILE_CPROFILE, PROFILE_TRACEMALLOC):
+            raise ValueError(f"Unknown profiler '{profile}'")
+        self.enabled = True
+        self.profile = profile
+
+    def disable(self) -> None:
+        self.enabled = False
+        self.profile = None
+
+    def span(self, name: str):
+        """Context manager that records the time spent in the block under name."""
+        return _Span(self, name) if self.enabled else _NULL_SPAN
+
+    def profiled(self, name: str):
+        """Context manager that profiles the block when a profiler is configured."""
+        return _Profiled(self, name) if self.profile else _NULL_SPAN
+
+    def observe(self, name: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+
+    def count(self, name: str, value: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters = {}
+            self.timers = {}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "timestamp": datetime.now().astimezone().isoformat(timespec="seconds"),
+                "counters": dict(self.counters),
+                "timers": {name: {"count": count, "seconds": total, "max_seconds": longest}
+                           for name, (count, total, longest) in self.timers.items()}
+            }
+
+    def prometheus_text(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = f"{METRIC_PREFIX}{name}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        if snapshot["timers"]:
+            lines.append(f"# TYPE {METRIC_PREFIX}stage_seconds summary")
+            for name, timer in sorted(snapshot["timers"].items()):
+                lines.append(f'{METRIC_PREFIX}stage_seconds_sum{{stage="{name}"}} {timer["seconds"]:.6f}')
+                lines.append(f'{METRIC_PREFIX}stage_seconds_count{{stage="{name}"}} {timer["count"]}')
+            lines.append(f"# TYPE {METRIC_PREFIX}stage_seconds_max gauge")
+            for name, timer in sorted(snapshot["timers"].items()):
+                lines.append(f'{METRIC_PREFIX}stage_seconds_max{{stage="{name}"}} {timer["max_seconds"]:.6f}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str = DEFAULT_PROMETHEUS_FILE) -> None:
+        """Writes the metrics in the Prometheus text format, replacing the file atomically."""
+        temporary = path + ".tmp"
+        with open(temporary, 'w') as file:
+            file.write(self.prometheus_text())
+        os.replace(temporary, path)
+
+    def write_json_log(self, path: str = DEFAULT_JSON_LOG) -> None:
+        """Appends a snapshot of the metrics as one JSON line."""
+        with open(path, 'a') as file:
+            file.write(json.dumps(self.snapshot()) + "\n")
+
+# The metrics of the process. HR_METRICS=1 enables them, HR_PROFILE=cprofile|tracemalloc
+# profiles every post_bundle.
+metrics = Metrics(enabled=os.environ.get("HR_METRICS", "") not in ("", "0"), profile=os.environ.get("HR_PROFILE") or None)
+
+class PostStats:
+    def __init__(self):
+        """
+        Timings and byte counts of posting one bundle, shown by print_ids. They are always
+        collected, a few clock reads per request, and also fed to metrics when it is enabled.
+
+        The body is streamed while it is encoded, so serialize_seconds is the time spent
+        producing body chunks and http_seconds the rest of the request: sending, the server
+        and the wait for the response headers. parse_seconds covers reading and parsing the
+        response body. bytes_sent counts the body before any Content-Encoding.
+        """
+        self.build_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.http_seconds = 0.0
+        self.parse_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.requests = 0
+
+    def built(self, seconds: float) -> None:
+        self.build_seconds += seconds
+        metrics.observe("build_bundle", seconds)
+
+    def body(self, chunks):
+        """Wraps a request body iterator, timing the encoding and counting the bytes."""
+        serialize_seconds = 0.0
+        bytes_sent = 0
+        iterator = iter(chunks)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    serialize_seconds += time.perf_counter() - start
+                    return
+                serialize_seconds += time.perf_counter() - start
+                bytes_sent += len(chunk)
+                yield chunk
+        finally:
+            # Also reached when the body is abandoned, e.g. by a failed connection.
+            self.serialize_seconds += serialize_seconds
+            self.bytes_sent += bytes_sent
+            metrics.observe("serialize", serialize_seconds)
+            metrics.count("bytes_sent", bytes_sent)
+
+    def response(self, chunks):
+        """Wraps a response body iterator, counting the bytes."""
+        for chunk in chunks:
+            self.bytes_received += len(chunk)
+            metrics.count("bytes_received", len(chunk))
+            yield chunk
+
+    def request(self, seconds: float, serialize_before: float) -> None:
+        """Records a request that took seconds up to its response headers."""
+        http_seconds = max(0.0, seconds - (self.serialize_seconds - serialize_before))
+        self.http_seconds += http_seconds
+        self.requests += 1
+        metrics.observe("http", http_seconds)
+        metrics.count("requests")
+
+    def parsed(self, seconds: float) -> None:
+        self.parse_seconds += seconds
+        metrics.observe("parse_response", seconds)
+
+    def add(self, other: "PostStats") -> None:
+        self.build_seconds += other.build_seconds
+        self.serialize_seconds += other.serialize_seconds
+        self.http_seconds += other.http_seconds
+        self.parse_seconds += other.parse_seconds
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.requests += other.requests
+
+    def summary(self) -> str:
+        return (f"Timings: build {self.build_seconds * 1000:.1f} ms, serialize {self.serialize_seconds * 1000:.1f} ms, "
+                f"HTTP {self.http_seconds * 1000:.1f} ms, parse {self.parse_seconds * 1000:.1f} ms; "
+                f"{self.bytes_sent} bytes sent, {self.bytes_received} received in {self.requests} request{'s' if self.requests != 1 else ''}")
+
+# Example usage:
+if __name__ == "__main__":
+    metrics.enable()
+    for _ in range(3):
+        with metrics.span("example"):
+            time.sleep(0.01)
+    metrics.count("bytes_sent", 1024)
+    print(metrics.prometheus_text())
@@ -0,0 +1,427 @@
+import itertools
+import json
+import random
+import threading
+import time
+import zlib
+from functools import partial
+from urllib.parse import parse_qs
+from urllib.request import urlopen
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler, SimpleHTTPRequestHandler
+
+BASE_PATH = "/csp/healthshare/demo/fhir/r4/"
+
+class MockFhirServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 entry_failure_rate: float = 0.0, entry_failure_status: str = "429 Too Many Requests",
+                 seed: int = None, accept_compression: bool = True):
+        """
+        A local stand-in for the FHIR server, used by the test harnesses and benchmarks.
+        It accepts Bundles (batch/transaction), Patient creates and reads and bulk $import of
+        NDJSON files, answers like the real server, and counts the TCP connections and requests it receives.
+
+        :param host: Interface to listen on.
+        :param port: Port to listen on, 0 picks a free port.
+        :param latency: Seconds to wait before answering each request.
+        :param entry_failure_rate: Fraction of batch entries answered with entry_failure_status
+                                   instead of being created, to exercise per-entry retries.
+        :param entry_failure_status: The status of the failed entries, e.g. "409 Conflict".
+        :param seed: Seed for picking the failed entries.
+        :param accept_compression: Decode gzip and deflate request bodies. When False, compressed
+                                   requests are answered with 415 Unsupported Media Type.
+        """
+        self.accept_compression = accept_compression
+        self.latency = latency
+        self.entry_failure_rate = entry_failure_rate
+        self.entry_failure_status = entry_failure_status
+        self.random = random.Random(seed)
+        self.connections_opened = 0
+        self.requests_handled = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.resources = {}
+        # (resource type, "system|value" or bare value) -> resource, for identifier searches.
+        self._by_identifier = {}
+        self._ids = itertools.count(1)
+        # $import job id -> completion response, None while the job is running.
+        self.imports = {}
+        self._import_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _MockFhirHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}{BASE_PATH}"
+
+    def start(self) -> "MockFhirServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def reset_counters(self):
+        with self._lock:
+            self.connections_opened = 0
+            self.requests_handled = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+
+    def reset_resources(self):
+        """Forgets the stored resources, e.g. between benchmark runs, so memory does not grow with each run."""
+        with self._lock:
+            self.resources = {}
+            self._by_identifier = {}
+
+    def create(self, resource: dict) -> dict:
+        """Assigns a new id to a resource and stores it."""
+        with self._lock:
+            resource["id"] = str(next(self._ids))
+            self.resources[(resource["resourceType"], resource["id"])] = resource
+            for identifier in resource.get("identifier", []):
+                self._by_identifier.setdefault((resource["resourceType"], identifier.get("value")), resource)
+                self._by_identifier.setdefault(
+                    (resource["resourceType"], f"{identifier.get('system')}|{identifier.get('value')}"), resource)
+        return resource
+
+    def search(self, resource_type: str, params: dict) -> list:
+        """
+        Finds stored resources of a type. Only the identifier parameter is supported,
+        with comma separated system|value tokens.
+        """
+        tokens = set()
+        for value in params.get("identifier", []):
+            tokens.update(value.split(","))
+        matches = []
+        with self._lock:
+            for token in tokens:
+                resource = self._by_identifier.get((resource_type, token))
+                if resource is not None and all(resource is not match for match in matches):
+                    matches.append(resource)
+        return matches
+
+    def start_import(self, parameters: dict) -> str:
+        """Starts a bulk $import of the input files of a Parameters resource and returns the job id."""
+        with self._lock:
+            job = str(next(self._import_ids))
+            self.imports[job] = None
+        threading.Thread(target=self._run_import, args=(job, parameters), daemon=True).start()
+        return job
+
+    def _run_import(self, job: str, parameters: dict) -> None:
+        # Inputs are loaded in request order, so Patients listed first can be referenced.
+        output, errors = [], []
+        for parameter in parameters.get("parameter", []):
+            if parameter.get("name") != "input":
+                continue
+            part = {item["name"]: item.get("valueUri", item.get("valueCode")) for item in parameter.get("part", [])}
+            count = 0
+            try:
+                with urlopen(part["url"]) as file:
+                    for line in file:
+                        if line.strip():
+                            self.create(self._resolve_conditional_reference(json.loads(line)))
+                            count += 1
+            except (OSError, ValueError) as e:
+                errors.append({"type": "OperationOutcome", "inputUrl": part.get("url"), "error": str(e)})
+            output.append({"type": part.get("type"), "count": count, "inputUrl": part.get("url")})
+        with self._lock:
+            self.imports[job] = {"transactionTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                                 "request": f"{self.base_url}$import", "output": output, "error": errors}
+
+    def _resolve_conditional_reference(self, resource: dict) -> dict:
+        # "Patient?identifier=system|value" -> "Patient/<id>", like the server does for conditional references.
+        subject = resource.get("subject")
+        if subject and "?" in subject.get("reference", ""):
+            resource_type, _, query = subject["reference"].partition("?")
+            matches = self.search(resource_type, parse_qs(query))
+            if len(matches) == 1:
+                subject["reference"] = f"{resource_type}/{matches[0]['id']}"
+        return resource
+
+    def handle_bundle(self, bundle: dict, minimal: bool = False) -> dict:
+        """
+        Processes each entry of a batch or transaction Bundle and builds the response Bundle.
+
+        :param minimal: Answer as for Prefer return=minimal, with no resources in the response entries.
+        """
+        full_urls = {}
+        response_entries = []
+        entries = bundle.get("entry", [])
+        for entry in entries:
+            request = entry.get("request", {})
+            if bundle.get("type") == "batch" and self.entry_failure_rate and self.random.random() < self.entry_failure_rate:
+                response_entries.append({
+                    "response": {
+                        "status": self.entry_failure_status,
+                        "outcome": {"resourceType": "OperationOutcome",
+                                    "issue": [{"severity": "error", "code": "transient"}]}
+                    }
+                })
+                continue
+            existing = []
+            if request.get("ifNoneExist"):
+                existing = self.search(request["url"], parse_qs(request["ifNoneExist"]))
+            if existing:
+                # Conditional create matched, nothing is created.
+                created, status = existing[0], "200 OK"
+            else:
+                created, status = self.create(dict(entry["resource"])), "201 Created"
+            if entry.get("fullUrl"):
+                full_urls[entry["fullUrl"]] = f"{created['resourceType']}/{created['id']}"
+            response_entries.append({
+                "resource": created,
+                "response": {
+                    "status": status,
+                    "location": f"{created['resourceType']}/{created['id']}/_history/1"
+                }
+            })
+        if bundle.get("type") == "transaction":
+            # Resolve references to urn:uuid fullUrls the way the server does.
+            for entry in response_entries:
+                subject = entry.get("resource", {}).get("subject")
+                if subject and subject.get("reference") in full_urls:
+                    subject["reference"] = full_urls[subject["reference"]]
+        if minimal:
+            for entry in response_entries:
+                entry.pop("resource", None)
+        return {
+            "resourceType": "Bundle",
+            "type": f"{bundle.get('type', 'batch')}-response",
+            "entry": response_entries
+        }
+
+class _MockFhirHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; with Nagle on, the body waits for the
+    # client's delayed ACK and every response gets about 40 ms slower than the real server.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        mock = self.server.mock
+        with mock._lock:
+            mock.connections_opened += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        """Reads the raw request body, as sent on the wire."""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    # Skip trailers up to the terminating blank line.
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def resource_path(self) -> list:
+        path = self.path.split("?")[0]
+        if path.startswith(BASE_PATH):
+            path = path[len(BASE_PATH):]
+        return [part for part in path.split("/") if part]
+
+    def send_json(self, status: int, payload: dict, headers: dict = None):
+        data = json.dumps(payload).encode()
+        mock = self.server.mock
+        with mock._lock:
+            mock.bytes_sent += len(data)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def begin_request(self, body: bytes = b""):
+        mock = self.server.mock
+        with mock._lock:
+            mock.requests_handled += 1
+            mock.bytes_received += len(body)
+        if mock.latency:
+            time.sleep(mock.latency)
+
+    def do_POST(self):
+        mock = self.server.mock
+        body = self.read_body()
+        self.begin_request(body)
+        encoding = self.headers.get("Content-Encoding", "identity").lower()
+        if encoding != "identity":
+            if not mock.accept_compression or encoding not in ("gzip", "deflate"):
+                self.send_json(415, {"resourceType": "OperationOutcome"})
+                return
+            body = zlib.decompress(body, 31 if encoding == "gzip" else 15)
+        try:
+            resource = json.loads(body)
+        except ValueError:
+            self.send_json(400, {"resourceType": "OperationOutcome"})
+            return
+        parts = self.resource_path()
+        if not parts and resource.get("resourceType") == "Bundle":
+            minimal = "return=minimal" in self.headers.get("Prefer", "")
+            self.send_json(200, mock.handle_bundle(resource, minimal))
+        elif parts == ["$import"] and resource.get("resourceType") == "Parameters":
+            job = mock.start_import(resource)
+            self.send_json(202, {"resourceType": "OperationOutcome",
+                                 "issue": [{"severity": "information", "code": "informational"}]},
+                           {"Content-Location": f"{mock.base_url}$import-poll-status/{job}"})
+        elif len(parts) == 1 and parts[0] == resource.get("resourceType"):
+            self.send_json(201, mock.create(resource))
+        else:
+            self.send_json(400, {"resourceType": "OperationOutcome"})
+
+    def do_GET(self):
+        mock = self.server.mock
+        self.begin_request()
+        parts = self.resource_path()
+        if parts == ["metadata"]:
+            self.send_json(200, {"resourceType": "CapabilityStatement", "status": "active", "fhirVersion": "4.0.1"})
+        elif len(parts) == 2 and parts[0] == "$import-poll-status" and parts[1] in mock.imports:
+            result = mock.imports[parts[1]]
+            if result is None:
+                self.send_json(202, {"resourceType": "OperationOutcome"}, {"Retry-After": "1"})
+            else:
+                self.send_json(200, result)
+        elif len(parts) == 1:
+            params = parse_qs(self.path.partition("?")[2])
+            matches = mock.search(parts[0], params)
+            self.send_json(200, {
+                "resourceType": "Bundle",
+                "type": "searchset",
+                "total": len(matches),
+                "entry": [{"resource": resource, "search": {"mode": "match"}} for resource in matches]
+            })
+        elif len(parts) == 2 and (parts[0], parts[1]) in mock.resources:
+            self.send_json(200, mock.resources[(parts[0], parts[1])])
+        else:
+            self.send_json(404, {"resourceType": "OperationOutcome"})
+
+class MockFileServer:
+    def __init__(self, directory: str, host: str = "127.0.0.1", port: int = 0):
+        """
+        A local stand-in for the file server the FHIR server fetches $import input files
+        from. Serves the files of a directory over HTTP.
+
+        :param directory: The directory to serve, e.g. an export directory.
+        :param host: Interface to listen on.
+        :param port: Port to listen on, 0 picks a free port.
+        """
+        self._httpd = ThreadingHTTPServer((host, port), partial(_QuietFileHandler, directory=directory))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> "MockFileServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+class _QuietFileHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def count_connections(post_count: int = 20) -> None:
+    """
+    Test harness: posts the same bundle post_count times, first with a new connection per
+    request (plain requests.post), then through a pooled FhirClient, and prints how many
+    TCP connections the stand-in server saw in each case.
+    """
+    import requests
+    from requests.auth import HTTPBasicAuth
+    from fhirserverclient import FhirClient, DEFAULT_HEADERS
+    from batchbundle import BatchBundle
+    from observation import HeartRateObservation
+
+    with MockFhirServer() as server:
+        observations = [HeartRateObservation.from_template("1", 70 + i, i) for i in range(10)]
+        batch = BatchBundle("1", observations)
+
+        for _ in range(post_count):
+            requests.post(server.base_url, data=batch.iter_json(), headers=DEFAULT_HEADERS,
+                          auth=HTTPBasicAuth("_System", "ISCDEMO"))
+        print(f"requests.post: {server.requests_handled} requests over {server.connections_opened} connections")
+
+        server.reset_counters()
+        with FhirClient(base_url=server.base_url) as client:
+            for _ in range(post_count):
+                batch.post_bundle(client=client)
+            assert len(batch.observation_ids) == len(observations)
+        print(f"FhirClient:    {server.requests_handled} requests over {server.connections_opened} connections")
+
+def check_sampled_checkpoints() -> None:
+    """
+    Test harness: posts a growing readings file in sampled mode with checkpoints, appending
+    lines in the middle of an hour window between posts, and checks that the stand-in server
+    got exactly one Observation per window, holding every reading of it.
+    """
+    import os
+    import tempfile
+    from datetime import datetime, timedelta, timezone
+    from checkpointstore import CheckpointStore
+    from fhirserverclient import FhirClient
+    from heartratefilebundlegenerator import HeartRateFileBundleGenerator
+    from patientidstore import PatientIdStore
+    from patients import Patients
+    from sampleddata import MODE_SAMPLED
+
+    start = datetime(2025, 3, 4, tzinfo=timezone(timedelta(hours=-5)))
+    with tempfile.TemporaryDirectory() as directory, MockFhirServer() as server, \
+            FhirClient(base_url=server.base_url) as client:
+        patients = Patients(PatientIdStore(os.path.join(directory, "patient_ids.db")))
+        checkpoints = CheckpointStore(os.path.join(directory, "checkpoints.db"))
+        file_name = os.path.join(directory, "3564449972.txt")
+        # Minute readings up to 01:29, then to 02:09 and 03:04; every post ends inside a window.
+        for first, last in ((0, 90), (90, 130), (130, 185)):
+            with open(file_name, "a") as file:
+                for minute in range(first, last):
+                    file.write(f"({60 + minute % 40}, '{(start + timedelta(minutes=minute)).isoformat()}')\n")
+            HeartRateFileBundleGenerator("356-444-9972", patients, mode=MODE_SAMPLED, file_name=file_name,
+                                         checkpoints=checkpoints).post_bundle(client)
+        checkpoints.close()
+        patients.ids.close()
+
+    windows = [resource for (resource_type, _), resource in server.resources.items() if resource_type == "Observation"]
+    starts = [window["effectivePeriod"]["start"] for window in windows]
+    assert len(starts) == len(set(starts)), f"windows posted twice: {sorted(starts)}"
+    # 00:00, 01:00 and 02:00 are complete, 03:00 waits for a later reading.
+    assert len(windows) == 3, sorted(starts)
+    assert all("E" not in window["valueSampledData"]["data"].split() for window in windows)
+    print(f"Sampled checkpoints: {len(windows)} windows posted once each")
+
+if __name__ == "__main__":
+    count_connections()
+    check_sampled_checkpoints()
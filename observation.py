@@ -7,7 +7,11 @@ from fhir.resources.reference import Reference
 from fhir.resources.extension import Extension
 from printresource import print_fhir_resource
 from zoneinfo import ZoneInfo
-from typing import Optional
+from timestamps import get_zone
+from typing import Iterable, List, Optional
+
+# Validated skeleton shared by every fast-path HeartRateObservation (see from_template).
+_template = None
 
 class HeartRateObservation(Observation):
     def __init__(self, subject_id: str, heart_rate_value: int, minutes_ago: int = 0, effective_dt: Optional[datetime] = None):
@@ -33,6 +37,71 @@ class HeartRateObservation(Observation):
         else:
             self.extension.append(heart_monitor_extension)
     
+    @classmethod
+    def get_template(cls) -> "HeartRateObservation":
+        """
+        Returns the invariant heart rate skeleton (LOINC 8867-4 code, vital-signs category,
+        mobile monitor extension), validated once through the regular constructor and cached.
+        """
+        global _template
+        if _template is None:
+            _template = cls("template", 0, effective_dt=datetime(2025, 1, 1, tzinfo=ZoneInfo("America/New_York")))
+        return _template
+
+    @classmethod
+    def from_template(cls, subject_id: str, heart_rate_value: int, minutes_ago: int = 0, effective_dt: Optional[datetime] = None) -> "HeartRateObservation":
+        """
+        Fast alternative to the constructor. The constant code, category and extension
+        objects are taken from the validated template, and only the per-reading fields
+        (value, effectiveDateTime, subject) are stamped onto a new instance without
+        running pydantic validation again.
+
+        :param subject_id: The FHIR patient id (e.g., "2").
+        :param heart_rate_value: The measured heart rate.
+        :param minutes_ago: The number of minutes behind current time if effective_dt is not provided.
+        :param effective_dt: An optional timezone-aware datetime to use as the effectiveDateTime.
+        :return: A HeartRateObservation equivalent to HeartRateObservation(subject_id, heart_rate_value, ...).
+        """
+        if effective_dt is None:
+            effective_dt = datetime.now(get_zone("America/New_York")) - timedelta(minutes=minutes_ago)
+        return cls._stamp(cls.get_template(), subject_id, heart_rate_value, effective_dt)
+
+    @classmethod
+    def build_many(cls, subject_id: str, heart_rate_values: Iterable[int], effective_dts: Iterable[datetime]) -> List["HeartRateObservation"]:
+        """
+        Builds one HeartRateObservation per (value, effective datetime) pair from the template.
+
+        :param subject_id: The FHIR patient id shared by all readings.
+        :param heart_rate_values: The measured heart rates.
+        :param effective_dts: Timezone-aware datetimes, or ISO 8601 strings as produced in bulk
+                              by timestamps.TimestampService, one per heart rate value.
+        :return: A list of HeartRateObservation objects in input order.
+        """
+        template = cls.get_template()
+        return [cls._stamp(template, subject_id, value, effective_dt)
+                for value, effective_dt in zip(heart_rate_values, effective_dts)]
+
+    @classmethod
+    def _stamp(cls, template: "HeartRateObservation", subject_id: str, heart_rate_value: int, effective_dt: datetime) -> "HeartRateObservation":
+        # The coding objects are shared with the template; only the lists holding them are
+        # new so that appending to one observation's extensions does not affect the others.
+        # subject and valueQuantity are always fresh because bundles rewrite subject.reference.
+        quantity = template.valueQuantity
+        return cls.construct(
+            extension=list(template.extension),
+            category=list(template.category),
+            code=template.code,
+            effectiveDateTime=effective_dt,
+            status=template.status,
+            subject=Reference.construct(reference=f"Patient/{subject_id}"),
+            valueQuantity=Quantity.construct(
+                value=heart_rate_value,
+                unit=quantity.unit,
+                system=quantity.system,
+                code=quantity.code
+            )
+        )
+
     def create_heart_rate_observation3(self, subject_id: str, heart_rate_value: int, minutes_ago: int = 0, effective_dt: Optional[datetime] = None) -> Observation:
         """
         Creates a FHIR Observation resource for heart rate.
@@ -103,7 +172,7 @@ class HeartRateObservation(Observation):
         :param minutes_behind: Minutes to subtract from the current Eastern Time.
         :return: ISO 8601 formatted datetime string.
         """
-        now_eastern = datetime.now(ZoneInfo("America/New_York"))
+        now_eastern = datetime.now(get_zone("America/New_York"))
         adjusted_time = now_eastern - timedelta(minutes=minutes_behind)
         return adjusted_time.isoformat()
 
@@ -0,0 +1,368 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import requests
+from batchbundle import BatchBundle
+from transactionbundle import TransactionBundle
+from bundledispatcher import DEFAULT_CHUNK_SIZE
+from fhirserverclient import FhirClient, get_default_client
+from retrypolicy import RetryPolicy
+
+DEFAULT_OUTBOX_DIR = "outbox"
+# A new segment file is started once the current one reaches this size.
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+# Appended records are fsynced once this many are pending, or fsync_interval seconds after the first.
+DEFAULT_FSYNC_EVERY = 500
+DEFAULT_FSYNC_INTERVAL = 0.2
+# Seconds the drainer sleeps when the outbox is empty, unless woken by an append.
+DEFAULT_POLL_INTERVAL = 1.0
+# System of the client-generated identifier given to every queued Observation. Resends are
+# conditional on it (ifNoneExist), which turns at-least-once delivery into exactly-once storage.
+OUTBOX_IDENTIFIER_SYSTEM = "urn:edge-gateway:outbox"
+
+CURSOR_FILE = "cursor.json"
+DEAD_LETTER_FILE = "dead-letter.ndjson"
+_SEGMENT_NAME = re.compile(r"^segment-(\d{8})\.log$")
+
+class Outbox:
+    def __init__(self, directory: str = DEFAULT_OUTBOX_DIR, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 fsync_every: int = DEFAULT_FSYNC_EVERY, fsync_interval: float = DEFAULT_FSYNC_INTERVAL):
+        """
+        Disk-backed queue of Observations waiting to be posted, for when the FHIR server is down.
+
+        Records are appended as JSON lines to segment files (segment-00000001.log, ...). Writes
+        are fsynced in groups, after fsync_every records or fsync_interval seconds, so at most
+        that much is lost on a power failure. A cursor file records how far the drainer has
+        posted; fully posted segments are deleted. A torn last line left by a crash is cut off
+        when the outbox is reopened.
+
+        :param directory: Where the segments, cursor and dead letters are kept.
+        :param segment_size: Size in bytes at which a new segment is started.
+        :param fsync_every: The number of unsynced records that triggers an fsync.
+        :param fsync_interval: The longest time in seconds an appended record stays unsynced
+                               while an OutboxDrainer is running.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self.appended = threading.Condition(self._lock)
+        self._unsynced = 0
+        self._unsynced_since = None
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self._segments()
+        self.cursor = self._load_cursor(segments[0] if segments else 1)
+        self._segment = segments[-1] if segments else 1
+        self._repair(self._segment_path(self._segment))
+        self._file = open(self._segment_path(self._segment), 'ab')
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"segment-{number:08d}.log")
+
+    def _segments(self) -> list:
+        return sorted(int(match.group(1)) for match in map(_SEGMENT_NAME.match, os.listdir(self.directory)) if match)
+
+    def _load_cursor(self, first_segment: int):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE), 'r') as file:
+                cursor = json.load(file)
+            return cursor["segment"], cursor["offset"]
+        except (OSError, ValueError, KeyError):
+            return first_segment, 0
+
+    @staticmethod
+    def _repair(path: str) -> None:
+        # Cut off a partial record left by a crash in the middle of a write.
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as file:
+            data = file.read()
+            end = data.rfind(b"\n") + 1
+            if end != len(data):
+                file.truncate(end)
+
+    def append(self, patient_identifier: str, observations) -> int:
+        """
+        Queues Observations of one patient. Each one gets a client-generated identifier, unless it
+        already has one, so it can be resent safely.
+
+        :param patient_identifier: The identifier of the patient in the form '356-444-9972'.
+        :param observations: An iterable of Observations.
+        :return: The number of records queued.
+        """
+        patient = json.dumps(patient_identifier).encode()
+        lines = [b'{"patient":' + patient + b',"resource":' + encode_resource(observation) + b'}\n'
+                 for observation in observations]
+        with self._lock:
+            for line in lines:
+                if self._file.tell() >= self.segment_size:
+                    self._rotate()
+                self._file.write(line)
+            # Make the records visible to the drainer, the fsync below makes them durable.
+            self._file.flush()
+            if self._unsynced == 0:
+                self._unsynced_since = time.monotonic()
+            self._unsynced += len(lines)
+            if self._unsynced >= self.fsync_every:
+                self._sync()
+            self.appended.notify_all()
+        return len(lines)
+
+    def _rotate(self) -> None:
+        self._sync()
+        self._file.close()
+        self._segment += 1
+        self._file = open(self._segment_path(self._segment), 'ab')
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._unsynced_since = None
+
+    def sync(self, if_older_than: float = None) -> None:
+        """
+        Fsyncs the records appended since the last sync.
+
+        :param if_older_than: Only sync if the oldest unsynced record is at least this many seconds old.
+        """
+        with self._lock:
+            if self._unsynced == 0 or self._file.closed:
+                return
+            if if_older_than is not None and time.monotonic() - self._unsynced_since < if_older_than:
+                return
+            self._sync()
+
+    def read_batch(self, max_records: int):
+        """
+        Reads up to max_records queued records from the cursor on, across segments.
+
+        :return: (list of (patient identifier, resource dict), position after the last record).
+                 Pass the position to acknowledge() once the records are posted. A corrupt record
+                 is returned as (None, its line as text), to be dead-lettered.
+        """
+        with self._lock:
+            last_segment = self._segment
+        records = []
+        segment, offset = self.cursor
+        while len(records) < max_records and segment <= last_segment:
+            path = self._segment_path(segment)
+            if os.path.exists(path):
+                with open(path, 'rb') as file:
+                    file.seek(offset)
+                    for line in file:
+                        if not line.endswith(b"\n"):
+                            break  # still being written
+                        try:
+                            record = json.loads(line)
+                            records.append((record["patient"], record["resource"]))
+                        except (ValueError, KeyError, TypeError):
+                            records.append((None, line.decode(errors="replace").rstrip("\n")))
+                        offset += len(line)
+                        if len(records) == max_records:
+                            break
+            if len(records) < max_records and segment < last_segment:
+                segment, offset = segment + 1, 0
+            else:
+                break
+        return records, (segment, offset)
+
+    def acknowledge(self, position) -> None:
+        """Moves the cursor past posted records and deletes the segments it has left behind."""
+        segment, offset = position
+        path = os.path.join(self.directory, CURSOR_FILE)
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as file:
+            json.dump({"segment": segment, "offset": offset}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        old_segment = self.cursor[0]
+        self.cursor = (segment, offset)
+        for number in range(old_segment, segment):
+            try:
+                os.remove(self._segment_path(number))
+            except FileNotFoundError:
+                pass
+
+    def dead_letter(self, records, status: str) -> None:
+        """Sets aside records the server rejected for good, with the rejection status."""
+        with open(os.path.join(self.directory, DEAD_LETTER_FILE), 'a') as file:
+            for patient_identifier, resource in records:
+                file.write(json.dumps({"patient": patient_identifier, "status": status, "resource": resource}) + "\n")
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self.cursor == (self._segment, self._file.tell())
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def encode_resource(observation) -> bytes:
+    """Serializes an Observation for the outbox, adding a client-generated identifier if it has none."""
+    data = observation.json().encode()
+    if observation.identifier:
+        return data
+    identifier = b'{"identifier":[{"system":"' + OUTBOX_IDENTIFIER_SYSTEM.encode() + b'","value":"' + \
+                 uuid.uuid4().hex.encode() + b'"}],'
+    return identifier + data[1:]
+
+class ServerUnavailable(Exception):
+    """The FHIR server could not be reached or kept failing entries with retryable statuses."""
+
+class OutboxDrainer:
+    def __init__(self, outbox: Outbox, patients, client: FhirClient = None, batch_size: int = DEFAULT_CHUNK_SIZE,
+                 retry_policy: RetryPolicy = None, poll_interval: float = DEFAULT_POLL_INTERVAL):
+        """
+        Background thread that posts queued Observations once the FHIR server is reachable.
+
+        Records are read in batches of up to batch_size and posted as one conditional
+        BatchBundle per patient; Patients without a FHIR id are first created with a
+        conditional TransactionBundle. The cursor only moves after every record of a batch
+        is stored or dead-lettered, so delivery is at least once, and the ifNoneExist on
+        each Observation's outbox identifier keeps resent records from being stored twice.
+
+        :param outbox: The Outbox to drain.
+        :param patients: The Patients registry, used to look up and store FHIR ids.
+        :param client: The FhirClient to post with, defaults to the shared client.
+        :param batch_size: The maximum number of records read and posted at once.
+        :param retry_policy: Backoff between attempts while the server is unavailable, and for failed entries.
+        :param poll_interval: Seconds to wait for new records when the outbox is empty.
+        """
+        self.outbox = outbox
+        self.patients = patients
+        self.client = client
+        self.batch_size = batch_size
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.poll_interval = poll_interval
+        self.posted = 0
+        self.dead_lettered = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> "OutboxDrainer":
+        self._thread = threading.Thread(target=self.run, name="outbox-drainer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = None) -> None:
+        self._stop.set()
+        with self.outbox.appended:
+            self.outbox.appended.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self) -> None:
+        failures = 0
+        while not self._stop.is_set():
+            self.outbox.sync(if_older_than=self.outbox.fsync_interval)
+            try:
+                drained = self.drain_once()
+                failures = 0
+            except (ServerUnavailable, requests.RequestException) as e:
+                print(f"Outbox: FHIR server unavailable, retrying later. Error: {e}")
+                self._stop.wait(self.retry_policy.delay(min(failures, 10)))
+                failures += 1
+                continue
+            except Exception as e:
+                # Anything else would end the thread while records keep being queued.
+                print(f"Outbox: draining failed, retrying later. Error: {e!r}")
+                self._stop.wait(self.retry_policy.delay(min(failures, 10)))
+                failures += 1
+                continue
+            if drained == 0:
+                with self.outbox.appended:
+                    self.outbox.appended.wait(min(self.poll_interval, self.outbox.fsync_interval))
+
+    def drain_once(self) -> int:
+        """
+        Posts the next batch of queued records.
+
+        :return: The number of records taken off the outbox, 0 if it was empty.
+        :raises ServerUnavailable: If the batch could not be stored; it is resent by the next call.
+        """
+        records, position = self.outbox.read_batch(self.batch_size)
+        if not records:
+            if position != self.outbox.cursor:
+                # Step over the end of a finished segment.
+                self.outbox.acknowledge(position)
+            return 0
+        client = self.client or get_default_client()
+        # Entries are resent at most batch_size times per batch; beyond that the whole batch
+        # waits for the next drain_once.
+        policy = self.retry_policy
+        batch_policy = RetryPolicy(policy.max_attempts, policy.base_delay, policy.max_delay, budget=len(records),
+                                   retryable_statuses=policy.retryable_statuses)
+        # Rejections are only written once the whole batch is stored: if a later patient's
+        # post fails, the batch is resent and would otherwise dead-letter them again.
+        rejected = []
+        by_patient = {}
+        for record in records:
+            if record[0] is None:
+                rejected.append((record, "Malformed record"))
+            else:
+                by_patient.setdefault(record[0], []).append(record)
+
+        for patient_identifier, patient_records in by_patient.items():
+            patient_id = self._patient_id(patient_identifier, client)
+            if patient_id is None:
+                rejected.extend((record, "Unknown patient") for record in patient_records)
+                continue
+            batch = BatchBundle(patient_id, [resource for _, resource in patient_records], conditional=True)
+            batch.post_bundle(client, batch_policy)
+            for record, result in zip(patient_records, batch.results):
+                if result.ok:
+                    continue
+                if self.retry_policy.is_retryable(result.status_code):
+                    raise ServerUnavailable(f"{len(batch.get_failed_indexes())} entries failed with {result.status}")
+                rejected.append((record, result.status))
+
+        for record, status in rejected:
+            self.outbox.dead_letter([record], status)
+        self.outbox.acknowledge(position)
+        self.dead_lettered += len(rejected)
+        self.posted += len(records) - len(rejected)
+        return len(records)
+
+    def _patient_id(self, patient_identifier: str, client: FhirClient) -> str:
+        patient_id = self.patients.get_patient_id(patient_identifier)
+        if patient_id:
+            return patient_id
+        patient = self.patients.get_patient(patient_identifier)
+        if patient is None:
+            return None
+        # Conditional on the Patient's identifier, so a retried create finds the earlier one.
+        patient_id = TransactionBundle(patient, []).post_bundle(client)
+        if patient_id == "":
+            raise ServerUnavailable(f"Could not create Patient {patient_identifier}")
+        self.patients.store_patient_id(patient_identifier, patient_id)
+        return patient_id
+
+    def server_available(self, timeout: float = 2.0) -> bool:
+        """True if the FHIR server answers GET metadata, used to decide between posting and queueing."""
+        return (self.client or get_default_client()).is_available(timeout)
+
+# Example usage:
+if __name__ == "__main__":
+    from patients import Patients
+
+    with Outbox() as outbox:
+        drainer = OutboxDrainer(outbox, Patients()).start()
+        while not outbox.is_empty():
+            time.sleep(1)
+        drainer.stop()
+        print(f"Posted {drainer.posted} queued Observations, {drainer.dead_lettered} dead-lettered")
@@ -0,0 +1,124 @@
+import atexit
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+# Default location of the identifier -> FHIR id cache.
+DEFAULT_STORE_PATH = "patient_ids.db"
+
+class PatientIdStore:
+    def __init__(self, path: str = DEFAULT_STORE_PATH, ttl: Optional[float] = None,
+                 revalidate: Optional[Callable[[str], bool]] = None, flush_every: int = 100):
+        """
+        Persistent cache of Patient FHIR ids keyed by identifier value, backed by SQLite.
+
+        All rows are loaded into a dict when the store is opened, so lookups are O(1)
+        and never touch the disk. Writes are queued and flushed to SQLite in one
+        transaction every flush_every ids, on flush()/close() and at interpreter exit.
+
+        :param path: The SQLite database file, ":memory:" for a process-local store.
+        :param ttl: Seconds after which a cached id is considered stale, None to keep ids forever.
+        :param revalidate: Called with a stale FHIR id; returns True if the Patient still exists
+                           on the server. Without it, stale ids are simply dropped.
+        :param flush_every: The number of pending writes that triggers a flush.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS patient_ids ("
+            "identifier TEXT PRIMARY KEY, fhir_id TEXT NOT NULL, stored_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+        # identifier -> (fhir_id, stored_at)
+        self._ids = {identifier: (fhir_id, stored_at) for identifier, fhir_id, stored_at
+                     in self._connection.execute("SELECT identifier, fhir_id, stored_at FROM patient_ids")}
+        atexit.register(self.close)
+
+    def get(self, identifier: str) -> Optional[str]:
+        """Returns the cached FHIR id of a patient, or None if unknown or stale."""
+        cached = self._ids.get(identifier)
+        if cached is None:
+            return None
+        fhir_id, stored_at = cached
+        if self.ttl is not None and time.time() - stored_at > self.ttl:
+            if self.revalidate is not None and self.revalidate(fhir_id):
+                # Still on the server, start a new TTL period.
+                self.put(identifier, fhir_id)
+                return fhir_id
+            self.delete(identifier)
+            return None
+        return fhir_id
+
+    def put(self, identifier: str, fhir_id: str) -> None:
+        """Caches the FHIR id of a patient. The write reaches disk with the next flush."""
+        with self._lock:
+            entry = (fhir_id, time.time())
+            self._ids[identifier] = entry
+            self._pending[identifier] = entry
+            flush = len(self._pending) >= self.flush_every
+        if flush:
+            self.flush()
+
+    def delete(self, identifier: str) -> None:
+        """Forgets the FHIR id of a patient, e.g. after the Patient was deleted on the server."""
+        with self._lock:
+            self._ids.pop(identifier, None)
+            self._pending[identifier] = None
+        self.flush()
+
+    def flush(self) -> None:
+        """Writes all pending changes to SQLite in a single transaction."""
+        with self._lock:
+            if not self._pending or self._connection is None:
+                return
+            upserts = [(identifier, entry[0], entry[1]) for identifier, entry in self._pending.items() if entry]
+            deletes = [(identifier,) for identifier, entry in self._pending.items() if entry is None]
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO patient_ids (identifier, fhir_id, stored_at) VALUES (?, ?, ?)", upserts)
+                self._connection.executemany("DELETE FROM patient_ids WHERE identifier = ?", deletes)
+            self._pending.clear()
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+        atexit.unregister(self.close)
+
+    def __contains__(self, identifier: str) -> bool:
+        return self.get(identifier) is not None
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+def server_revalidator(client=None) -> Callable[[str], bool]:
+    """
+    Returns a revalidate callback that checks with a GET Patient/{id} whether a cached id
+    still exists on the FHIR server.
+
+    :param client: The FhirClient to use, defaults to the shared client.
+    """
+    from fhirserverclient import get_default_client
+
+    def revalidate(fhir_id: str) -> bool:
+        try:
+            return (client or get_default_client()).get(f"Patient/{fhir_id}").status_code == 200
+        except Exception as e:
+            print(f"Could not revalidate Patient/{fhir_id}. Error: {e}")
+            return False
+
+    return revalidate
+
+# Example usage:
+if __name__ == "__main__":
+    store = PatientIdStore(ttl=24 * 3600, revalidate=server_revalidator())
+    for identifier, (fhir_id, stored_at) in store._ids.items():
+        print(f"{identifier} -> Patient/{fhir_id} (stored {time.ctime(stored_at)})")
@@ -1,134 +1,236 @@
+import json
+import os
+import threading
+from collections import OrderedDict
 from fhir.resources.patient import Patient
 from printresource import print_fhir_resource
-from fhir.resources.patient import Patient
-import requests
-from requests.auth import HTTPBasicAuth
+from fhirserverclient import FhirClient, get_default_client
+from patientidstore import PatientIdStore
+
+# Identifiers per Patient?identifier=a,b,c search, keeps the URL well under server limits.
+RESOLVE_BATCH_SIZE = 50
+# Validated Patient resources kept in memory by Patients.get_patient.
+DEFAULT_CACHE_SIZE = 1024
+# (full_name, identifier) tuples per page of Patients.get_short_form_patients.
+DEFAULT_PAGE_SIZE = 20
+
+def identifier_token(patient: Patient) -> str:
+    """
+    Returns the first identifier of a Patient as a FHIR search token "system|value",
+    e.g. "http://mgb.org|356-444-9972", or None if the Patient has no identifier.
+    """
+    if not patient.identifier:
+        return None
+    identifier = patient.identifier[0]
+    if identifier.system:
+        return f"{identifier.system}|{identifier.value}"
+    return identifier.value
+
+def parse_patient_line(line: str):
+    """
+    Parses one line of patients.txt into the FHIR structure of a Patient.
+    Each line should contain:
+      Name | Address | Date of Birth | Gender | Telecom | Identifier
+
+    Parsing Details:
+    - Address: "123 Main Street, Boston, MA, 02142" is parsed into:
+      line, city, state, and postalCode.
+    - Telecom: "phone, mobile, 617-231-3345" is parsed into:
+      system, use, and value.
+    - Identifier: "http://mgb.org, 356-444-9972" is parsed into:
+      system and value.
+    - Name: "Mary Johnson" is split into:
+      given (Mary) and family (Johnson).
+
+    :return: (full_name, identifier_value, patient_data), or None for blank and malformed lines.
+    """
+    if not line:
+        return None
+
+    parts = line.split('|')
+    if len(parts) < 6:
+        print(f"Skipping malformed line: {line}")
+        return None
+
+    # Extract and clean the fields.
+    full_name = parts[0].strip()
+    address_field = parts[1].strip()
+    dob = parts[2].strip()
+    gender = parts[3].strip()
+    telecom_field = parts[4].strip()
+    identifier_field = parts[5].strip()
+
+    # Parse Name: Split full name into given and family.
+    name_parts = full_name.split()
+    if len(name_parts) >= 2:
+        given = name_parts[0]
+        family = " ".join(name_parts[1:])
+    else:
+        given = full_name
+        family = ""
+
+    # Parse Address (expected format: "line, city, state, postalCode")
+    address_parts = [p.strip() for p in address_field.split(',')]
+    if len(address_parts) < 4:
+        print(f"Address field malformed: {address_field}")
+        return None
+    address_line = address_parts[0]
+    city = address_parts[1]
+    state = address_parts[2]
+    postalCode = address_parts[3]
+
+    # Parse Telecom (expected format: "system, use, value")
+    telecom_parts = [p.strip() for p in telecom_field.split(',')]
+    if len(telecom_parts) < 3:
+        print(f"Telecom field malformed: {telecom_field}")
+        return None
+    telecom_system = telecom_parts[0]
+    telecom_use = telecom_parts[1]
+    telecom_value = telecom_parts[2]
+
+    # Parse Identifier (expected format: "system, value")
+    identifier_parts = [p.strip() for p in identifier_field.split(',')]
+    if len(identifier_parts) < 2:
+        print(f"Identifier field malformed: {identifier_field}")
+        return None
+    identifier_system = identifier_parts[0]
+    identifier_value = identifier_parts[1]
+
+    # Build the patient data dictionary using FHIR structure.
+    patient_data = {
+        "resourceType": "Patient",
+        "name": [{
+            "given": [given],
+            "family": family,
+            "text": full_name
+        }],
+        "address": [{
+            "line": [address_line],
+            "city": city,
+            "state": state,
+            "postalCode": postalCode,
+        }],
+        "birthDate": dob,
+        "gender": gender,
+        "telecom": [{
+            "system": telecom_system,
+            "use": telecom_use,
+            "value": telecom_value,
+        }],
+        "identifier": [{
+            "system": identifier_system,
+            "value": identifier_value,
+        }]
+    }
+    return full_name, identifier_value, patient_data
 
 class Patients:
-    def __init__(self):
-        # List to store short form tuples of (full_name, identifier_value)
-        self.short_form_patients = []
-        # Dictionary to store Patient resources keyed by their Identifier value.
-        self.patients = {}
-        # Dictionary to store FHIR IDs (if any) keyed by identifier.
-        self.ids = {}
-        self.load_patients("patients.txt")
+    def __init__(self, id_store: PatientIdStore = None, file_path: str = "patients.txt",
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        """
+        Registry of the gateway patients in patients.txt.
+
+        Only a byte-offset index (identifier -> position of its line) is kept in memory. The
+        index is cached next to the roster as <file_path>.idx and rebuilt when the roster's
+        modification time or size changes. Patient resources are parsed and validated on
+        first access and kept in an LRU cache of cache_size entries.
+
+        :param id_store: Persistent cache of FHIR ids keyed by identifier. Defaults to the
+                         patient_ids.db store, so ids survive restarts and known patients are
+                         posted with a BatchBundle instead of being created again.
+        :param file_path: The patient roster.
+        :param cache_size: The maximum number of validated Patient resources kept in memory.
+        """
+        self.file_path = file_path
+        self.cache_size = cache_size
+        # Identifiers in roster order, and identifier -> (byte offset, identifier system).
+        self.identifiers = []
+        self.index = {}
+        # LRU cache of Patient resources keyed by their Identifier value. The OutboxDrainer
+        # thread reads it too, the lock keeps the reordering and eviction consistent.
+        self.patients = OrderedDict()
+        self._lock = threading.Lock()
+        # Persistent store of FHIR IDs (if any) keyed by identifier.
+        self.ids = id_store if id_store is not None else PatientIdStore()
+        self.load_patients(file_path)
 
     def load_patients(self, file_path: str) -> None:
         """
-        Reads the patients.txt file and creates Patient resources.
-        Each line should contain:
-          Name | Address | Date of Birth | Gender | Telecom | Identifier
-
-        Parsing Details:
-        - Address: "123 Main Street, Boston, MA, 02142" is parsed into:
-          line, city, state, and postalCode.
-        - Telecom: "phone, mobile, 617-231-3345" is parsed into:
-          system, use, and value.
-        - Identifier: "http://mgb.org, 356-444-9972" is parsed into:
-          system and value.
-        - Name: "Mary Johnson" is split into:
-          given (Mary) and family (Johnson).
-        The resulting Patient resources are stored in self.patients, keyed by identifier.value.
+        Loads the byte-offset index of patients.txt, from the cached <file_path>.idx when it
+        is still current, otherwise by scanning the roster once and writing a new index.
+        Lines that parse_patient_line rejects are left out of the index.
         """
-        with open(file_path, 'r') as file:
-            for line in file:
-                line = line.strip()
-                if not line:
-                    continue
-
-                parts = line.split('|')
-                if len(parts) < 6:
-                    print(f"Skipping malformed line: {line}")
-                    continue
-
-                # Extract and clean the fields.
-                full_name = parts[0].strip()
-                address_field = parts[1].strip()
-                dob = parts[2].strip()
-                gender = parts[3].strip()
-                telecom_field = parts[4].strip()
-                identifier_field = parts[5].strip()
-
-                # Parse Name: Split full name into given and family.
-                name_parts = full_name.split()
-                if len(name_parts) >= 2:
-                    given = name_parts[0]
-                    family = " ".join(name_parts[1:])
-                else:
-                    given = full_name
-                    family = ""
-
-                # Parse Address (expected format: "line, city, state, postalCode")
-                address_parts = [p.strip() for p in address_field.split(',')]
-                if len(address_parts) < 4:
-                    print(f"Address field malformed: {address_field}")
-                    continue
-                address_line = address_parts[0]
-                city = address_parts[1]
-                state = address_parts[2]
-                postalCode = address_parts[3]
-
-                # Parse Telecom (expected format: "system, use, value")
-                telecom_parts = [p.strip() for p in telecom_field.split(',')]
-                if len(telecom_parts) < 3:
-                    print(f"Telecom field malformed: {telecom_field}")
-                    continue
-                telecom_system = telecom_parts[0]
-                telecom_use = telecom_parts[1]
-                telecom_value = telecom_parts[2]
-
-                # Parse Identifier (expected format: "system, value")
-                identifier_parts = [p.strip() for p in identifier_field.split(',')]
-                if len(identifier_parts) < 2:
-                    print(f"Identifier field malformed: {identifier_field}")
-                    continue
-                identifier_system = identifier_parts[0]
-                identifier_value = identifier_parts[1]
-
-                # Build the patient data dictionary using FHIR structure.
-                patient_data = {
-                    "resourceType": "Patient",
-                    "name": [{
-                        "given": [given],
-                        "family": family,
-                        "text": full_name
-                    }],
-                    "address": [{
-                        "line": [address_line],
-                        "city": city,
-                        "state": state,
-                        "postalCode": postalCode,
-                    }],
-                    "birthDate": dob,
-                    "gender": gender,
-                    "telecom": [{
-                        "system": telecom_system,
-                        "use": telecom_use,
-                        "value": telecom_value,
-                    }],
-                    "identifier": [{
-                        "system": identifier_system,
-                        "value": identifier_value,
-                    }]
-                }
-
-                # Create a Patient resource.
-                patient_resource = Patient(**patient_data)
-                # Store the patient keyed by the identifier's value.
-                self.patients[identifier_value] = patient_resource
-
-                # Append a short-form tuple (full_name, identifier_value)
-                self.short_form_patients.append((full_name, identifier_value))
+        index_path = file_path + ".idx"
+        stat = os.stat(file_path)
+        try:
+            with open(index_path, 'r') as index_file:
+                cached = json.load(index_file)
+            if cached["mtime_ns"] == stat.st_mtime_ns and cached["size"] == stat.st_size:
+                self._set_index(cached["entries"])
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+
+        entries = []
+        with open(file_path, 'rb') as file:
+            offset = 0
+            for raw_line in file:
+                parsed = parse_patient_line(raw_line.decode().strip())
+                if parsed is not None:
+                    _, identifier_value, patient_data = parsed
+                    entries.append([identifier_value, offset, patient_data["identifier"][0]["system"]])
+                offset += len(raw_line)
+        self._set_index(entries)
+        try:
+            with open(index_path, 'w') as index_file:
+                json.dump({"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "entries": entries}, index_file)
+        except OSError as e:
+            print(f"Could not write patient index {index_path}. Error: {e}")
+
+    def _set_index(self, entries) -> None:
+        self.identifiers = [identifier for identifier, _, _ in entries]
+        self.index = {identifier: (offset, system) for identifier, offset, system in entries}
+
+    def _read_line(self, file, identifier: str) -> str:
+        file.seek(self.index[identifier][0])
+        return file.readline().decode().strip()
 
     def get_patient(self, identifier: str) -> Patient:
-        """Retrieve a Patient resource by its identifier."""
-        return self.patients.get(identifier)
-    
+        """Retrieve a Patient resource by its identifier, parsing it on first access."""
+        with self._lock:
+            patient = self.patients.get(identifier)
+            if patient is not None:
+                self.patients.move_to_end(identifier)
+                return patient
+        if identifier not in self.index:
+            return None
+        with open(self.file_path, 'rb') as file:
+            _, _, patient_data = parse_patient_line(self._read_line(file, identifier))
+        # Create a Patient resource, outside the lock as validation is the slow part.
+        patient = Patient(**patient_data)
+        with self._lock:
+            # Another thread may have cached it meanwhile, keep one instance.
+            patient = self.patients.setdefault(identifier, patient)
+            self.patients.move_to_end(identifier)
+            if len(self.patients) > self.cache_size:
+                self.patients.popitem(last=False)
+        return patient
+
+    def __contains__(self, identifier: str) -> bool:
+        return identifier in self.index
+
+    def __len__(self) -> int:
+        return len(self.identifiers)
+
+    def get_identifier_token(self, identifier: str) -> str:
+        """The "system|value" search token of a patient, without parsing the Patient."""
+        _, system = self.index[identifier]
+        return f"{system}|{identifier}" if system else identifier
+
     def store_patient_id(self, identifier: str, fhir_id) -> str:
         """Store a Patient FHIR Id by its identifier."""
-        if self.patients.get(identifier):
-            self.ids[identifier] = fhir_id
+        if identifier in self.index:
+            self.ids.put(identifier, fhir_id)
             return "Patient FHIR id stored"
         else: 
            return "Could not find patient identifer, unable to store FHIR id"
@@ -136,12 +238,73 @@ class Patients:
     def get_patient_id(self, identifier: str) -> str:
         return self.ids.get(identifier)
     
-    def get_short_form_patients(self) -> []:
-         return self.short_form_patients
+    def resolve_patient_ids(self, identifiers=None, client: FhirClient = None) -> int:
+        """
+        Looks up the FHIR ids of patients on the server in bulk with Patient?identifier=a,b,c
+        searches and stores every match, so later uploads for them use the batch path.
+
+        :param identifiers: The identifiers to resolve, defaults to all patients without a cached id.
+        :param client: The FhirClient to search with, defaults to the shared client.
+        :return: The number of FHIR ids found.
+        """
+        client = client or get_default_client()
+        if identifiers is None:
+            identifiers = [identifier for identifier in self.identifiers if not self.get_patient_id(identifier)]
+        tokens = {}
+        for identifier in identifiers:
+            if identifier in self.index:
+                tokens[self.get_identifier_token(identifier)] = identifier
+
+        found = 0
+        token_list = list(tokens)
+        for start in range(0, len(token_list), RESOLVE_BATCH_SIZE):
+            batch = token_list[start:start + RESOLVE_BATCH_SIZE]
+            response = client.get("Patient", params={"identifier": ",".join(batch), "_count": len(batch),
+                                                     "_elements": "identifier"})
+            while True:
+                if response.status_code != 200:
+                    print(f"Failed to search Patients. Status code: {response.status_code}")
+                    print("Response:", response.text)
+                    break
+                searchset = response.json()
+                for entry in searchset.get('entry', []):
+                    resource = entry['resource']
+                    for identifier in resource.get('identifier', []):
+                        token = f"{identifier['system']}|{identifier['value']}" if identifier.get('system') else identifier.get('value')
+                        if token in tokens:
+                            self.store_patient_id(tokens[token], resource['id'])
+                            found += 1
+                            break
+                # Follow paging in case the server caps the page size.
+                next_url = next((link['url'] for link in searchset.get('link', []) if link['relation'] == 'next'), None)
+                if next_url is None:
+                    break
+                response = client.session.get(next_url, timeout=client.timeout)
+        return found
+
+    def get_short_form_patients(self, page_size: int = DEFAULT_PAGE_SIZE):
+        """
+        Yields the roster in pages, each a list of up to page_size (full_name, identifier_value)
+        tuples. Names are read from the roster as the pages are requested.
+        """
+        with open(self.file_path, 'rb') as file:
+            for start in range(0, len(self.identifiers), page_size):
+                yield [self._short_form(file, identifier) for identifier in self.identifiers[start:start + page_size]]
+
+    def get_short_form_patient(self, number: int):
+        """Returns the (full_name, identifier_value) tuple of the number-th patient, counting from 1."""
+        identifier = self.identifiers[number - 1]
+        with open(self.file_path, 'rb') as file:
+            return self._short_form(file, identifier)
+
+    def _short_form(self, file, identifier: str):
+        full_name = self._read_line(file, identifier).split('|', 1)[0].strip()
+        return full_name, identifier
     
-    def post_patient(self, identifier):
+    def post_patient(self, identifier, client: FhirClient = None):
         """
         Posts a FHIR Patient to a local FHIR server.
+        :param client: The FhirClient to post with, defaults to the shared client.
         :return: The response object from the POST request.
         """
         
@@ -153,19 +316,9 @@ class Patients:
             print(f"No such patient with this identifier {identifier}")
             return
 
-        # Define the endpoint for posting an Observation
-        endpoint = "http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4/Patient"
-
-         # Prepare headers for FHIR JSON
-        headers = {
-        "Accept": "*/*",
-        "content-type": "application/fhir+json",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Prefer": "return=representation"
-        }
-
-        # Send the POST request
-        response = requests.post(endpoint, data=patient_json, headers=headers, auth=HTTPBasicAuth('_System', 'ISCDEMO'))
+        # Send the POST request to the Patient endpoint over the pooled connection
+        client = client or get_default_client()
+        response = client.post("Patient", data=patient_json)
 
         # Basic status check
         if response.status_code in (200, 201):
@@ -187,8 +340,11 @@ if __name__ == "__main__":
     #     name = patient.name[0]
     #     print(f"Identifier: {pid}, Given: {name.given[0]}, Family: {name.family}")
     #     print_fhir_resource(patient)
-    for index, (name, identifier) in enumerate(patients.get_short_form_patients(), start=1):
-      print(f"{index}. {name} : {identifier}")
+    index = 0
+    for page in patients.get_short_form_patients():
+        for name, identifier in page:
+            index += 1
+            print(f"{index}. {name} : {identifier}")
 
         
     # patients.post_patient("356-444-9972")
@@ -1,27 +1,127 @@
-def print_fhir_resource(resource):
+import json
+import sys
+from itertools import islice
+from pydantic import BaseModel
+
+# Entries shown by a bundle preview.
+DEFAULT_PREVIEW_ENTRIES = 2
+
+# Field name -> JSON name of each model class, see _json_names.
+_aliases = {}
+
+def _json_names(model_class) -> dict:
+    names = _aliases.get(model_class)
+    if names is None:
+        names = _aliases[model_class] = {name: field.alias for name, field in model_class.__fields__.items()}
+    return names
+
+def _fields(data):
+    # The non-None (name, value) pairs of a model or dict, in the order and with the names of
+    # resource.dict(), without exporting the nested models first.
+    if isinstance(data, dict):
+        return [(key, value) for key, value in data.items() if value is not None]
+    names = _json_names(type(data))
+    fields = [(names.get(name, name), value) for name, value in data.__dict__.items()
+              if value is not None and name != "resource_type"]
+    if getattr(data, "resource_type", None) and data.has_resource_base():
+        fields.append(("resourceType", data.resource_type))
+    return fields
+
+class _Formatter:
+    def __init__(self, max_depth: int = None, max_fields: int = None, max_value_length: int = None):
+        self.max_depth = max_depth
+        self.max_fields = max_fields
+        self.max_value_length = max_value_length
+        self.lines = []
+        self.truncated = False
+
+    def add(self, path: str, value, summary: bool = False) -> bool:
+        # Returns False once max_fields lines are written, which stops the walk.
+        if self.max_fields is not None and len(self.lines) >= self.max_fields:
+            self.truncated = True
+            return False
+        text = str(value)
+        if not summary and self.max_value_length is not None and len(text) > self.max_value_length:
+            text = text[:self.max_value_length] + f"... ({len(text)} chars)"
+        self.lines.append(f"{path}: {text}")
+        return True
+
+    def walk(self, data, prefix: str = "", depth: int = 0) -> bool:
+        if isinstance(data, (BaseModel, dict)):
+            items = _fields(data)
+            summary = "{...}"
+        elif isinstance(data, list):
+            items = [(f"[{index}]", item) for index, item in enumerate(data) if item is not None]
+            summary = f"[{len(data)} items]"
+        else:
+            # data is a scalar type (string, int, bool, etc.)
+            # prefix[:-1] to remove the last '.' from prefix
+            return self.add(prefix[:-1], data)
+        if self.max_depth is not None and depth >= self.max_depth and items:
+            return self.add(prefix[:-1], summary, summary=True)
+        for key, value in items:
+            if not self.walk(value, f"{prefix}{key}.", depth + 1):
+                return False
+        return True
+
+def _as_resource(resource):
+    # Serialized resources, e.g. entries built by bundlepipeline, are decoded for printing.
+    if isinstance(resource, (bytes, str)):
+        return json.loads(resource)
+    return resource
+
+def format_fhir_resource(resource, max_depth: int = None, max_fields: int = None, max_value_length: int = None) -> str:
+    """
+    Formats all non-None fields (including nested fields) of a FHIR resource object, one
+    "path: value" line per field, as print_fhir_resource prints them.
+
+    The model is walked directly instead of being exported with resource.dict() first, and
+    the walk stops at max_fields, so the cost depends on what is shown rather than on the
+    size of the resource.
+
+    :param resource: A FHIR resource object, a JSON dict, or its JSON as str/bytes.
+    :param max_depth: Nesting depth below which objects and lists are shown as {...} or [n items].
+    :param max_fields: The maximum number of lines; a truncation note follows them.
+    :param max_value_length: Values longer than this are cut off.
+    :return: The lines, each ending with a newline.
+    """
+    formatter = _Formatter(max_depth, max_fields, max_value_length)
+    formatter.walk(_as_resource(resource))
+    if formatter.truncated:
+        formatter.lines.append(f"... (truncated at {max_fields} fields)")
+    return "".join(f"{line}\n" for line in formatter.lines)
+
+def print_fhir_resource(resource, max_depth: int = None, max_fields: int = None, max_value_length: int = None,
+                        file=None):
     """
     Recursively prints all non-None fields (including nested fields)
     from a FHIR resource object, line by line.
+    The output is formatted first and written at once, see format_fhir_resource for the limits.
+
+    :param file: Where to write, defaults to sys.stdout.
     """
-    def print_non_none(data, prefix=""):
-        if isinstance(data, dict):
-            for key, value in data.items():
-                if value is not None:
-                    print_non_none(value, prefix=f"{prefix}{key}.")
-        elif isinstance(data, list):
-            for idx, item in enumerate(data):
-                if item is not None:
-                    print_non_none(item, prefix=f"{prefix}[{idx}].")
-        else:
-            # data is a scalar type (string, int, bool, etc.)
-            # prefix[:-1] to remove the last '.' or bracket from prefix
-            print(f"{prefix[:-1]}: {data}")
-            
-    # If the resource has a dict() method, use it; otherwise assume it's a dict.
-    if hasattr(resource, "dict"):
-        resource_dict = resource.dict()
-    else:
-        resource_dict = resource
-        
-    # Start the recursive printing
-    print_non_none(resource_dict)
\ No newline at end of file
+    (file or sys.stdout).write(format_fhir_resource(resource, max_depth, max_fields, max_value_length))
+
+def format_bundle_preview(entries, count: int = DEFAULT_PREVIEW_ENTRIES, total: int = None, **limits) -> str:
+    """
+    Formats the first entries of a bundle. entries is consumed lazily and only count items
+    are taken from it, so a generator of entries previews in O(count) whatever the size of
+    the bundle it belongs to.
+
+    :param entries: An iterable of (label, resource) pairs, e.g. ("Patient", patient).
+    :param count: The number of entries to show.
+    :param total: The number of entries of the whole bundle (or all its chunks), for the header, if known.
+    :param limits: max_depth, max_fields and max_value_length for each entry, see format_fhir_resource.
+    :return: The formatted preview.
+    """
+    parts = [] if total is None else [f"Total entries: {total}\n"]
+    for index, (label, resource) in enumerate(islice(entries, count), start=1):
+        parts.append(f"Entry {index} ({label}):\n")
+        parts.append(format_fhir_resource(resource, **limits))
+    if total is not None and total > count:
+        parts.append(f"... {total - count} more entries\n")
+    return "".join(parts)
+
+def print_bundle_preview(entries, count: int = DEFAULT_PREVIEW_ENTRIES, total: int = None, file=None, **limits):
+    """Prints the first entries of a bundle in one write, see format_bundle_preview."""
+    (file or sys.stdout).write(format_bundle_preview(entries, count, total, **limits))
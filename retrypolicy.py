@@ -0,0 +1,66 @@
+import random
+import threading
+
+# Entry or request statuses worth resending: timeouts, conflicts, throttling and server errors.
+# Anything else (400, 404, 422, ...) fails the same way when resent.
+RETRYABLE_STATUSES = frozenset((0, 408, 409, 423, 429, 500, 502, 503, 504))
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30.0
+# Entries resent over the lifetime of a policy, so a struggling server is not flooded with retries.
+DEFAULT_RETRY_BUDGET = 10000
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = DEFAULT_MAX_ATTEMPTS, base_delay: float = DEFAULT_BASE_DELAY,
+                 max_delay: float = DEFAULT_MAX_DELAY, budget: int = DEFAULT_RETRY_BUDGET,
+                 retryable_statuses=RETRYABLE_STATUSES, seed: int = None):
+        """
+        When and how often failed bundle entries are resent.
+
+        Waits grow exponentially with full jitter: before retry n the delay is uniform in
+        [0, min(max_delay, base_delay * 2**n)], or the server's Retry-After if that is longer.
+        One policy can be shared by all the bundles of an upload; its budget then caps the
+        total number of entries resent by all of them.
+
+        :param max_attempts: Attempts per entry, including the first post.
+        :param base_delay: Seconds before the first retry, before jitter.
+        :param max_delay: Upper bound of a single delay in seconds.
+        :param budget: The maximum number of entries resent over the lifetime of the policy.
+        :param retryable_statuses: Status codes worth retrying, 0 stands for a failed connection.
+        :param seed: Seed of the jitter, fixed seeds give reproducible delays.
+        """
+        if max_attempts < 1:
+            raise ValueError("max_attempts must be at least 1")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.retryable_statuses = retryable_statuses
+        self.random = random.Random(seed)
+        self.retried = 0
+        self._lock = threading.Lock()
+
+    def is_retryable(self, status_code: int) -> bool:
+        return status_code in self.retryable_statuses
+
+    def acquire(self, count: int) -> int:
+        """Takes up to count entries from the budget and returns how many may be resent."""
+        with self._lock:
+            granted = max(0, min(count, self.budget - self.retried))
+            self.retried += granted
+        return granted
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """Seconds to wait before retry number attempt (counting from 0)."""
+        with self._lock:
+            delay = self.random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+def retry_after_seconds(value: str) -> float:
+    """Parses a Retry-After header given in seconds, the form FHIR servers use. Returns None otherwise."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
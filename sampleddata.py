@@ -0,0 +1,198 @@
+from fhir.resources.observation import Observation, ObservationComponent
+from fhir.resources.codeableconcept import CodeableConcept
+from fhir.resources.coding import Coding
+from fhir.resources.period import Period
+from fhir.resources.quantity import Quantity
+from fhir.resources.reference import Reference
+from fhir.resources.sampleddata import SampledData
+from observation import HeartRateObservation
+from timestamps import DEFAULT_TZ_NAME, TimestampService, format_iso
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, readings are then grouped in Python
+    np = None
+
+# How readings become Observations in the bundle generators.
+MODE_RAW = "raw"          # one HeartRateObservation per reading
+MODE_SAMPLED = "sampled"  # one valueSampledData Observation per time window
+MODES = (MODE_RAW, MODE_SAMPLED)
+
+DEFAULT_WINDOW_SECONDS = 3600
+DEFAULT_PERIOD_SECONDS = 60
+STATISTICS_SYSTEM = "http://terminology.hl7.org/CodeSystem/observation-statistics"
+
+# Kinds of Observation already checked against the FHIR model, see _validate_once.
+_validated = set()
+
+class SampledHeartRateBuilder:
+    def __init__(self, window_seconds: int = DEFAULT_WINDOW_SECONDS, period_seconds: int = DEFAULT_PERIOD_SECONDS,
+                 summaries: bool = False, tz_name: str = DEFAULT_TZ_NAME):
+        """
+        Packs heart rate readings into one Observation per time window with valueSampledData.
+
+        Windows are aligned to multiples of window_seconds since the epoch and divided into
+        slots of period_seconds. Each slot holds the mean of its readings, or "E" if it has
+        none, so the data string has window_seconds / period_seconds values. An hour at one
+        reading per minute is one resource instead of 60.
+
+        :param window_seconds: Length of the time window of one Observation.
+        :param period_seconds: Sampling period, the readings of each period are averaged.
+        :param summaries: Also emit one Observation per window with min/max/mean/count components.
+        :param tz_name: Zone of effectivePeriod when no per-reading UTC offsets are given.
+        """
+        if period_seconds <= 0 or window_seconds % period_seconds:
+            raise ValueError("window_seconds must be a positive multiple of period_seconds")
+        self.window_seconds = window_seconds
+        self.period_seconds = period_seconds
+        self.summaries = summaries
+        self.tz_name = tz_name
+
+    def build(self, subject_id: str, rates, epochs, utc_offsets=None) -> list:
+        """
+        Builds the Observations for a set of readings, in time order. With summaries, each
+        window's summary follows its sampled Observation.
+
+        :param subject_id: The FHIR patient id (or identifier) used as the subject.
+        :param rates: Heart rates.
+        :param epochs: Epoch seconds of each reading, in any order.
+        :param utc_offsets: UTC offset in minutes of each reading, as HeartRateReader provides.
+                            effectivePeriod then uses the offset of the window's first reading.
+        """
+        windows = list(self.windows(rates, epochs, utc_offsets))
+        if not windows:
+            return []
+        starts = [window[0] for window in windows]
+        ends = [start + self.window_seconds - 1 for start in starts]
+        if utc_offsets is not None:
+            offsets = [window[1] for window in windows]
+            start_strings, end_strings = format_iso(starts, offsets), format_iso(ends, offsets)
+        else:
+            timestamps = TimestampService(self.tz_name)
+            start_strings, end_strings = timestamps.format_epochs(starts), timestamps.format_epochs(ends)
+
+        observations = []
+        for (_, _, slot_means, window_rates), start, end in zip(windows, start_strings, end_strings):
+            observations.append(self.sampled_observation(subject_id, slot_means, start, end))
+            if self.summaries:
+                observations.append(self.summary_observation(subject_id, window_rates, start, end))
+        return observations
+
+    def windows(self, rates, epochs, utc_offsets=None):
+        """
+        Yields (window start epoch, UTC offset of its first reading or None, slot means with
+        None for empty slots, the window's rates) for every window holding readings.
+        """
+        slots = self.window_seconds // self.period_seconds
+        if np is not None:
+            rates = np.asarray(rates, dtype=np.float64)
+            epochs = np.asarray(epochs, dtype=np.int64)
+            order = np.argsort(epochs, kind="stable")
+            rates, epochs = rates[order], epochs[order]
+            offsets = np.asarray(utc_offsets, dtype=np.int64)[order] if utc_offsets is not None else None
+            window_ids = epochs // self.window_seconds
+            bounds = np.concatenate(([0], np.flatnonzero(np.diff(window_ids)) + 1, [len(epochs)]))
+            for low, high in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                if low == high:
+                    continue
+                start = int(window_ids[low]) * self.window_seconds
+                slot_index = (epochs[low:high] - start) // self.period_seconds
+                sums = np.bincount(slot_index, weights=rates[low:high], minlength=slots)
+                counts = np.bincount(slot_index, minlength=slots)
+                means = [total / count if count else None for total, count in zip(sums.tolist(), counts.tolist())]
+                yield start, (int(offsets[low]) if offsets is not None else None), means, rates[low:high].tolist()
+            return
+
+        readings = sorted(zip(epochs, rates, utc_offsets if utc_offsets is not None else [None] * len(epochs)))
+        index = 0
+        while index < len(readings):
+            start = readings[index][0] // self.window_seconds * self.window_seconds
+            offset = readings[index][2]
+            sums, counts, window_rates = [0.0] * slots, [0] * slots, []
+            while index < len(readings) and readings[index][0] < start + self.window_seconds:
+                epoch, rate, _ = readings[index]
+                slot = (epoch - start) // self.period_seconds
+                sums[slot] += rate
+                counts[slot] += 1
+                window_rates.append(rate)
+                index += 1
+            yield start, offset, [total / count if count else None for total, count in zip(sums, counts)], window_rates
+
+    def sampled_observation(self, subject_id: str, slot_means: list, start: str, end: str) -> Observation:
+        """One Observation whose valueSampledData holds the slot means of a window."""
+        template = HeartRateObservation.get_template()
+        quantity = template.valueQuantity
+        observation = Observation.construct(
+            extension=list(template.extension),
+            category=list(template.category),
+            code=template.code,
+            effectivePeriod=Period.construct(start=start, end=end),
+            status=template.status,
+            subject=Reference.construct(reference=f"Patient/{subject_id}"),
+            valueSampledData=SampledData.construct(
+                origin=Quantity.construct(value=0, unit=quantity.unit, system=quantity.system, code=quantity.code),
+                period=self.period_seconds * 1000,
+                dimensions=1,
+                data=" ".join("E" if mean is None else _format_value(mean) for mean in slot_means)
+            )
+        )
+        _validate_once("sampled", observation)
+        return observation
+
+    def summary_observation(self, subject_id: str, window_rates: list, start: str, end: str) -> Observation:
+        """One Observation with the minimum, maximum, mean and count of a window's readings."""
+        template = HeartRateObservation.get_template()
+        quantity = template.valueQuantity
+
+        def statistic(code: str, display: str, value) -> ObservationComponent:
+            return ObservationComponent.construct(
+                code=CodeableConcept.construct(coding=[Coding.construct(system=STATISTICS_SYSTEM, code=code, display=display)]),
+                valueQuantity=Quantity.construct(value=value, unit=quantity.unit, system=quantity.system, code=quantity.code)
+            )
+
+        count = len(window_rates)
+        observation = Observation.construct(
+            extension=list(template.extension),
+            category=list(template.category),
+            code=template.code,
+            effectivePeriod=Period.construct(start=start, end=end),
+            status=template.status,
+            subject=Reference.construct(reference=f"Patient/{subject_id}"),
+            component=[
+                statistic("minimum", "Minimum", _number(min(window_rates))),
+                statistic("maximum", "Maximum", _number(max(window_rates))),
+                statistic("average", "Average", _number(round(sum(window_rates) / count, 1))),
+                ObservationComponent.construct(
+                    code=CodeableConcept.construct(coding=[Coding.construct(system=STATISTICS_SYSTEM, code="count", display="Count")]),
+                    valueInteger=count
+                )
+            ]
+        )
+        _validate_once("summary", observation)
+        return observation
+
+def _number(value):
+    # Whole numbers as int so the JSON reads 72 rather than 72.0.
+    return int(value) if float(value).is_integer() else value
+
+def _format_value(value: float) -> str:
+    return str(_number(round(value, 1)))
+
+def _validate_once(kind: str, observation: Observation) -> None:
+    # Observations are built with construct() for speed; the first of each kind is run
+    # through full validation so a malformed structure fails early instead of at the server.
+    if kind not in _validated:
+        Observation.parse_raw(observation.json())
+        _validated.add(kind)
+
+# Example usage:
+if __name__ == "__main__":
+    import random
+    import time
+
+    now = int(time.time())
+    epochs = [now - minute * 60 for minute in range(24 * 60)]
+    rates = [random.randint(60, 160) for _ in epochs]
+    observations = SampledHeartRateBuilder(summaries=True).build("2", rates, epochs)
+    print(f"{len(epochs)} readings -> {len(observations)} Observations")
+    print(observations[0].json(indent=2)[:800])
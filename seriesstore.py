@@ -0,0 +1,278 @@
+from array import array
+from bisect import bisect_left
+from heartratereader import FORMAT_BLOCK_SIZE
+from observation import HeartRateObservation
+from timestamps import format_iso
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, merging and statistics then run in Python
+    np = None
+
+# How long MainHR and the directory watcher keep readings, relative to each patient's latest.
+DEFAULT_RETENTION_SECONDS = 3 * 24 * 3600
+# NumPy dtype matching each array typecode used by the series.
+_DTYPES = {'H': "uint16", 'q': "int64", 'h': "int16"}
+
+def _as_array(typecode: str, values) -> array:
+    if np is not None and isinstance(values, np.ndarray):
+        # One copy of the buffer instead of a Python int per value.
+        return array(typecode, values.astype(_DTYPES[typecode]).tobytes())
+    return values if isinstance(values, array) and values.typecode == typecode else array(typecode, values)
+
+class WindowStats:
+    __slots__ = ("start_epoch", "count", "min", "max", "mean")
+
+    def __init__(self, start_epoch: int, count: int, min: int, max: int, mean: float):
+        """Statistics of the readings of one time window, see PatientSeries.window_stats."""
+        self.start_epoch = start_epoch
+        self.count = count
+        self.min = min
+        self.max = max
+        self.mean = mean
+
+    def __repr__(self) -> str:
+        return (f"WindowStats(start_epoch={self.start_epoch}, count={self.count}, "
+                f"min={self.min}, max={self.max}, mean={self.mean:.1f})")
+
+class PatientSeries:
+    __slots__ = ("identifier", "rates", "epochs", "utc_offsets")
+
+    def __init__(self, identifier: str, rates=None, epochs=None, utc_offsets=None):
+        """
+        The heart rate readings of one patient in time order, as parallel arrays: rates as
+        unsigned 16 bit integers, epoch seconds as int64 and UTC offsets in minutes as int16,
+        12 bytes per reading. Observations are only built from it when they are serialized
+        (iter_observations).
+
+        :param identifier: The identifier of the patient in the form '356-444-9972'.
+        :param rates: Initial readings, in any order. Unlike add, equal readings are all kept.
+        :param epochs: Epoch seconds, one per rate.
+        :param utc_offsets: UTC offsets in minutes, one per rate.
+        """
+        self.identifier = identifier
+        self.rates = array('H')
+        self.epochs = array('q')
+        self.utc_offsets = array('h')
+        if rates is not None:
+            self.add(rates, epochs, utc_offsets, unique=False)
+
+    def __len__(self) -> int:
+        return len(self.epochs)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(values.itemsize * len(values) for values in (self.rates, self.epochs, self.utc_offsets))
+
+    def add(self, rates, epochs, utc_offsets, unique: bool = True) -> int:
+        """
+        Adds readings in any order. Readings later than all stored ones are appended, others
+        are merged in.
+
+        :param unique: Drop readings with the same time and rate as another one, e.g. when a
+                       file is read again.
+        :return: The number of readings in the series afterwards.
+        """
+        if len(epochs) == 0:
+            return len(self)
+        rates, epochs, utc_offsets = _as_array('H', rates), _as_array('q', epochs), _as_array('h', utc_offsets)
+        if self._is_sorted(epochs) and (not self.epochs or epochs[0] > self.epochs[-1]):
+            # The common case of new readings, no sorting or searching needed.
+            self.rates.extend(rates)
+            self.epochs.extend(epochs)
+            self.utc_offsets.extend(utc_offsets)
+            return len(self)
+        self.rates += rates
+        self.epochs += epochs
+        self.utc_offsets += utc_offsets
+        self._sort(unique)
+        return len(self)
+
+    @staticmethod
+    def _is_sorted(epochs) -> bool:
+        if np is not None:
+            return bool(np.all(np.diff(np.frombuffer(epochs, dtype=np.int64)) > 0))
+        return all(earlier < later for earlier, later in zip(epochs, epochs[1:]))
+
+    def _sort(self, unique: bool) -> None:
+        if np is not None:
+            rates = np.frombuffer(self.rates, dtype=np.uint16)
+            epochs = np.frombuffer(self.epochs, dtype=np.int64)
+            order = np.lexsort((rates, epochs))
+            rates, epochs, offsets = rates[order], epochs[order], np.frombuffer(self.utc_offsets, dtype=np.int16)[order]
+            if unique:
+                keep = np.concatenate(([True], (np.diff(epochs) != 0) | (np.diff(rates.astype(np.int32)) != 0)))
+                rates, epochs, offsets = rates[keep], epochs[keep], offsets[keep]
+            self.rates, self.epochs = array('H', rates.tobytes()), array('q', epochs.tobytes())
+            self.utc_offsets = array('h', offsets.tobytes())
+            return
+        readings = sorted(zip(self.epochs, self.rates, self.utc_offsets))
+        if unique:
+            readings = [reading for index, reading in enumerate(readings)
+                        if index == 0 or reading[:2] != readings[index - 1][:2]]
+        self.epochs = array('q', (reading[0] for reading in readings))
+        self.rates = array('H', (reading[1] for reading in readings))
+        self.utc_offsets = array('h', (reading[2] for reading in readings))
+
+    def _bounds(self, start_epoch: int = None, end_epoch: int = None) -> tuple:
+        low = 0 if start_epoch is None else bisect_left(self.epochs, start_epoch)
+        high = len(self.epochs) if end_epoch is None else bisect_left(self.epochs, end_epoch)
+        return low, max(low, high)
+
+    def range(self, start_epoch: int = None, end_epoch: int = None) -> "PatientSeries":
+        """The readings in [start_epoch, end_epoch), found by binary search, as a new series."""
+        low, high = self._bounds(start_epoch, end_epoch)
+        series = PatientSeries(self.identifier)
+        series.rates, series.epochs = self.rates[low:high], self.epochs[low:high]
+        series.utc_offsets = self.utc_offsets[low:high]
+        return series
+
+    def head(self, count: int) -> "PatientSeries":
+        """The first count readings as a new series."""
+        series = PatientSeries(self.identifier)
+        series.rates, series.epochs, series.utc_offsets = self.rates[:count], self.epochs[:count], self.utc_offsets[:count]
+        return series
+
+    def trim(self, before_epoch: int) -> int:
+        """Drops the readings before before_epoch, returns how many were dropped."""
+        low, _ = self._bounds(before_epoch)
+        del self.rates[:low], self.epochs[:low], self.utc_offsets[:low]
+        return low
+
+    def _windows(self, seconds: int, start_epoch: int = None, end_epoch: int = None) -> tuple:
+        # (low, high) index bounds of every non-empty window of the range, windows being
+        # aligned to multiples of seconds since the epoch.
+        low, high = self._bounds(start_epoch, end_epoch)
+        if low == high:
+            return []
+        if np is not None:
+            window_ids = np.frombuffer(self.epochs, dtype=np.int64)[low:high] // seconds
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(window_ids)) + 1)) + low
+            return list(zip(starts.tolist(), starts[1:].tolist() + [high]))
+        bounds = []
+        index = low
+        while index < high:
+            end = min(high, bisect_left(self.epochs, (self.epochs[index] // seconds + 1) * seconds))
+            bounds.append((index, end))
+            index = end
+        return bounds
+
+    def window_stats(self, seconds: int, start_epoch: int = None, end_epoch: int = None) -> list:
+        """
+        Count, min, max and mean of the readings of every window of seconds that holds any,
+        in time order, optionally only over [start_epoch, end_epoch).
+        """
+        windows = self._windows(seconds, start_epoch, end_epoch)
+        if not windows:
+            return []
+        if np is not None:
+            rates = np.frombuffer(self.rates, dtype=np.uint16)
+            starts = np.array([low for low, _ in windows])
+            counts = np.array([high - low for low, high in windows])
+            low, high = windows[0][0], windows[-1][1]
+            values = rates[low:high].astype(np.int64)
+            offsets = starts - low
+            sums = np.add.reduceat(values, offsets).tolist()
+            minimums = np.minimum.reduceat(values, offsets).tolist()
+            maximums = np.maximum.reduceat(values, offsets).tolist()
+            return [WindowStats(self.epochs[start] // seconds * seconds, count, minimum, maximum, total / count)
+                    for start, count, minimum, maximum, total
+                    in zip(starts.tolist(), counts.tolist(), minimums, maximums, sums)]
+        stats = []
+        for low, high in windows:
+            values = self.rates[low:high]
+            stats.append(WindowStats(self.epochs[low] // seconds * seconds, high - low, min(values), max(values),
+                                     sum(values) / (high - low)))
+        return stats
+
+    def downsample(self, seconds: int, start_epoch: int = None, end_epoch: int = None) -> "PatientSeries":
+        """
+        One reading per window of seconds that holds any: the rounded mean rate, at the window
+        start, with the UTC offset of the window's first reading.
+        """
+        windows = self._windows(seconds, start_epoch, end_epoch)
+        series = PatientSeries(self.identifier)
+        stats = self.window_stats(seconds, start_epoch, end_epoch)
+        series.rates = array('H', (round(window.mean) for window in stats))
+        series.epochs = array('q', (window.start_epoch for window in stats))
+        series.utc_offsets = array('h', (self.utc_offsets[low] for low, _ in windows))
+        return series
+
+    def iter_observations(self, subject_id: str, start_epoch: int = None, end_epoch: int = None):
+        """
+        Lazily builds one HeartRateObservation per reading of [start_epoch, end_epoch), in
+        time order, a block of readings at a time.
+
+        :param subject_id: The FHIR id or identifier used as the Observation subject.
+        """
+        low, high = self._bounds(start_epoch, end_epoch)
+        for start in range(low, high, FORMAT_BLOCK_SIZE):
+            end = min(high, start + FORMAT_BLOCK_SIZE)
+            effective_dts = format_iso(self.epochs[start:end], self.utc_offsets[start:end])
+            yield from HeartRateObservation.build_many(subject_id, self.rates[start:end], effective_dts)
+
+class SeriesStore:
+    __slots__ = ("series", "max_age_seconds")
+
+    def __init__(self, max_age_seconds: int = None):
+        """
+        The readings of many patients in memory, one PatientSeries per patient identifier.
+        At 12 bytes per reading, three days of minute readings for 1000 patients take about
+        50 MB, where the same readings as Observation objects would take gigabytes.
+
+        :param max_age_seconds: Readings older than this, relative to a patient's latest reading,
+                                are dropped when readings are added. None keeps everything.
+        """
+        self.series = {}
+        self.max_age_seconds = max_age_seconds
+
+    def __len__(self) -> int:
+        return len(self.series)
+
+    def __contains__(self, identifier: str) -> bool:
+        return identifier in self.series
+
+    def __getitem__(self, identifier: str) -> PatientSeries:
+        return self.series[identifier]
+
+    @property
+    def identifiers(self) -> list:
+        return list(self.series)
+
+    @property
+    def reading_count(self) -> int:
+        return sum(len(series) for series in self.series.values())
+
+    @property
+    def nbytes(self) -> int:
+        return sum(series.nbytes for series in self.series.values())
+
+    def get(self, identifier: str) -> PatientSeries:
+        """The series of a patient, created empty if the patient has none yet."""
+        series = self.series.get(identifier)
+        if series is None:
+            series = self.series[identifier] = PatientSeries(identifier)
+        return series
+
+    def add(self, identifier: str, rates, epochs, utc_offsets) -> PatientSeries:
+        """Adds readings of a patient, see PatientSeries.add, and returns the patient's series."""
+        series = self.get(identifier)
+        series.add(rates, epochs, utc_offsets)
+        if self.max_age_seconds is not None and len(series):
+            series.trim(series.epochs[-1] - self.max_age_seconds)
+        return series
+
+    def remove(self, identifier: str) -> None:
+        self.series.pop(identifier, None)
+
+# Example usage:
+if __name__ == "__main__":
+    from heartratereader import HeartRateReader
+
+    store = SeriesStore()
+    reader = HeartRateReader("3564449972.txt")
+    series = store.add("356-444-9972", reader.rates, reader.epochs, reader.utc_offsets)
+    print(f"{len(series)} readings in {series.nbytes} bytes")
+    for window in series.window_stats(3600)[:5]:
+        print(window)
+    print(f"Hourly: {len(series.downsample(3600))} readings")
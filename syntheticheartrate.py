@@ -0,0 +1,113 @@
+from datetime import datetime
+from timestamps import get_zone
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for batch generation
+    np = None
+
+# Shapes of the synthetic heart rate signal.
+SHAPE_UNIFORM = "uniform"          # independent uniform rates, like random.randint
+SHAPE_CIRCADIAN = "circadian"      # daily cycle, low at night and highest in the afternoon, plus noise
+SHAPE_RANDOM_WALK = "random_walk"  # circadian baseline plus a slowly wandering random walk
+SHAPES = (SHAPE_UNIFORM, SHAPE_CIRCADIAN, SHAPE_RANDOM_WALK)
+
+class SyntheticHeartRateGenerator:
+    def __init__(self, seed: int = None, low_hr: int = 60, high_hr: int = 160, shape: str = SHAPE_UNIFORM,
+                 tachycardia_per_day: float = 0.0):
+        """
+        Generates heart rate readings as NumPy arrays in one shot.
+
+        :param seed: Seed of the numpy Generator, fixed seeds give reproducible load tests.
+        :param low_hr: Lower bound for heart rate values.
+        :param high_hr: Upper bound for heart rate values.
+        :param shape: One of SHAPES.
+        :param tachycardia_per_day: Expected number of tachycardia episodes (10-40 minutes at
+                                    130-180 bpm) per day of readings.
+        """
+        if np is None:
+            raise ImportError("SyntheticHeartRateGenerator requires numpy (pip install numpy)")
+        if shape not in SHAPES:
+            raise ValueError(f"shape must be one of {SHAPES}")
+        self.rng = np.random.default_rng(seed)
+        self.low_hr = low_hr
+        self.high_hr = high_hr
+        self.shape = shape
+        self.tachycardia_per_day = tachycardia_per_day
+
+    def generate(self, count: int, start_epoch: int, span_seconds: int, tz_name: str = "America/New_York", sort: bool = False):
+        """
+        Generates count readings at random times in [start_epoch, start_epoch + span_seconds).
+
+        :param count: The number of readings.
+        :param start_epoch: Epoch seconds of the start of the time span.
+        :param span_seconds: Length of the time span in seconds.
+        :param tz_name: Zone whose local time drives the circadian cycle.
+        :param sort: Return the readings in time order instead of random order.
+        :return: (rates as uint8 array, epoch seconds as int64 array)
+        """
+        offsets = self.rng.integers(0, span_seconds, size=count, dtype=np.int64)
+        if sort or self.shape == SHAPE_RANDOM_WALK:
+            offsets.sort()
+        epochs = start_epoch + offsets
+        rates = self.rates_at(epochs, tz_name)
+        if not sort and self.shape == SHAPE_RANDOM_WALK:
+            # The walk needs time order; shuffle afterwards to match the other shapes.
+            order = self.rng.permutation(count)
+            epochs, rates = epochs[order], rates[order]
+        return rates, epochs
+
+    def rates_at(self, epochs, tz_name: str = "America/New_York"):
+        """Returns a uint8 heart rate for each epoch in the configured shape."""
+        count = len(epochs)
+        if self.shape == SHAPE_UNIFORM:
+            rates = self.rng.integers(self.low_hr, self.high_hr + 1, size=count).astype(np.float64)
+        else:
+            rates = self._circadian_baseline(epochs, tz_name)
+            rates += self.rng.normal(0.0, 3.0, size=count)
+            if self.shape == SHAPE_RANDOM_WALK:
+                # Time-ordered steps; pulling the walk back toward zero keeps it within a few bpm of the baseline.
+                walk = np.cumsum(self.rng.normal(0.0, 0.8, size=count))
+                rates += walk - _moving_average(walk, 240)
+        if self.tachycardia_per_day > 0 and count:
+            rates = self._add_tachycardia(epochs, rates)
+        return np.clip(np.rint(rates), 0, 255).astype(np.uint8)
+
+    def _circadian_baseline(self, epochs, tz_name: str):
+        # Local hour of day, using one UTC offset for the whole batch.
+        tz = get_zone(tz_name)
+        utc_offset = datetime.fromtimestamp(int(epochs[0]) if len(epochs) else 0, tz).utcoffset().total_seconds()
+        hours = ((epochs + utc_offset) % 86400) / 3600.0
+        middle = (self.low_hr + self.high_hr) / 2.0
+        amplitude = (self.high_hr - self.low_hr) / 4.0
+        # Lowest around 4am, highest around 4pm.
+        return middle - amplitude * np.cos(2.0 * np.pi * (hours - 4.0) / 24.0)
+
+    def _add_tachycardia(self, epochs, rates):
+        start, end = int(epochs.min()), int(epochs.max()) + 1
+        days = (end - start) / 86400.0
+        for _ in range(self.rng.poisson(self.tachycardia_per_day * max(days, 1e-9))):
+            episode_start = self.rng.integers(start, end)
+            duration = self.rng.integers(10 * 60, 40 * 60)
+            in_episode = (epochs >= episode_start) & (epochs < episode_start + duration)
+            rates[in_episode] = self.rng.uniform(130, 180, size=int(in_episode.sum()))
+        return rates
+
+def _moving_average(values, window: int):
+    # Centered moving average in O(n); the window shrinks at both ends instead of padding with zeros.
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+    index = np.arange(len(values))
+    low = np.clip(index - window // 2, 0, len(values))
+    high = np.clip(index + window // 2 + 1, 0, len(values))
+    return (cumulative[high] - cumulative[low]) / (high - low)
+
+# Example usage:
+if __name__ == "__main__":
+    import time
+
+    generator = SyntheticHeartRateGenerator(seed=42, shape=SHAPE_RANDOM_WALK, tachycardia_per_day=2)
+    start = time.perf_counter()
+    rates, epochs = generator.generate(1_000_000, int(datetime(2025, 3, 1, tzinfo=get_zone("America/New_York")).timestamp()),
+                                       7 * 86400, sort=True)
+    print(f"Generated {len(rates)} readings in {time.perf_counter() - start:.2f}s, "
+          f"min {rates.min()} mean {rates.mean():.1f} max {rates.max()}")
@@ -0,0 +1,150 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, timestamps are then formatted one by one
+    np = None
+
+DEFAULT_TZ_NAME = "America/New_York"
+
+@lru_cache(maxsize=None)
+def get_zone(tz_name: str = DEFAULT_TZ_NAME):
+    """
+    Returns the tzinfo for an IANA zone such as "America/New_York", or a fixed offset
+    timezone for names like "-05:00". Each zone is only looked up once.
+    """
+    if tz_name[:1] in ("+", "-"):
+        sign = -1 if tz_name[0] == "-" else 1
+        hours, minutes = tz_name[1:].split(":")
+        return timezone(sign * timedelta(hours=int(hours), minutes=int(minutes)))
+    return ZoneInfo(tz_name)
+
+class OffsetTable:
+    def __init__(self, tz, start_epoch: int, end_epoch: int):
+        """
+        UTC offsets of a zone between two epochs as a transition table, so the offset of any
+        number of timestamps is a binary search instead of a zone lookup each. Transitions are
+        found by sampling every hour and then narrowed to the quarter hour, since zones change
+        their offset on hour, half hour (Lord Howe) or quarter hour boundaries.
+
+        :param tz: The tzinfo, e.g. get_zone("America/New_York").
+        :param start_epoch: First epoch second covered.
+        :param end_epoch: Last epoch second covered.
+        """
+        first_hour = int(start_epoch) // 3600
+        last_hour = int(end_epoch) // 3600
+        # transitions[i] is the first epoch with offset minutes offsets[i].
+        self.transitions = [first_hour * 3600]
+        self.offsets = [_offset_minutes(first_hour * 3600, tz)]
+        for hour in range(first_hour + 1, last_hour + 1):
+            offset = _offset_minutes(hour * 3600, tz)
+            if offset != self.offsets[-1]:
+                transition = hour * 3600
+                for quarter in (2700, 1800, 900):
+                    if _offset_minutes(transition - quarter, tz) == offset:
+                        transition -= quarter
+                        break
+                self.transitions.append(transition)
+                self.offsets.append(offset)
+
+    def offset_at(self, epoch: int) -> int:
+        """UTC offset in minutes at an epoch second."""
+        return self.offsets[max(0, bisect_right(self.transitions, epoch) - 1)]
+
+    def offsets_for(self, epochs):
+        """UTC offsets in minutes of many epochs, a numpy array when numpy is available."""
+        if len(self.offsets) == 1:
+            if np is not None:
+                return np.full(len(epochs), self.offsets[0], dtype=np.int64)
+            return [self.offsets[0]] * len(epochs)
+        if np is not None:
+            index = np.searchsorted(np.asarray(self.transitions, dtype=np.int64), _as_int64(epochs), side="right") - 1
+            return np.asarray(self.offsets, dtype=np.int64)[np.maximum(index, 0)]
+        return [self.offset_at(epoch) for epoch in epochs]
+
+def _offset_minutes(epoch: int, tz) -> int:
+    return int(datetime.fromtimestamp(epoch, tz).utcoffset().total_seconds()) // 60
+
+@lru_cache(maxsize=None)
+def _offset_suffix(minutes: int) -> str:
+    # Same form as datetime.isoformat(): "+00:00", "-05:00", "+05:30".
+    sign = "-" if minutes < 0 else "+"
+    return f"{sign}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}"
+
+def _as_int64(values):
+    if isinstance(values, np.ndarray):
+        return values.astype(np.int64, copy=False)
+    try:
+        # array('q'), array('h') and other buffers are viewed without copying.
+        return np.frombuffer(values, dtype=np.dtype(values.typecode)).astype(np.int64)
+    except (AttributeError, TypeError):
+        return np.asarray(values, dtype=np.int64)
+
+def format_iso(epochs, utc_offsets) -> list:
+    """
+    Formats epoch seconds as ISO 8601 local times, exactly like
+    datetime.fromtimestamp(epoch, tz).isoformat() for whole seconds.
+
+    :param epochs: Epoch seconds.
+    :param utc_offsets: The UTC offset in minutes of each epoch.
+    :return: A list of strings such as "2025-03-04T08:57:35-06:00".
+    """
+    if len(epochs) == 0:
+        return []
+    if np is not None:
+        offsets = _as_int64(utc_offsets)
+        local = _as_int64(epochs) + offsets * 60
+        # One vectorized conversion of the local wall-clock times.
+        stamps = np.datetime_as_string(local.astype("datetime64[s]"), unit="s").tolist()
+        return [stamp + _offset_suffix(offset) for stamp, offset in zip(stamps, offsets.tolist())]
+    days = {}
+    result = []
+    for epoch, offset in zip(epochs, utc_offsets):
+        day, seconds = divmod(epoch + offset * 60, 86400)
+        date = days.get(day)
+        if date is None:
+            date = days[day] = datetime.fromtimestamp(day * 86400, timezone.utc).strftime("%Y-%m-%dT")
+        result.append(f"{date}{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}{_offset_suffix(offset)}")
+    return result
+
+class TimestampService:
+    def __init__(self, tz_name: str = DEFAULT_TZ_NAME, now: datetime = None):
+        """
+        Timestamps for one bundle. "now" is captured once, so every reading of the bundle is
+        placed relative to the same instant, and timestamps are formatted in bulk.
+
+        :param tz_name: The zone of the formatted timestamps.
+        :param now: The reference instant, defaults to the current time truncated to the second.
+        """
+        self.tz = get_zone(tz_name)
+        self.now = now or datetime.now(self.tz).replace(microsecond=0)
+        self.now_epoch = int(self.now.timestamp())
+
+    def minutes_ago(self, minutes: int) -> datetime:
+        return self.now - timedelta(minutes=minutes)
+
+    def format_epochs(self, epochs) -> list:
+        """ISO 8601 strings in this zone for many epoch seconds."""
+        if len(epochs) == 0:
+            return []
+        if np is not None:
+            epochs = _as_int64(epochs)
+            start, end = int(epochs.min()), int(epochs.max())
+        else:
+            start, end = min(epochs), max(epochs)
+        return format_iso(epochs, OffsetTable(self.tz, start, end).offsets_for(epochs))
+
+    def format_minutes_ago(self, minutes) -> list:
+        """ISO 8601 strings for readings the given numbers of minutes before now."""
+        if np is not None:
+            return self.format_epochs(self.now_epoch - _as_int64(minutes) * 60)
+        return self.format_epochs([self.now_epoch - minute * 60 for minute in minutes])
+
+# Example usage:
+if __name__ == "__main__":
+    timestamps = TimestampService()
+    print(timestamps.now.isoformat())
+    print(timestamps.format_minutes_ago([0, 5, 60, 1440]))
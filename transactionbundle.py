@@ -1,39 +1,67 @@
+import time
 import uuid
-import requests
 from fhir.resources.bundle import Bundle, BundleEntry, BundleEntryRequest
 from fhir.resources.patient import Patient
 from fhir.resources.observation import Observation
-from patients import Patients
+from patients import Patients, identifier_token
 from observation import HeartRateObservation
-import requests
-from requests.auth import HTTPBasicAuth
 from printresource import print_fhir_resource
+from bundlestream import stream_bundle_json
+from bundleresponse import DEFAULT_READ_SIZE, parse_bundle_response, response_text
+from fhirserverclient import FhirClient, get_default_client
+from metrics import PostStats, metrics
 
 
+def refer_to(observations, patient_full_url: str):
+    """
+    Copies of the Observations with their subject set to a Patient fullUrl, as a
+    TransactionBundle posts them, e.g. to preview a bundle without building it.
+    """
+    for observation in observations:
+        observation = observation.copy(deep=True)
+        observation.subject.reference = patient_full_url
+        yield observation
+
 class TransactionBundle:
-    def __init__(self, patient: Patient, observations):
+    def __init__(self, patient: Patient, observations, conditional: bool = True, patient_full_url: str = None):
         """
         Initializes a TransactionBundle.
         
         :param patient: A FHIR Patient resource.
-        :param observations: A single Observation or a list of Observation resources.
+        :param observations: A single Observation or a list of Observation resources (models, JSON dicts
+                             or serialized JSON bytes).
                              Each Observation's subject will be updated to reference the patient.
+        :param conditional: Create the Patient with ifNoneExist on its identifier (system|value),
+                            so the server reuses an existing Patient instead of creating a duplicate.
+        :param patient_full_url: The fullUrl of the Patient entry, defaults to a new urn:uuid. Observations
+                                 given as serialized JSON bytes must already refer to it (see bundlepipeline).
         """
+        started = time.perf_counter()
+        self.stats = PostStats()   # timings and byte counts, shown by print_ids
         # Ensure observations is a list.
         if not isinstance(observations, list):
             observations = [observations]
             
         # Generate UUID-based fullUrl for the Patient entry.
-        self.patient_fullUrl = f"urn:uuid:{uuid.uuid4()}"
+        self.patient_fullUrl = patient_full_url or f"urn:uuid:{uuid.uuid4()}"
         
-        # Create the Patient BundleEntry.
-        patient_entry = BundleEntry.construct(
-            fullUrl=self.patient_fullUrl,
-            resource=patient,
-            request=BundleEntryRequest.construct(
+        # Create the Patient BundleEntry, conditional on no Patient with the same identifier existing.
+        token = identifier_token(patient) if conditional else None
+        if token:
+            patient_request = BundleEntryRequest.construct(
+                method="POST",
+                url="Patient",
+                ifNoneExist=f"identifier={token}"
+            )
+        else:
+            patient_request = BundleEntryRequest.construct(
                 method="POST",
                 url="Patient"
             )
+        patient_entry = BundleEntry.construct(
+            fullUrl=self.patient_fullUrl,
+            resource=patient,
+            request=patient_request
         )
         
         # Process each Observation.
@@ -42,7 +70,10 @@ class TransactionBundle:
             # Generate a unique fullUrl for each Observation.
             obs_fullUrl = f"urn:uuid:{uuid.uuid4()}"
             # Update the Observation subject to reference the Patient fullUrl.
-            obs.subject.reference = self.patient_fullUrl
+            if isinstance(obs, dict):
+                obs["subject"] = {"reference": self.patient_fullUrl}
+            elif not isinstance(obs, bytes):
+                obs.subject.reference = self.patient_fullUrl
             # Create the Observation BundleEntry.
             observation_entry = BundleEntry.construct(
                 fullUrl=obs_fullUrl,
@@ -59,45 +90,92 @@ class TransactionBundle:
             type="transaction",
             entry=[patient_entry] + self.observation_entries
         )
+        self.stats.built(time.perf_counter() - started)
         
         # Initialize IDs (to be set after posting)
         self.patient_id = ""
         self.observation_ids = []  # list for multiple observations
 
 
+    def iter_entries(self):
+        """
+        Yields a (resource, request, fullUrl) tuple for the Patient and each Observation.
+        """
+        for entry in self.bundle.entry:
+            yield entry.resource, entry.request, entry.fullUrl
+
+    def iter_json(self):
+        """
+        Streams the Bundle JSON in chunks without building the whole document in memory.
+        """
+        return stream_bundle_json("transaction", self.iter_entries())
+
     # the return of this function is the id of the patient
-    def post_bundle(self) -> str:
+    def post_bundle(self, client: FhirClient = None) -> str:
         """
         Posts a FHIR Transaction bundle to a local FHIR server.
+        The Bundle JSON is sent as a chunked request body while it is being encoded.
+        :param client: The FhirClient to post with, defaults to the shared client.
         :return: The response object from the POST request.
         """
-        bundle_json = self.bundle.json()
-        endpoint = "http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4/"
-        headers = {
-            "Accept": "*/*",
-            "Content-Type": "application/fhir+json",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Prefer": "return=representation"
-        }
-        response = requests.post(endpoint, data=bundle_json, headers=headers,
-                                 auth=HTTPBasicAuth('_System', 'ISCDEMO'))
-        
+        client = client or get_default_client()
+        started = time.perf_counter()
+        try:
+            # Passed as a function, so the body can be encoded again if it has to be resent.
+            response = client.post_bundle(lambda: self.stats.body(self.iter_json()))
+        finally:
+            self.stats.request(time.perf_counter() - started, 0.0)
+        metrics.count("entries_posted", len(self.bundle.entry))
+        started = time.perf_counter()
         if response.status_code in (200, 201):
-            resource = response.json()
-            # Extract the patient id from the first entry.
-            self.patient_id = resource['entry'][0]['resource']['id']
+            patient_id = self.read_response(response.status_code, self.stats.response(response.iter_content(DEFAULT_READ_SIZE)))
+        else:
+            patient_id = self.read_response(response.status_code, response.text)
+        self.stats.parsed(time.perf_counter() - started)
+        return patient_id
+
+    def read_response(self, status_code: int, body) -> str:
+        """
+        Collects the Patient and Observation ids from the server's answer to this bundle.
+        The ids are taken from each entry's response.location, so minimal responses work and
+        echoed resources are never decoded. Shared by post_bundle and the asynchronous uploader.
+
+        :param status_code: HTTP status of the POST.
+        :param body: Response body as str, bytes or an iterable of bytes chunks.
+        :return: The new Patient id on success, "" otherwise.
+        """
+        if status_code in (200, 201):
+            entries = parse_bundle_response(body)
+            if len(entries) != len(self.bundle.entry):
+                # e.g. an OperationOutcome instead of a transaction-response Bundle.
+                print(f"Failed to post Transaction Bundle. Malformed response: "
+                      f"{len(entries)} entries in the response, {len(self.bundle.entry)} posted")
+                self.patient_id = ""
+                self.observation_ids = []
+                metrics.count("entries_failed", len(self.bundle.entry))
+                return ""
+            # Extract the patient id from the first entry. This also covers a conditional
+            # create that matched an existing Patient.
+            self.patient_id = entries[0].id or ""
             # For each observation entry (assuming they follow patient entry),
             # collect their ids.
-            self.observation_ids = [entry['resource']['id'] for entry in resource['entry'][1:]]
+            self.observation_ids = [entry.id for entry in entries[1:]]
+            metrics.count("bundles_posted")
             # (Optional) Call your print function here.
             # print_fhir_resource(resource)
             return self.patient_id
         else:
-            print(f"Failed to post Transaction Bundle. Status code: {response.status_code}")
-            print("Response:", response.text)
+            print(f"Failed to post Transaction Bundle. Status code: {status_code}")
+            print("Response:", response_text(body))
+            metrics.count("entries_failed", len(self.bundle.entry))
             return ""
-        
-        return response
+
+    @property
+    def failed_count(self) -> int:
+        """The number of Observations not stored by the last post, all of them if the transaction failed."""
+        if not self.patient_id:
+            return len(self.observation_entries)
+        return self.observation_ids.count(None)
 
     def get_patient_id(self):
         return self.patient_id
@@ -108,6 +186,7 @@ class TransactionBundle:
     def print_ids(self):
         print("Patient ID:", self.get_patient_id())
         print("Observation IDs:", self.get_observation_ids())
+        print(self.stats.summary())
 
 # Example usage:
 if __name__ == "__main__":